@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""\
+Benchmark the Subledger Python API against a local stand-in of Subledger
+
+Runs from_id, all, save, get_balance and journal entry posting against
+subledger.testing.FakeSubledger at each injected latency and writes the
+timings as JSON, for comparison between revisions. The memory used per model
+instance and the cost of encoding and decoding payloads with each installed
+serializer are included.
+
+    python benchmarks.py --latency 0 0.02 --accounts 200 --entries 500
+"""
+import argparse
+import datetime
+import json
+import logging
+import platform
+import sys
+import time
+
+from subledger.base import SubledgerBase
+from subledger.identity import IdentityMap
+from subledger.models import Organization, Book, Account, JournalEntry, Line
+from subledger.serializers import get_serializer, available_serializers
+from subledger.testing import FakeSubledger
+
+
+class Timer(object):
+    """Collect the duration of repeated operations """
+
+    def __init__(self):
+        self.durations = []
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.durations.append(time.time() - self._start)
+
+    def result(self, operations=None):
+        """Return a summary, `operations` per timed block default to 1 """
+        durations = sorted(self.durations)
+        total = sum(durations)
+        count = operations or len(durations)
+        return {'count': count,
+                'seconds': total,
+                'ops_per_second': count / total if total else None,
+                'mean': total / count if count else None,
+                'p50': durations[len(durations) // 2] if durations else None,
+                'p95': durations[int(len(durations) * 0.95)]
+                if durations else None}
+
+
+def reset_index():
+    SubledgerBase.set_identity_map(IdentityMap())
+
+
+def entry_lines(debit, credit, amount='1.00'):
+    return [{'account': debit._id,
+             'value': {'type': 'debit', 'amount': amount}},
+            {'account': credit._id,
+             'value': {'type': 'credit', 'amount': amount}}]
+
+
+def run(latency, n_accounts, n_entries, workers):
+    """Run all benchmarks at the given latency, return their results """
+    server = FakeSubledger(latency=latency).start()
+    SubledgerBase.set_access(server.access(pool_maxsize=workers))
+    reset_index()
+    results = {}
+    try:
+        org_id = server.seed(books=1, accounts=n_accounts)
+        book_id = server.books.keys()[0]
+
+        timer = Timer()
+        with timer:
+            org = Organization.from_id(org_id)
+        results['from_id_cold'] = timer.result()
+        timer = Timer()
+        for _ in range(100):
+            with timer:
+                Organization.from_id(org_id)
+        results['from_id_cached'] = timer.result()
+
+        book = Book.from_id(book_id, org_id)
+        timer = Timer()
+        with timer:
+            accounts = list(Account.all(book, limit=100, prefetch=False))
+        results['all'] = timer.result(len(accounts))
+        reset_index()
+        book = Book.from_id(book_id, org_id)
+        timer = Timer()
+        with timer:
+            accounts = list(Account.all(book, limit=100))
+        results['all_prefetch'] = timer.result(len(accounts))
+
+        timer = Timer()
+        for i in range(min(n_accounts, 50)):
+            account = Account(book, 'Benchmark %s' % i)
+            with timer:
+                account.save()
+        results['save_create'] = timer.result()
+        timer = Timer()
+        for account in accounts[:50]:
+            account.description += ' updated'
+            with timer:
+                account.save()
+        results['save_update'] = timer.result()
+
+        at = datetime.datetime.utcnow()
+        timer = Timer()
+        for account in accounts[:50]:
+            with timer:
+                account.get_balance(at)
+        results['get_balance'] = timer.result()
+        timer = Timer()
+        with timer:
+            balances = book.get_balances([at], accounts=accounts,
+                                         max_workers=workers)
+        results['get_balances_bulk'] = timer.result(len(balances))
+
+        effective_at = at.strftime('%Y-%m-%dT%H:%M:%SZ')
+        # Consecutive entries touch different accounts, so the concurrent
+        # writer does not have to serialize them
+        entries = [JournalEntry(book, 'Entry %s' % i, effective_at,
+                                entry_lines(accounts[2 * i % len(accounts)],
+                                            accounts[(2 * i + 1) %
+                                                     len(accounts)]))
+                   for i in range(n_entries)]
+        half = n_entries // 2
+        timer = Timer()
+        with timer:
+            for entry in entries[:half]:
+                entry.save()
+        results['post_sequential'] = timer.result(half)
+        timer = Timer()
+        with timer:
+            posted = list(JournalEntry.save_many(entries[half:],
+                                                 max_workers=workers))
+        results['post_concurrent'] = timer.result(len(posted))
+
+        results['requests'] = server.requests
+        results['metrics'] = SubledgerBase.metrics()['totals']
+    finally:
+        server.stop()
+    return results
+
+
+def object_size(obj):
+    """Return the size in bytes of `obj` and the containers it holds """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += object_size(key) + object_size(value)
+    elif isinstance(obj, (list, tuple)):
+        size += sum(object_size(item) for item in obj)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+        size += object_size(obj.__dict__)
+    elif hasattr(obj, '__slots__'):
+        for name in type(obj).__slots__:
+            if hasattr(obj, name):
+                size += object_size(getattr(obj, name))
+    return size
+
+
+def memory():
+    """Return the size per instance of each model class in bytes
+
+    Shared values like ids and descriptions are left out, only the
+    instances themselves and their private containers are counted.
+    """
+    book_ref = Book(Organization('Org'), 'Book')
+    lines = [{'account': 'a', 'value': {'type': 'debit', 'amount': '1.00'}},
+             {'account': 'b', 'value': {'type': 'credit', 'amount': '1.00'}}]
+    entry = JournalEntry(book_ref, 'Entry', '2014-01-01T00:00:00Z', lines)
+    sizes = {'Organization': sys.getsizeof(Organization('Org')),
+             'Book': sys.getsizeof(book_ref),
+             'Account': sys.getsizeof(Account(book_ref, 'Account')),
+             'JournalEntry': sys.getsizeof(entry),
+             'JournalEntry.line_items': object_size(entry.line_items),
+             'Line': sys.getsizeof(Line('a', 'debit', '1.00')),
+             'lines as dicts': object_size(lines)}
+    return dict((name, {'bytes': size}) for name, size in sizes.items())
+
+
+def sample_instances():
+    """Return an unsaved instance of every model class by name """
+    org = Organization('Org')
+    org._id = 'org'
+    book = Book(org, 'Book')
+    book._id = 'book'
+    lines = [Line('a', 'debit', '1.00'), Line('b', 'credit', '1.00')]
+    return {'Organization': org,
+            'Book': book,
+            'Account': Account(book, 'Account'),
+            'JournalEntry': JournalEntry(book, 'Entry',
+                                         '2014-01-01T00:00:00Z', lines)}
+
+
+def serialization(repeat=2000, batch=1000):
+    """Time encoding payloads and decoding responses per serializer
+
+    Each model is encoded and decoded `repeat` times on its own, and once
+    as a list of `batch` payloads.
+    """
+    results = {}
+    for name in available_serializers():
+        serializer = get_serializer(name)
+        for model, instance in sorted(sample_instances().items()):
+            payload = instance._payload()
+            text = serializer.dumps(payload)
+            encode, decode = Timer(), Timer()
+            for _ in range(repeat):
+                with encode:
+                    serializer.dumps(payload)
+                with decode:
+                    serializer.loads(text)
+            results['%s_%s_encode' % (name, model)] = encode.result()
+            results['%s_%s_decode' % (name, model)] = decode.result()
+            payloads = [instance._payload() for _ in range(batch)]
+            encode, decode = Timer(), Timer()
+            with encode:
+                text = serializer.dumps(payloads)
+            with decode:
+                serializer.loads(text)
+            results['%s_%s_batch_encode' % (name, model)] = \
+                encode.result(batch)
+            results['%s_%s_batch_decode' % (name, model)] = \
+                decode.result(batch)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--latency', type=float, nargs='+', default=[0, 0.02],
+                        help='seconds added to every response')
+    parser.add_argument('--accounts', type=int, default=200)
+    parser.add_argument('--entries', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=10)
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    report = {'created_at': datetime.datetime.utcnow().isoformat(),
+              'python': platform.python_version(),
+              'accounts': args.accounts,
+              'entries': args.entries,
+              'workers': args.workers,
+              'memory': memory(),
+              'serialization': serialization(),
+              'runs': []}
+    for name, size in sorted(report['memory'].items()):
+        print '%-24s %6d bytes' % (name, size['bytes'])
+    for name, result in sorted(report['serialization'].items()):
+        print '%-40s %12.1f ops/s' % (name, result['ops_per_second'] or 0)
+    for latency in args.latency:
+        logging.info('Benchmark at %ss latency', latency)
+        results = run(latency, args.accounts, args.entries, args.workers)
+        report['runs'].append({'latency': latency, 'results': results})
+        for name, result in sorted(results.items()):
+            if isinstance(result, dict) and 'ops_per_second' in result:
+                print '%6.3fs %-20s %10.1f ops/s' % (
+                    latency, name, result['ops_per_second'] or 0)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print 'Results written to', args.output
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
@@ -0,0 +1,183 @@
+"""\
+Balances of many accounts at many points in time
+
+Account.get_balance needs one request per account and timestamp. These
+functions spread such requests over a WorkerPool, optionally limited to a
+number of requests per second, and request each (account, at) pair only once.
+
+A BalanceCache keeps the balances returned by Account.get_balance. Balances
+at a moment long enough ago no longer change and are kept for good, recent
+ones for a short while.
+"""
+import copy
+import datetime
+import threading
+import time
+
+from workers import WorkerPool, RateLimiter, SingleFlight, as_completed
+from workers import DEFAULT_MAX_WORKERS
+
+AT_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def iter_balances(accounts, at_datetimes, max_workers=None, rate=None,
+                  pool=None):
+    """Yield ((account, at_datetime), balance) as the balances come in
+
+    `at_datetimes` must be datetimes at UTC. Identical pairs, also pairs
+    that fall in the same second, are requested from Subledger only once.
+    `rate` limits the number of requests per second. Pass a WorkerPool as
+    `pool` to share workers, otherwise one with `max_workers` is used.
+    """
+    at_datetimes = list(at_datetimes)
+    # One request per account id and timestamp as sent to Subledger
+    pending = {}
+    for account in accounts:
+        for at in at_datetimes:
+            key = (account._id, at.strftime(AT_FORMAT))
+            if key not in pending:
+                pending[key] = (account, at, [])
+            targets = pending[key][2]
+            if (account, at) not in targets:
+                targets.append((account, at))
+
+    own_pool = pool is None
+    if own_pool:
+        pool = WorkerPool(max_workers or DEFAULT_MAX_WORKERS)
+    limiter = RateLimiter(rate) if rate else None
+
+    def fetch(account, at):
+        if limiter is not None:
+            limiter.acquire()
+        return account.get_balance(at)
+
+    futures = {}
+    finished = False
+    try:
+        for account, at, targets in pending.values():
+            futures[pool.submit(fetch, account, at)] = targets
+        for future in as_completed(futures.keys()):
+            balance = future.result()
+            for target in futures[future]:
+                yield target, balance
+        finished = True
+    finally:
+        if own_pool:
+            # Only wait for the workers when no request is left running
+            pool.shutdown(wait=finished)
+
+
+def get_balances(accounts, at_datetimes, **options):
+    """Return a dict of balances by (account, at_datetime)
+
+    Takes the same options as iter_balances.
+    """
+    return dict(iter_balances(accounts, at_datetimes, **options))
+
+
+class BalanceCache(object):
+    """Balances of accounts by (account id, at)
+
+    A balance at a moment more than `horizon`, a timedelta, ago is settled:
+    it is cached until invalidated. Other balances are cached for `ttl`
+    seconds. Attached, a journal entry saved from this process invalidates
+    the cached balances of its accounts at or after its effective date.
+    Entries posted elsewhere are only seen once a cached balance expires, so
+    choose a horizon after which no entries are backdated.
+    """
+
+    def __init__(self, horizon=datetime.timedelta(days=1), ttl=60):
+        self.horizon = horizon
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # account id -> {at string: (balance, expires at or None)}
+        self._balances = {}
+        # Invalidations per account id, a load that saw one is not cached
+        self._generations = {}
+        self._loads = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def attach(self):
+        """Invalidate balances for every journal entry saved from now on """
+        from models import JournalEntry
+        JournalEntry.add_post_hook(self.invalidate_entry)
+
+    def detach(self):
+        from models import JournalEntry
+        JournalEntry.remove_post_hook(self.invalidate_entry)
+
+    def get(self, account_id, at_datetime, load):
+        """Return the balance of `account_id` at `at_datetime`, a datetime at
+        UTC, calling load() for it when it is not cached
+
+        Concurrent misses for the same balance share one load.
+        """
+        at = at_datetime.strftime(AT_FORMAT)
+        with self._lock:
+            cached = self._balances.get(account_id, {}).get(at)
+            if cached is not None:
+                balance, expires_at = cached
+                if expires_at is None or expires_at > time.time():
+                    self.hits += 1
+                    return copy.deepcopy(balance)
+                del self._balances[account_id][at]
+                self.expirations += 1
+            self.misses += 1
+        balance = self._loads.do((account_id, at), self._load, account_id,
+                                 at_datetime, at, load)
+        return copy.deepcopy(balance)
+
+    def _load(self, account_id, at_datetime, at, load):
+        settled = datetime.datetime.utcnow() - self.horizon
+        expires_at = None if at_datetime <= settled else time.time() + self.ttl
+        generation = self._generations.get(account_id, 0)
+        balance = load()
+        with self._lock:
+            if self._generations.get(account_id, 0) == generation:
+                self._balances.setdefault(account_id, {})[at] = \
+                    (balance, expires_at)
+        return balance
+
+    def invalidate(self, account_id, effective_at=None):
+        """Forget the balances of `account_id` at or after `effective_at`, a
+        Subledger timestamp, or all of them
+        """
+        with self._lock:
+            self._generations[account_id] = \
+                self._generations.get(account_id, 0) + 1
+            balances = self._balances.get(account_id)
+            if not balances:
+                return
+            if effective_at is None:
+                stale = list(balances)
+            else:
+                # Timestamps to the second compare as strings
+                start = effective_at[:19]
+                stale = [at for at in balances if at[:19] >= start]
+            for at in stale:
+                del balances[at]
+            self.invalidations += len(stale)
+
+    def invalidate_entry(self, entry):
+        """Forget the balances changed by the JournalEntry `entry` """
+        for account_id in set(line.account for line in entry.line_items):
+            self.invalidate(account_id, entry.effective_at)
+
+    def clear(self):
+        with self._lock:
+            self._balances = {}
+
+    def stats(self):
+        """Return lookup counters and the number of cached balances """
+        with self._lock:
+            size = sum(len(b) for b in self._balances.values())
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'size': size}
@@ -3,10 +3,24 @@ Under the hood base classes and functionality
 
 TODO: use logging module and log http request under debug level
 """
+import contextlib
 import logging
-import json
+import random
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from identity import StripedIdentityMap
+from metrics import Metrics
+from serializers import get_serializer
+from workers import WorkerPool, RateLimiter, context
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_TIMEOUT = 60
 
 
 class Dummy:
@@ -22,13 +36,28 @@ def memoize(func):
     """
 
     def memoizer(cls, id_, *args, **kwargs):
-        if id_ in cls._instance_index:
-            if cls is not type(cls._instance_index[id_]):
+        index = cls._instance_index
+        instance = index.get(id_)
+        if instance is not None:
+            if cls is not type(instance):
                 raise TypeError('Instance with ID does not match class')
-            return cls._instance_index[id_]
-        else:
+            instance._revalidate()
+            return instance
+
+        def load():
+            instance = cls._from_disk_cache(id_)
+            if instance is not None:
+                instance._revalidate()
+                return instance
             instance = func(cls, id_, *args, **kwargs)
-            cls._instance_index[id_] = instance
+            # Another thread may have loaded the same id meanwhile
+            return index.setdefault(id_, instance)
+
+        # Concurrent calls for the same id share one request
+        load_once = getattr(index, 'load_once', None)
+        instance = load_once(id_, load) if load_once else load()
+        if cls is not type(instance):
+            raise TypeError('Instance with ID does not match class')
         return instance
 
     return memoizer
@@ -42,28 +71,145 @@ def memoize_from_dict(func):
 
     def memoizer(cls, dictionary):
         id_ = dictionary['id']
-        if id_ in cls._instance_index:
+        instance = cls._instance_index.get(id_)
+        if instance is not None:
             # Ignore other values in dictionary when 'id' is present
-            if cls is not type(cls._instance_index[id_]):
+            if cls is not type(instance):
                 raise TypeError('Instance with ID does not match class')
-            return cls._instance_index[id_]
+            return instance
         else:
             instance = func(cls, dictionary)
-            cls._instance_index[id_] = instance
+            instance._fetched_at = time.time()
+            instance._mark_clean()
+            instance = cls._instance_index.setdefault(id_, instance)
+            if cls._disk_cache is not None:
+                cls._disk_cache.put(instance)
         return instance
 
     return memoizer
 
 
+class RetryPolicy(object):
+    """When and how long to wait before a failed request is sent again
+
+    Requests are retried at most `max_retries` times on a connection error
+    or one of `statuses`, waiting `backoff` * 2 ** attempt seconds up to
+    `max_backoff`. With `jitter` a random part of that wait is used, so
+    concurrent clients do not retry in lockstep. A Retry-After header sent
+    by Subledger takes precedence, also capped at `max_backoff`.
+
+    GET and PATCH are safe to repeat: a repeated PATCH carries the same
+    version and cannot be applied twice. POST creates resources, like
+    create_and_post, so it is only repeated when Subledger throttled it
+    (status 429), except for archive and activate.
+    """
+    idempotent_methods = ('GET', 'PATCH')
+    idempotent_post_suffixes = ('/archive', '/activate')
+
+    def __init__(self, max_retries=3, backoff=0.5, max_backoff=30,
+                 jitter=True, statuses=(429, 500, 502, 503, 504)):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = statuses
+
+    def is_idempotent(self, method, path):
+        if method in self.idempotent_methods:
+            return True
+        return path.endswith(self.idempotent_post_suffixes)
+
+    def should_retry(self, method, path, attempt, status=None):
+        """Return True if a request that failed with `status` may be retried
+
+        `status` is None for connection errors.
+        """
+        if attempt >= self.max_retries:
+            return False
+        if status is not None and status not in self.statuses:
+            return False
+        return status == 429 or self.is_idempotent(method, path)
+
+    def delay(self, attempt, retry_after=None):
+        """Return the number of seconds to wait before the next attempt """
+        if retry_after is not None:
+            # A bad header should not block a worker indefinitely
+            return min(retry_after, self.max_backoff)
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+
+def parse_retry_after(value):
+    """Return the seconds to wait from a Retry-After header, or None """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(mktime_tz(date) - time.time(), 0)
+
+
 class Access(object):
     """Client access to your Subledger account
+
+    All requests go through one `requests.Session`, so connections to the
+    Subledger API are pooled and kept alive between calls. Tune the pool with
+    the keyword arguments or inject a preconfigured session.
     """
 
-    def __init__(self, key_id, secret):
-        """ """
+    def __init__(self, key_id, secret, session=None,
+                 pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE, pool_block=False,
+                 keep_alive=True, timeout=DEFAULT_TIMEOUT, retry=None,
+                 rate_limit=None, burst=1, metrics=None, serializer=None):
+        """Set up credentials and the connection pool
+
+        `pool_connections` is the number of hosts to keep a pool for,
+        `pool_maxsize` the maximum number of connections kept per host.
+        With `pool_block` requests wait for a free connection instead of
+        opening an extra one. `timeout` in seconds is passed to every request.
+
+        `retry` is a RetryPolicy, by default up to 3 retries. `rate_limit`
+        caps the number of requests per second sent by this client, allowing
+        `burst` requests at once. Requests are recorded in `metrics`, a new
+        metrics.Metrics by default.
+
+        Payloads are encoded and responses decoded with `serializer`, by
+        default the fastest one in serializers that is installed.
+        """
         self._key_id = key_id
         self._secret = secret
         self.api_url = "https://api.subledger.com/v1"
+        self.timeout = timeout
+        if retry is None:
+            retry = RetryPolicy()
+        self.retry = retry
+        self.rate_limiter = None
+        if rate_limit:
+            self.rate_limiter = RateLimiter(rate_limit, burst)
+        self.retries = 0
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        if serializer is None:
+            serializer = get_serializer()
+        self.serializer = serializer
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                pool_block=pool_block)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        self.session = session
 
     def create_new_identity(self, email, description, reference=None):
         logging.debug('Access.create_identity')
@@ -80,38 +226,299 @@ class Access(object):
 
 
     def get_json(self, path, data=None):
-        return self._json_request(requests.get, path, params=data)
+        return self._json_request('GET', path, params=data)
 
     def post_json(self, path, data):
-        logging.debug('POST: %s' % (data,))
-        json_data = json.dumps(data)
-        return self._json_request(requests.post, path, data=json_data)
+        logging.debug('POST: %s', data)
+        json_data = self.serializer.dumps(data)
+        return self._json_request('POST', path, data=json_data)
 
     def patch_json(self, path, data):
-        logging.debug('PATCH: %s' % (data,))
-        json_data = json.dumps(data)
-        return self._json_request(requests.patch, path, data=json_data)
+        logging.debug('PATCH: %s', data)
+        json_data = self.serializer.dumps(data)
+        return self._json_request('PATCH', path, data=json_data)
+
+    def _json_request(self, method, path, **kwargs):
+        """Send the request, retrying as allowed by the RetryPolicy
 
-    def _json_request(self, req_func, path, **kwargs):
-        """ """
+        Raises ValueError(status_code, text) when Subledger keeps refusing.
+        """
         url = self.api_url + path
         auth = (self._key_id, self._secret)
-        logging.info("%s (API_KEY: %s)" % (url, self._key_id))
-        r = req_func(url, auth=auth, **kwargs)
-        # TODO: Error handling
-        if r.status_code in (200, 201, 202):
-            return r.json()
+        logging.info("%s (API_KEY: %s)", url, self._key_id)
+        bytes_sent = len(kwargs.get('data') or '')
+        attempt = 0
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            start = time.time()
+            try:
+                r = self.session.request(
+                    method, url, auth=auth, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.metrics.record(method, path, None, time.time() - start,
+                                    bytes_sent, 0, attempt)
+                if not self.retry.should_retry(method, path, attempt):
+                    raise
+                delay = self.retry.delay(attempt)
+            else:
+                self.metrics.record(method, path, r.status_code,
+                                    time.time() - start, bytes_sent,
+                                    len(r.content), attempt)
+                if r.status_code in (200, 201, 202):
+                    return self.serializer.loads(r.content)
+                if not self.retry.should_retry(
+                        method, path, attempt, r.status_code):
+                    raise ValueError(r.status_code, r.text)
+                retry_after = parse_retry_after(r.headers.get('Retry-After'))
+                delay = self.retry.delay(attempt, retry_after)
+            attempt += 1
+            self.retries += 1
+            logging.info("Retry %s of %s in %.2fs", attempt, url, delay)
+            time.sleep(delay)
+
+    def connection_stats(self):
+        """Return connection reuse counters of the pooled connections
+
+        `requests` is the number of HTTP requests sent, `connections` the
+        number of connections opened for them. Every request above that
+        reused a kept-alive connection.
+        """
+        stats = {'requests': 0, 'connections': 0}
+        # The same adapter is usually mounted for both http and https
+        adapters = dict((id(a), a) for a in self.session.adapters.values())
+        for adapter in adapters.values():
+            poolmanager = getattr(adapter, 'poolmanager', None)
+            if poolmanager is None:
+                continue
+            pools = poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats['requests'] += pool.num_requests
+                stats['connections'] += pool.num_connections
+        stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+        if stats['requests']:
+            stats['hit_rate'] = float(stats['reused']) / stats['requests']
         else:
-            raise ValueError(r.status_code, r.text)
+            stats['hit_rate'] = 0.0
+        return stats
+
+    def close(self):
+        """Close all pooled connections """
+        self.session.close()
+
+
+class AsyncAccess(object):
+    """Concurrent counterpart of Access
+
+    Requests are sent from a WorkerPool, each call returns a Future.
+    """
+
+    def __init__(self, access, max_workers=None, pool=None):
+        self.access = access
+        if pool is None:
+            pool = WorkerPool(max_workers or access_pool_size(access))
+        self.pool = pool
+
+    def get_json(self, path, data=None):
+        return self.pool.submit(self.access.get_json, path, data)
+
+    def post_json(self, path, data):
+        return self.pool.submit(self.access.post_json, path, data)
+
+    def patch_json(self, path, data):
+        return self.pool.submit(self.access.patch_json, path, data)
+
+
+def access_pool_size(access):
+    """Return the number of connections Access keeps per host """
+    adapter = access.session.get_adapter(access.api_url)
+    return getattr(adapter, '_pool_maxsize', DEFAULT_POOL_MAXSIZE)
+
+
+def _slot_names(cls):
+    """Return the names of all slots of `cls` and its base classes """
+    names = []
+    for klass in reversed(cls.__mro__):
+        for name in klass.__dict__.get('__slots__', ()):
+            if name != '__weakref__' and name not in names:
+                names.append(name)
+    return tuple(names)
+
+
+class _Bound(object):
+    """A value of the client an instance or thread is bound to
+
+    Used for SubledgerBase._api, _instance_index and _disk_cache. On an
+    instance loaded by a client.Client it is the value of that client,
+    otherwise of the client active in the current thread. Without a client
+    it is the value set with scoped_access, `name` 'access', or else the
+    default set by authenticate, set_access, set_identity_map and
+    set_disk_cache.
+    """
+
+    def __init__(self, name, default=None):
+        self.name = name
+        self.default = default
+
+    def __get__(self, instance, owner):
+        client = getattr(instance, '_client', None)
+        if client is None:
+            client = context.values.get('client')
+        if client is not None:
+            return getattr(client, self.name)
+        value = context.values.get(self.name)
+        if value is None:
+            return self.default
+        return value
+
+
+def current_client(instance=None):
+    """Return the client `instance` is bound to, or else the active client
+    of this thread, or None
+    """
+    client = getattr(instance, '_client', None)
+    if client is None:
+        client = context.values.get('client')
+    return client
+
+
+@contextlib.contextmanager
+def using(client):
+    """Make `client` the active client of this thread within the block
+
+    Nothing changes when `client` is None.
+    """
+    if client is None:
+        yield None
+        return
+    previous = context.values.get('client')
+    context.values['client'] = client
+    try:
+        yield client
+    finally:
+        if previous is None:
+            context.values.pop('client', None)
+        else:
+            context.values['client'] = previous
+
+
+@contextlib.contextmanager
+def scoped_access(access):
+    """Send the requests of this thread with `access` within the block
+
+    Calls the thread submits to a WorkerPool meanwhile, like the *_async
+    methods, use it as well.
+
+        with scoped_access(Access(key_id, secret)):
+            org = Organization.from_id(org_id)
+    """
+    previous = context.values.get('access')
+    context.values['access'] = access
+    try:
+        yield access
+    finally:
+        if previous is None:
+            context.values.pop('access', None)
+        else:
+            context.values['access'] = previous
+
+
+class Lazy(object):
+    """Stand-in for an instance of `cls` that is loaded on first use
+
+    `args` are the arguments of cls.from_id, the id first. The instance is
+    loaded on the first access of one of its attributes, in the client the
+    stand-in was created in. repr never loads it: it shows the instance
+    when it is loaded or indexed already, and only the id otherwise.
+    """
+    __slots__ = ('_cls', '_args', '_client', '_instance')
+
+    def __init__(self, cls, *args):
+        object.__setattr__(self, '_cls', cls)
+        object.__setattr__(self, '_args', args)
+        object.__setattr__(self, '_client', current_client())
+        object.__setattr__(self, '_instance', None)
+
+    @property
+    def _id(self):
+        return self._args[0]
+
+    def resolve(self):
+        """Return the instance, loaded with from_id when needed """
+        if self._instance is None:
+            with using(self._client):
+                instance = self._cls.from_id(*self._args)
+            object.__setattr__(self, '_instance', instance)
+        return self._instance
+
+    def loaded(self):
+        """Return the instance if it is loaded or indexed, else None """
+        if self._instance is None:
+            with using(self._client):
+                index = self._cls._instance_index
+                if self._id in index:
+                    object.__setattr__(self, '_instance', index.get(self._id))
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.resolve(), name, value)
+
+    def __repr__(self):
+        instance = self.loaded()
+        if instance is None:
+            return '<%s %s>' % (self._cls.__name__, self._id)
+        return repr(instance)
+
+
+class _Fields(object):
+    """Read-only mapping of the fields of an instance, to format paths """
+    __slots__ = ('_instance', '_overrides')
+
+    def __init__(self, instance, **overrides):
+        self._instance = instance
+        self._overrides = overrides
+
+    def __getitem__(self, name):
+        if name in self._overrides:
+            return self._overrides[name]
+        try:
+            return getattr(self._instance, name)
+        except AttributeError:
+            raise KeyError(name)
 
 
 class SubledgerBase(object):
     """Base class for shared functionality of Subledger classes
+
+    Instances keep their values in slots instead of a __dict__, subclasses
+    declare their own fields in __slots__.
     """
-    _api = None
+    __slots__ = ('description', 'reference', '_id', '_version', '_type',
+                 '_fetched_at', '_refreshing', '_clean', '_parent', '_client',
+                 '__weakref__')
+    # Both depend on the client the instance or thread is bound to
+    _api = _Bound('access')
     _path = ''
+    # Path to read an instance, when it differs from _path
+    _get_path = None
+    # Seconds before a cached instance is revalidated by from_id, see
+    # set_max_age
+    _max_age = None
+    _refresh_ahead = None
+    # Guards _refreshing, so an instance is refreshed by one worker at once
+    _refresh_lock = threading.Lock()
+    # Optional store.DiskCache, see set_disk_cache. A client has its own,
+    # instances of one identity are never served to another.
+    _disk_cache = _Bound('disk_cache')
     # Object ID's are globally unique, so we can index these
-    _instance_index = {}
+    _instance_index = _Bound('identity_map', StripedIdentityMap())
+    # Runs the *_async methods, created on first use
+    _workers = None
+    _workers_lock = threading.Lock()
 
     def __init__(self, description, reference=None):
         # Attributes available on all 
@@ -121,11 +528,138 @@ class SubledgerBase(object):
         self._id = None
         self._version = None
         self._type = 'active'
+        # Time the values were last read from or written to Subledger
+        self._fetched_at = None
+        self._refreshing = False
+        # Payload as last read from or written to Subledger, see is_dirty
+        self._clean = None
+        # Unsaved parent instance, its id is taken on save
+        self._parent = None
+        # The client.Client this instance was created by, if any
+        self._client = context.values.get('client')
+
+    @classmethod
+    def authenticate(cls, key_id, secret, **options):
+        """Register API credentials for all Subledger classes
+
+        `options` are passed to Access to tune its connection pool.
+        """
+        SubledgerBase.set_access(Access(key_id, secret, **options))
 
     @classmethod
-    def authenticate(cls, key_id, secret):
-        # TODO: refactor
-        SubledgerBase._api = Access(key_id, secret)
+    def set_access(cls, access):
+        """Use the given Access instance for all Subledger classes
+
+        Threads within scoped_access and instances of a client.Client use
+        their own Access instead.
+        """
+        SubledgerBase.__dict__['_api'].default = access
+
+    @classmethod
+    def metrics(cls):
+        """Return a snapshot of the request metrics and instance index
+
+        Those of the active client.Client, if any.
+        """
+        return cls._api.metrics.snapshot(identity_map=cls._instance_index)
+
+    @classmethod
+    def set_identity_map(cls, identity_map):
+        """Index instances of all classes in `identity_map`
+
+        Pass an IdentityMap or StripedIdentityMap to tune its limits, or any
+        dict-like object with get, setdefault and item assignment. Instances indexed so far
+        are not carried over. Instances of a client.Client are indexed in
+        the identity map of the client.
+        """
+        SubledgerBase.__dict__['_instance_index'].default = identity_map
+
+    @classmethod
+    def set_disk_cache(cls, disk_cache, hydrate=True):
+        """Keep loaded instances of all classes in `disk_cache`
+
+        from_id reads instances from the disk cache before it contacts
+        Subledger. With `hydrate` all cached instances are indexed right
+        away. Pass None to stop using a disk cache. Instances of a
+        client.Client use the disk cache of the client, if any.
+        """
+        SubledgerBase.__dict__['_disk_cache'].default = disk_cache
+        if disk_cache is not None and hydrate:
+            disk_cache.hydrate()
+
+    @classmethod
+    def _from_disk_cache(cls, id_):
+        """Return the instance with id_ from the disk cache, or None """
+        if cls._disk_cache is None:
+            return None
+        cached = cls._disk_cache.get(id_, cls.__name__)
+        if cached is None:
+            return None
+        data, stored_at = cached
+        instance = cls._from_dict(data)
+        instance._fetched_at = stored_at
+        return instance
+
+    @classmethod
+    def set_max_age(cls, max_age, refresh_ahead=None):
+        """Revalidate cached instances older than `max_age` seconds
+
+        Applies to the class it is called on and its subclasses, call it on
+        SubledgerBase for all classes. from_id returns a cached instance
+        when it is fresh and reloads it in place when it is older. Cached
+        instances older than `refresh_ahead` seconds, but still fresh, are
+        returned immediately and reloaded in the background. Pass None to
+        cache forever.
+        """
+        cls._max_age = max_age
+        cls._refresh_ahead = refresh_ahead
+
+    @classmethod
+    def set_concurrency(cls, max_workers):
+        """Run the *_async methods of all classes in `max_workers` threads
+
+        Keep it at or below the connection pool size of Access; more workers
+        only wait for a free connection. The calls submitted to the previous
+        workers still run, then their threads stop.
+        """
+        with SubledgerBase._workers_lock:
+            previous = SubledgerBase._workers
+            SubledgerBase._workers = WorkerPool(max_workers)
+        if previous is not None:
+            previous.shutdown(wait=False)
+
+    @classmethod
+    def _worker_pool(cls):
+        with SubledgerBase._workers_lock:
+            if SubledgerBase._workers is None:
+                SubledgerBase._workers = WorkerPool()
+            return SubledgerBase._workers
+
+    @classmethod
+    def from_id_async(cls, *args):
+        """Return a Future for from_id(*args)
+
+        The result comes from the same instance index as from_id.
+        """
+        return cls._worker_pool().submit(cls.from_id, *args)
+
+    @classmethod
+    def all_async(cls, *args, **kwargs):
+        """Return a Future for the list of instances all() yields """
+        return cls._worker_pool().submit(
+            lambda: list(cls.all(*args, **kwargs)))
+
+    def save_async(self):
+        """Return a Future for save() """
+        return self._worker_pool().submit(self.save)
+
+    def archive_async(self):
+        """Return a Future for archive() """
+        return self._worker_pool().submit(self.archive)
+
+    def activate_async(self):
+        """Return a Future for activate() """
+        return self._worker_pool().submit(self.activate)
 
     def archive(self):
         """Archive this instance in Subledger. 
@@ -133,11 +667,13 @@ class SubledgerBase(object):
         Can be called on any instance of Organization, Book,
         Account, JournalEntry, Line, Category, Report
         """
-        path = self._path % self.__dict__
+        path = self._path % _Fields(self)
         path += "/archive"
         result = self._api.post_json(path, {})
         # Remember the type for its state
         self._set_type(result.keys()[0])
+        if self._disk_cache is not None:
+            self._disk_cache.put(self)
 
     def activate(self):
         """Activate this instance in Subledger. 
@@ -145,33 +681,118 @@ class SubledgerBase(object):
         Can be called on any instance of Organization, Book,
         Account, JournalEntry, Line, Category, Report
         """
-        path = self._path % self.__dict__
+        path = self._path % _Fields(self)
         path += "/activate"
         result = self._api.post_json(path, {})
         # Remember the type for its state
         self._set_type(result.keys()[0])
+        if self._disk_cache is not None:
+            self._disk_cache.put(self)
+
+    def refresh(self):
+        """Reload the values of this instance from Subledger
+
+        When Subledger has the same version, only the freshness of the
+        instance is renewed. Otherwise the values are replaced, also any
+        unsaved changes. Returns True when the values changed.
+        """
+        path = (self._get_path or self._path) % _Fields(self)
+        result = self._api.get_json(path)
+        type_ = result.keys()[0]
+        data = result[type_]
+        self._fetched_at = time.time()
+        if data['version'] == self._version and type_ == self._type:
+            return False
+        for k in self._payload():
+            if k in data:
+                setattr(self, k, data[k])
+        self._version = data['version']
+        self._set_type(type_)
+        self._mark_clean()
+        if self._disk_cache is not None:
+            self._disk_cache.put(self)
+        return True
+
+    def invalidate(self):
+        """Mark this instance stale, from_id will reload it """
+        self._fetched_at = None
+
+    @property
+    def age(self):
+        """Seconds since the values were read from Subledger, None if unknown
+        """
+        if self._fetched_at is None:
+            return None
+        return time.time() - self._fetched_at
+
+    def _revalidate(self):
+        """Refresh this cached instance when it is no longer fresh """
+        age = self.age
+        if age is None:
+            if self._id is not None:
+                self.refresh()
+        elif self._max_age is not None and age > self._max_age:
+            self.refresh()
+        elif self._refresh_ahead is not None and age > self._refresh_ahead:
+            with self._refresh_lock:
+                scheduled = self._refreshing
+                self._refreshing = True
+            if not scheduled:
+                self._worker_pool().submit(self._refresh_in_background)
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            logging.exception('Background refresh of %s failed', self._id)
+        finally:
+            self._refreshing = False
 
     @property
     def is_active(self):
         # TODO: Think about behavior with unsaved objects: True, False or None
         return self._type.startswith('active')
 
+    @property
+    def is_dirty(self):
+        """True when this instance has values not saved to Subledger """
+        return self._id is None or bool(self._changes())
+
+    def _changes(self):
+        """Return the public fields that differ from the saved values """
+        payload = self._payload()
+        if self._clean is None:
+            return payload
+        return dict((k, v) for k, v in payload.items()
+                    if k not in self._clean or self._clean[k] != v)
+
+    def _mark_clean(self):
+        self._clean = self._payload()
+
+    def _set_parent(self, parent):
+        """Take the ids of the instance this one belongs to """
+        pass
+
     def save(self):
         """Write data to Subledger 
         
         POST on new instance
-        UPDATE when info has changed
+        PATCH with the changed fields when info has changed, nothing is sent
+        when it has not
         """
+        if self._parent is not None:
+            self._set_parent(self._parent)
+        payload = self._payload()
+        old_id = self._id
+        if self._id:
+            data = self._changes()
+            if not data:
+                return False
+        else:
+            data = payload
         # Build path
-        data = self.__dict__.copy()
-        data['_id'] = self._id or ''
-        path = self._path % data
+        path = self._path % _Fields(self, _id=self._id or '')
         path = path.rstrip('/')  # a trailing slash led to UNAUTHORIZED errors
-        # Pop private keys
-        for k in data.keys():
-            if k.startswith('_'):
-                del data[k]
-        old_id = self._id
         if self._id:
             data['version'] = self._version + 1
             # Update existing
@@ -185,11 +806,64 @@ class SubledgerBase(object):
         # Store metadata on self
         self._id = result[type_]['id']
         self._version = result[type_]['version']
+        self._fetched_at = time.time()
+        self._clean = payload
         # Index object for fast retrieval (and guarantee single occurance)
-        SubledgerBase._instance_index[self._id] = self
+        self._instance_index[self._id] = self
+        if self._disk_cache is not None:
+            self._disk_cache.put(self)
         # Return True if it was created, False on update
         return self._id != old_id
 
+    def _as_dict(self):
+        """Return the Subledger representation of this instance
+
+        The result can be passed to _from_dict.
+        """
+        values = self._values()
+        data = dict((k, v) for k, v in values.items()
+                    if not k.startswith('_'))
+        data['id'] = self._id
+        data['version'] = self._version
+        data['type'] = self._type
+        if '_org_id' in values:
+            data['org'] = self._org_id
+        if '_book_id' in values:
+            data['book'] = self._book_id
+        return data
+
+    @classmethod
+    def _payload_fields(cls):
+        """Return the names of the public fields, written to Subledger """
+        names = cls.__dict__.get('_public_names')
+        if names is None:
+            names = tuple(name for name in _slot_names(cls)
+                          if not name.startswith('_'))
+            # Cache per class, not inherited by subclasses
+            cls._public_names = names
+        return names
+
+    def _payload(self):
+        """Return the values to send to Subledger on save """
+        return dict((name, getattr(self, name))
+                    for name in self._payload_fields())
+
+    def _values(self):
+        """Return a dict of the fields of this instance, like a __dict__ """
+        cls = type(self)
+        names = cls.__dict__.get('_field_names')
+        if names is None:
+            names = _slot_names(cls)
+            # Cache per class, not inherited by subclasses
+            cls._field_names = names
+        values = {}
+        for name in names:
+            try:
+                values[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        return values
+
     def _set_type(self, type_):
         if type_ in self._types:
             self._type = type_
@@ -211,4 +885,4 @@ class SubledgerBase(object):
         raise NotImplementedError('Each class should implement from_dict')
 
     def __unicode__(self):
-        return unicode(self.__dict__)
\ No newline at end of file
+        return unicode(self._values())
\ No newline at end of file
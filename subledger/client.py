@@ -0,0 +1,75 @@
+"""\
+Clients for serving many Subledger identities from one process
+
+SubledgerBase.authenticate sets one Access for all classes. A Client holds
+its own Access, with its own connection pool, and its own identity map.
+Instances created or loaded while a client is active are bound to it: they
+keep using its Access and identity map, also outside the with block. Clients
+are independent of each other and can be used from many threads at once.
+
+    acme = Client(acme_key_id, acme_secret)
+    initech = Client(initech_key_id, initech_secret)
+    with acme:
+        org = Organization.from_id(acme_org_id)
+    for book in Book.all(org):   # as acme
+        ...
+"""
+import threading
+
+from base import Access, using
+from identity import StripedIdentityMap
+
+
+class Client(object):
+    """Access to Subledger as one identity, with its own instance index
+
+    Pass `key_id` and `secret` with `options` for Access, or an `access`.
+    Instances are indexed in `identity_map`, a new StripedIdentityMap by
+    default. Pass a store.DiskCache as `disk_cache` to keep them between
+    runs, see SubledgerBase.set_disk_cache; the disk cache set there is not
+    used by clients.
+    """
+
+    def __init__(self, key_id=None, secret=None, access=None,
+                 identity_map=None, disk_cache=None, hydrate=True,
+                 **options):
+        if access is None:
+            access = Access(key_id, secret, **options)
+        self.access = access
+        if identity_map is None:
+            identity_map = StripedIdentityMap()
+        self.identity_map = identity_map
+        self.disk_cache = disk_cache
+        # Active with blocks per thread
+        self._scopes = threading.local()
+        if disk_cache is not None and hydrate:
+            with using(self):
+                disk_cache.hydrate()
+
+    def activate(self):
+        """Return a context manager making this the active client of the
+        current thread
+        """
+        return using(self)
+
+    def __enter__(self):
+        scope = self.activate()
+        stack = getattr(self._scopes, 'stack', None)
+        if stack is None:
+            stack = self._scopes.stack = []
+        stack.append(scope)
+        return scope.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self._scopes.stack.pop().__exit__(*exc_info)
+
+    def metrics(self):
+        """Return a snapshot of the request metrics and instance index """
+        return self.access.metrics.snapshot(identity_map=self.identity_map)
+
+    def close(self):
+        """Close the pooled connections of this client """
+        self.access.close()
+
+    def __repr__(self):
+        return 'Client(%s)' % self.access._key_id
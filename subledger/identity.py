@@ -0,0 +1,264 @@
+"""\
+Identity map for Subledger instances
+
+Object ID's are globally unique, so every loaded instance is indexed by its
+id. The IdentityMap keeps weak references to all indexed instances, so an id
+maps to one live object for as long as that object is referenced anywhere.
+On top of that it holds strong references to the most recently used
+instances, to serve repeated lookups without requests to Subledger. These
+strong references are bounded by size, per type and by age.
+
+A StripedIdentityMap spreads the ids over several IdentityMaps, each with its
+own lock, so threads indexing different ids rarely wait for each other.
+"""
+import itertools
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from workers import SingleFlight
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_STRIPES = 16
+
+
+class IdentityMap(object):
+    """Mapping of id to instance with LRU eviction
+
+    `max_size` bounds the number of instances kept alive by the map, None
+    means unbounded. `ttl` evicts instances that were not looked up for that
+    many seconds. `type_limits` bounds the number of instances per class,
+    by class or class name, e.g. {'JournalEntry': 1000}. With `weak` the map
+    keeps no instance alive by itself.
+
+    Evicted instances that are still referenced elsewhere are found again
+    by their id.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=None, type_limits=None,
+                 weak=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.type_limits = {}
+        for type_, limit in (type_limits or {}).items():
+            self.type_limits[getattr(type_, '__name__', type_)] = limit
+        self.weak = weak
+        self._lock = threading.RLock()
+        # All live instances
+        self._live = weakref.WeakValueDictionary()
+        # Strong references in LRU order: id -> (instance, last used)
+        self._recent = OrderedDict()
+        # Ids of strong references per type name, in LRU order
+        self._recent_by_type = {}
+        # Loads in progress, see load_once
+        self._loads = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, id_, default=None):
+        """Return the instance with the given id, counts as a lookup """
+        with self._lock:
+            instance = self._live.get(id_)
+            if instance is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._touch(id_, instance)
+            return instance
+
+    def __getitem__(self, id_):
+        instance = self.get(id_)
+        if instance is None:
+            raise KeyError(id_)
+        return instance
+
+    def __contains__(self, id_):
+        with self._lock:
+            return id_ in self._live
+
+    def __setitem__(self, id_, instance):
+        with self._lock:
+            self._live[id_] = instance
+            self._touch(id_, instance)
+
+    def setdefault(self, id_, instance):
+        """Index `instance` unless another instance has the id already
+
+        Returns the indexed instance.
+        """
+        with self._lock:
+            existing = self._live.get(id_)
+            if existing is not None:
+                self._touch(id_, existing)
+                return existing
+            self[id_] = instance
+            return instance
+
+    def load_once(self, id_, load):
+        """Return load(), concurrent calls for the same id share one call
+
+        `load` should index the instance it returns.
+        """
+        return self._loads.do(id_, load)
+
+    def __delitem__(self, id_):
+        with self._lock:
+            del self._live[id_]
+            self._forget(id_)
+
+    def pop(self, id_, default=None):
+        with self._lock:
+            instance = self._live.pop(id_, default)
+            self._forget(id_)
+            return instance
+
+    def __len__(self):
+        return len(self._live)
+
+    def __iter__(self):
+        return iter(self._live.keys())
+
+    def keys(self):
+        return self._live.keys()
+
+    def values(self):
+        return self._live.values()
+
+    def items(self):
+        return self._live.items()
+
+    def clear(self):
+        with self._lock:
+            self._live.clear()
+            self._recent.clear()
+            self._recent_by_type.clear()
+
+    def stats(self):
+        """Return lookup and eviction counters """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'size': len(self._recent),
+                'live': len(self._live)}
+
+    def _touch(self, id_, instance):
+        """Mark `instance` as most recently used """
+        if self.weak:
+            return
+        now = time.time()
+        type_name = type(instance).__name__
+        self._forget(id_)
+        self._recent[id_] = (instance, now)
+        by_type = self._recent_by_type.setdefault(type_name, OrderedDict())
+        by_type[id_] = None
+        # Enforce the limits, least recently used first
+        limit = self.type_limits.get(type_name)
+        while limit is not None and len(by_type) > limit:
+            self._evict(next(iter(by_type)))
+        while self.max_size is not None and len(self._recent) > self.max_size:
+            self._evict(next(iter(self._recent)))
+        while self.ttl is not None and self._recent:
+            old_id = next(iter(self._recent))
+            if now - self._recent[old_id][1] <= self.ttl:
+                break
+            self._forget(old_id)
+            self.expirations += 1
+
+    def _evict(self, id_):
+        self._forget(id_)
+        self.evictions += 1
+
+    def _forget(self, id_):
+        """Drop the strong reference to id_ if there is one """
+        entry = self._recent.pop(id_, None)
+        if entry is not None:
+            by_type = self._recent_by_type[type(entry[0]).__name__]
+            del by_type[id_]
+
+
+class StripedIdentityMap(object):
+    """IdentityMap split in `stripes` by id, each with its own lock
+
+    `max_size` and `type_limits` are divided over the stripes, so they are
+    enforced per stripe rather than exactly. The other arguments are those
+    of IdentityMap.
+    """
+
+    def __init__(self, stripes=DEFAULT_STRIPES, max_size=DEFAULT_MAX_SIZE,
+                 ttl=None, type_limits=None, weak=False):
+        def share(limit):
+            if limit is None:
+                return None
+            return -(-limit // stripes)
+
+        type_limits = dict((type_, share(limit))
+                           for type_, limit in (type_limits or {}).items())
+        self._stripes = [IdentityMap(share(max_size), ttl, type_limits, weak)
+                         for _ in range(stripes)]
+
+    def _stripe(self, id_):
+        return self._stripes[hash(id_) % len(self._stripes)]
+
+    def get(self, id_, default=None):
+        return self._stripe(id_).get(id_, default)
+
+    def __getitem__(self, id_):
+        return self._stripe(id_)[id_]
+
+    def __contains__(self, id_):
+        return id_ in self._stripe(id_)
+
+    def __setitem__(self, id_, instance):
+        self._stripe(id_)[id_] = instance
+
+    def setdefault(self, id_, instance):
+        return self._stripe(id_).setdefault(id_, instance)
+
+    def load_once(self, id_, load):
+        return self._stripe(id_).load_once(id_, load)
+
+    def __delitem__(self, id_):
+        del self._stripe(id_)[id_]
+
+    def pop(self, id_, default=None):
+        return self._stripe(id_).pop(id_, default)
+
+    def __len__(self):
+        return sum(len(stripe) for stripe in self._stripes)
+
+    def __iter__(self):
+        return itertools.chain(*self._stripes)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [v for stripe in self._stripes for v in stripe.values()]
+
+    def items(self):
+        return [i for stripe in self._stripes for i in stripe.items()]
+
+    def clear(self):
+        for stripe in self._stripes:
+            stripe.clear()
+
+    def stats(self):
+        """Return the counters of IdentityMap.stats summed over the stripes
+        """
+        stats = dict.fromkeys(
+            ('hits', 'misses', 'evictions', 'expirations', 'size', 'live'), 0)
+        for stripe in self._stripes:
+            for key, value in stripe.stats().items():
+                if key in stats:
+                    stats[key] += value
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = (float(stats['hits']) / lookups
+                             if lookups else 0.0)
+        stats['stripes'] = len(self._stripes)
+        return stats
@@ -0,0 +1,203 @@
+"""\
+Local balances computed from journal entries
+
+A Ledger keeps the lines of the journal entries it is given, per account and
+sorted by effective date, with running debit and credit totals. It answers
+balance queries at any point in time with a binary search instead of a request
+to Subledger. Attach it to have every journal entry posted through
+JournalEntry.save ingested automatically.
+
+The ledger only knows the entries it was given. Use reconcile to compare it
+with the balances Subledger reports.
+"""
+import bisect
+import datetime
+import threading
+from decimal import Decimal
+
+from balances import iter_balances
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ')
+ZERO = Decimal(0)
+
+
+def parse_datetime(value):
+    """Return a datetime for a Subledger timestamp or datetime at UTC """
+    if isinstance(value, datetime.datetime):
+        return value
+    for format_ in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, format_)
+        except ValueError:
+            pass
+    raise ValueError('Invalid Subledger timestamp %r' % (value,))
+
+
+def balance_value(type_, amount):
+    """Return a Subledger value dict for `amount` """
+    if not amount:
+        type_ = 'zero'
+    return {'type': type_, 'amount': str(amount)}
+
+
+class AccountLedger(object):
+    """Lines of a single account with running totals
+
+    A line inserted out of order only drops the totals from its position on.
+    They are computed again up to the position a query needs.
+    """
+
+    def __init__(self):
+        self.times = []
+        self.amounts = []
+        # Running totals, debit_totals[i] is the sum of debits up to times[i].
+        # Only the totals of a prefix of the lines are known.
+        self.debit_totals = []
+        self.credit_totals = []
+
+    def add(self, effective_at, type_, amount):
+        if type_ == 'debit':
+            debit, credit = amount, ZERO
+        elif type_ == 'credit':
+            debit, credit = ZERO, amount
+        else:
+            raise ValueError('Line type must be debit or credit, not %r'
+                             % (type_,))
+        if not self.times or effective_at >= self.times[-1]:
+            self.times.append(effective_at)
+            self.amounts.append((debit, credit))
+            return
+        i = bisect.bisect_right(self.times, effective_at)
+        self.times.insert(i, effective_at)
+        self.amounts.insert(i, (debit, credit))
+        del self.debit_totals[i:]
+        del self.credit_totals[i:]
+
+    def totals(self, at=None):
+        """Return (debit, credit) of all lines effective at or before `at` """
+        if at is None:
+            i = len(self.times)
+        else:
+            i = bisect.bisect_right(self.times, at)
+        if not i:
+            return ZERO, ZERO
+        self._compute(i)
+        return self.debit_totals[i - 1], self.credit_totals[i - 1]
+
+    def _compute(self, count):
+        """Compute the running totals of the first `count` lines """
+        known = len(self.debit_totals)
+        if known >= count:
+            return
+        if known:
+            debit, credit = self.debit_totals[-1], self.credit_totals[-1]
+        else:
+            debit = credit = ZERO
+        for line_debit, line_credit in self.amounts[known:count]:
+            debit += line_debit
+            credit += line_credit
+            self.debit_totals.append(debit)
+            self.credit_totals.append(credit)
+
+
+class Ledger(object):
+    """Balances of accounts from locally known journal entries """
+
+    def __init__(self):
+        self._accounts = {}
+        self._entry_ids = set()
+        self._lock = threading.Lock()
+
+    def attach(self):
+        """Ingest every journal entry saved from now on """
+        from models import JournalEntry
+        JournalEntry.add_post_hook(self.ingest)
+
+    def detach(self):
+        from models import JournalEntry
+        JournalEntry.remove_post_hook(self.ingest)
+
+    def ingest(self, entry):
+        """Add the lines of a JournalEntry
+
+        Entries with an id are ingested only once.
+        """
+        with self._lock:
+            if entry._id is not None:
+                if entry._id in self._entry_ids:
+                    return
+                self._entry_ids.add(entry._id)
+        for line in entry.line_items:
+            self.add_line(line.account, line.type, line.amount,
+                          entry.effective_at)
+
+    def add_line(self, account_id, type_, amount, effective_at):
+        """Add a single line, `amount` as a string or Decimal """
+        effective_at = parse_datetime(effective_at)
+        amount = Decimal(amount)
+        with self._lock:
+            account = self._accounts.get(account_id)
+            if account is None:
+                account = self._accounts[account_id] = AccountLedger()
+            account.add(effective_at, type_, amount)
+
+    def totals(self, account, at=None):
+        """Return (debit, credit) totals of `account` at `at` or the latest
+
+        `account` is an Account or account id.
+        """
+        account_id = getattr(account, '_id', account)
+        with self._lock:
+            ledger = self._accounts.get(account_id)
+            if ledger is None:
+                return ZERO, ZERO
+            if at is not None:
+                at = parse_datetime(at)
+            return ledger.totals(at)
+
+    def balance(self, account, at=None):
+        """Return the balance in the form of Account.get_balance """
+        debit, credit = self.totals(account, at)
+        if debit > credit:
+            value = balance_value('debit', debit - credit)
+        else:
+            value = balance_value('credit', credit - debit)
+        return {'balance': {'debit_value': balance_value('debit', debit),
+                            'credit_value': balance_value('credit', credit),
+                            'value': value}}
+
+    def amount(self, account, at=None):
+        """Return the balance as a Decimal, positive on the normal side
+
+        `account` must be an Account, its normal_balance tells which side
+        is positive.
+        """
+        debit, credit = self.totals(account, at)
+        if account.normal_balance == 'debit':
+            return debit - credit
+        return credit - debit
+
+    def reconcile(self, accounts, at, **options):
+        """Compare local balances with those reported by Subledger
+
+        Returns a list of (account, local, remote) for every account whose
+        debit or credit total differs. `options` are passed to
+        balances.iter_balances.
+        """
+        mismatches = []
+        for (account, _), remote in iter_balances(accounts, [at], **options):
+            local = self.balance(account, at)
+            if not _same_balance(local, remote):
+                mismatches.append((account, local, remote))
+        return mismatches
+
+    def __contains__(self, account):
+        return getattr(account, '_id', account) in self._accounts
+
+
+def _same_balance(local, remote):
+    for key in ('debit_value', 'credit_value'):
+        if Decimal(local['balance'][key]['amount']) != \
+                Decimal(remote['balance'][key]['amount']):
+            return False
+    return True
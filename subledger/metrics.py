@@ -0,0 +1,168 @@
+"""\
+Request metrics of an Access instance
+
+Every request to Subledger is recorded per endpoint: latency histogram, status
+codes, bytes sent and received and retries. Endpoints are paths with their
+ids replaced, e.g. GET /orgs/:id/books/:id/accounts/:id/balance. Listeners
+receive every request as an event dict, to forward them to another metrics
+system.
+"""
+import logging
+import threading
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Path segments that are followed by an id
+COLLECTIONS = ('orgs', 'books', 'accounts', 'journal_entries', 'lines',
+               'identities', 'keys', 'categories', 'reports')
+# Path segments after a collection that are not an id
+ACTIONS = ('create_and_post', 'archive', 'activate', 'balance')
+
+
+def endpoint(path):
+    """Return `path` without query string and with ids replaced by :id """
+    segments = path.split('?', 1)[0].split('/')
+    for i in range(1, len(segments)):
+        if segments[i - 1] in COLLECTIONS and segments[i] \
+                and segments[i] not in ACTIONS:
+            segments[i] = ':id'
+    return '/'.join(segments)
+
+
+class Histogram(object):
+    """Counts of observed values per bucket """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last count is for values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Return the upper bound of the bucket holding quantile `q` """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return {'buckets': dict(zip(self.buckets, self.counts)),
+                'overflow': self.counts[-1],
+                'count': self.count,
+                'sum': self.total,
+                'mean': self.total / self.count if self.count else None,
+                'min': self.min,
+                'max': self.max,
+                'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99)}
+
+
+class EndpointMetrics(object):
+    """Counters of a single method and endpoint """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.latency = Histogram(buckets)
+        self.statuses = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.retries = 0
+
+    def snapshot(self):
+        return {'latency': self.latency.snapshot(),
+                'statuses': dict(self.statuses),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'retries': self.retries}
+
+
+class Metrics(object):
+    """Request metrics per method and endpoint """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._endpoints = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, callback):
+        """Call `callback` with an event dict for every request """
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def record(self, method, path, status, elapsed, bytes_sent=0,
+               bytes_received=0, attempt=0):
+        """Record a single request, `status` is None on connection errors """
+        name = endpoint(path)
+        with self._lock:
+            key = (method, name)
+            metrics = self._endpoints.get(key)
+            if metrics is None:
+                metrics = self._endpoints[key] = EndpointMetrics(self.buckets)
+            metrics.latency.observe(elapsed)
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            metrics.bytes_sent += bytes_sent
+            metrics.bytes_received += bytes_received
+            if attempt:
+                metrics.retries += 1
+        if self._listeners:
+            event = {'method': method, 'endpoint': name, 'path': path,
+                     'status': status, 'elapsed': elapsed,
+                     'bytes_sent': bytes_sent,
+                     'bytes_received': bytes_received, 'attempt': attempt}
+            for callback in self._listeners:
+                try:
+                    callback(event)
+                except Exception:
+                    logging.exception('Metrics listener failed')
+
+    def snapshot(self, identity_map=None):
+        """Return all metrics as a dict
+
+        Endpoints are keyed by 'METHOD endpoint'. Pass an IdentityMap to
+        include its cache statistics.
+        """
+        with self._lock:
+            endpoints = dict(('%s %s' % key, metrics.snapshot())
+                             for key, metrics in self._endpoints.items())
+        totals = {'requests': 0, 'retries': 0, 'bytes_sent': 0,
+                  'bytes_received': 0, 'seconds': 0.0}
+        for metrics in endpoints.values():
+            totals['requests'] += metrics['latency']['count']
+            totals['retries'] += metrics['retries']
+            totals['bytes_sent'] += metrics['bytes_sent']
+            totals['bytes_received'] += metrics['bytes_received']
+            totals['seconds'] += metrics['latency']['sum']
+        snapshot = {'endpoints': endpoints, 'totals': totals}
+        if identity_map is not None and hasattr(identity_map, 'stats'):
+            snapshot['identity_map'] = identity_map.stats()
+        return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
@@ -20,8 +20,45 @@ DONE: let each object have Singleton behaviour based on it's ID. This way \
       identity.
       
 """
+from decimal import Decimal, InvalidOperation
+
 from base import memoize, memoize_from_dict
-from base import Dummy, SubledgerBase
+from base import Dummy, Lazy, SubledgerBase, current_client, using
+from balances import iter_balances
+from paging import Pager
+from posting import JournalEntryWriter
+from workers import WorkerPool, wait_all, DEFAULT_MAX_WORKERS
+
+# Default effective_at to start listings of journal entries and lines from
+EPOCH = '1970-01-01T00:00:00.000Z'
+
+
+def _prefetch(loads):
+    """Load instances concurrently with from_id
+
+    `loads` is an iterable of (class, from_id arguments). Each instance is
+    loaded once, instances already indexed are not loaded again.
+    """
+    pending = {}
+    for cls, args in loads:
+        if args not in pending and args[0] not in cls._instance_index:
+            pending[args] = cls
+    if not pending:
+        return
+    # A pool of its own, the caller may be a worker of the shared pool
+    pool = WorkerPool(min(len(pending), DEFAULT_MAX_WORKERS))
+    try:
+        wait_all([pool.submit(cls.from_id, *args)
+                  for args, cls in pending.items()])
+    finally:
+        pool.shutdown()
+
+
+def _prefetch_related(instances, names):
+    """Load the related instances `names` of all `instances` at once """
+    if names:
+        _prefetch(instance._related(name)
+                  for instance in instances for name in names)
 
 
 class Organization(SubledgerBase):
@@ -31,6 +68,7 @@ class Organization(SubledgerBase):
     example, the organization "Bitmymoney.com" can have 2 accounting Books:
     EUR and XBT. For transactions in euro and bitcoin respectively.
     """
+    __slots__ = ()
     _path = '/orgs/%(_id)s'
     _types = ('active_org', 'archived_org')
 
@@ -47,12 +85,8 @@ class Organization(SubledgerBase):
         result = cls._api.get_json(path)
         type_ = result.keys()[0]
         data = result[type_]
-        # Create instance
-        self = cls(data['description'], data.get('reference'))
-        self._id = data['id']
-        self._version = data['version']
-        self._set_type(type_)
-        return self
+        data['type'] = type_
+        return cls._from_dict(data)
 
     @classmethod
     @memoize_from_dict
@@ -70,7 +104,7 @@ class Organization(SubledgerBase):
         return self
 
     def __repr__(self):
-        return "Organization(%(description)s) %(_id)s" % self.__dict__
+        return "Organization(%(description)s) %(_id)s" % self._values()
 
 
 class Book(SubledgerBase):
@@ -78,6 +112,7 @@ class Book(SubledgerBase):
     
     This is the accounting book than can be used for a single asset.
     """
+    __slots__ = ('_org_id',)
     _path = '/orgs/%(_org_id)s/books/%(_id)s'
     _types = ('active_book', 'archived_book')
 
@@ -88,29 +123,77 @@ class Book(SubledgerBase):
         """
         super(Book, self).__init__(description, reference)
         # Book specific fields
+        self._set_parent(org)
+
+    def _set_parent(self, org):
         self._org_id = org._id  # Rember the org_id
+        # An unsaved org gets its id later, take it when saving
+        self._parent = org if org._id is None else None
+        self._client = current_client(org)
 
     @property
     def organization(self):
         """Return the organization that owns this Book """
         # Organization will return itself from cache or load from Subledger
-        return Organization.from_id(self._org_id)
+        with using(self._client):
+            return Organization.from_id(self._org_id)
+
+    @property
+    def organization_ref(self):
+        """Return a Lazy stand-in for the organization, loaded on use """
+        with using(self._client):
+            return Lazy(Organization, self._org_id)
+
+    def _related(self, name):
+        """Return (class, from_id arguments) of the related `name` """
+        if name == 'organization':
+            return Organization, (self._org_id,)
+        raise ValueError('Book has no related %r' % (name,))
 
     @classmethod
     def all(
             cls, organization, state='active',
-            action='starting', id_=None, description=None, limit=None):
+            action='starting', id_=None, description=None, limit=None,
+            prefetch=True, prefetch_related=()):
         """Iterate over books for given organization
         
-        Filter results with the parameters.
+        Filter results with the parameters. All pages are followed, `limit`
+        sets the page size. With `prefetch` the next page is loaded while
+        the current one is consumed. The related instances named in
+        `prefetch_related`, like 'organization', are loaded concurrently
+        for each page.
         """
         path = cls._path % {'_org_id': organization._id, '_id': ''}
         data = {'state': state, 'action': action, 'id': id_,
                 'description': description, 'limit': limit}
-        result = cls._api.get_json(path, data)
-        for v in result['%s_books' % state]:
-            v['type'] = "%s_book" % state
-            yield cls._from_dict(v)
+        client = current_client(organization)
+        with using(client):
+            pager = Pager(cls._api, path, data, '%s_books' % state, prefetch)
+        for page in pager.iter_pages():
+            books = []
+            with using(client):
+                for v in page:
+                    v['type'] = "%s_book" % state
+                    books.append(cls._from_dict(v))
+                _prefetch_related(books, prefetch_related)
+            for book in books:
+                yield book
+
+    def get_balances(self, at_datetimes, accounts=None, stream=False,
+                     **options):
+        """Get balances of accounts in this Book at each of `at_datetimes`
+
+        Balances of all active accounts are fetched unless `accounts` is
+        given. Returns a dict by (account, at_datetime), or with `stream` an
+        iterator of ((account, at_datetime), balance) in order of arrival.
+        `options` are passed to balances.iter_balances.
+        """
+        if accounts is None:
+            accounts = Account.all(self)
+        results = iter_balances(accounts, at_datetimes, **options)
+        if stream:
+            return results
+        return dict(results)
 
     @classmethod
     @memoize
@@ -147,8 +230,8 @@ class Book(SubledgerBase):
         return self
 
     def __repr__(self):
-        data = self.__dict__.copy()
-        data['organization'] = Organization.from_id(self._org_id)
+        data = self._values()
+        data['organization'] = self.organization_ref
         return "Book(%(organization)r, %(description)s) %(_id)s" % data
 
 
@@ -157,8 +240,11 @@ class Account(SubledgerBase):
     
     This is the accounting book than can be used for a single asset.
     """
+    __slots__ = ('_org_id', '_book_id', 'normal_balance')
     _path = '/orgs/%(_org_id)s/books/%(_book_id)s/accounts/%(_id)s'
     _types = ('active_account', 'archived_account')
+    # Optional balances.BalanceCache, see set_balance_cache
+    _balance_cache = None
 
     def __init__(
             self, book, description, normal_balance='credit', reference=None):
@@ -168,44 +254,136 @@ class Account(SubledgerBase):
         """
         super(Account, self).__init__(description, reference)
         # Account specific fields
-        self._org_id = book._org_id
-        self._book_id = book._id
+        self._set_parent(book)
         # Debit or Credit account?
         self.normal_balance = normal_balance  # 'debit' or 'credit'
 
+    def _set_parent(self, book):
+        self._org_id = book._org_id
+        self._book_id = book._id
+        # An unsaved book gets its id later, take it when saving
+        self._parent = book if book._id is None else None
+        self._client = current_client(book)
+
     def get_balance(self, at_datetime_utc=None):
         """Get the balance of an account.
         at_datetime must be a datetime at UTC
+
+        With a balance cache set, see set_balance_cache, a cached balance is
+        returned without a request.
         """
-        path = self._path % self.__dict__
+        cache = self._balance_cache
+        if cache is not None:
+            return cache.get(self._id, at_datetime_utc,
+                             lambda: self._fetch_balance(at_datetime_utc))
+        return self._fetch_balance(at_datetime_utc)
+
+    def _fetch_balance(self, at_datetime_utc):
+        path = self._path % self._values()
         at_string = at_datetime_utc.strftime('%Y-%m-%dT%H:%M:%SZ')
         path += "/balance?at=%s" % at_string
         result = self._api.get_json(path, {})
         return result
 
+    @classmethod
+    def set_balance_cache(cls, balance_cache):
+        """Keep the balances returned by get_balance in `balance_cache`
+
+        The cache is attached, so journal entries saved from this process
+        invalidate the balances they change. Pass None to stop caching.
+        """
+        if Account._balance_cache is not None:
+            Account._balance_cache.detach()
+        Account._balance_cache = balance_cache
+        if balance_cache is not None:
+            balance_cache.attach()
+
+    def get_balance_async(self, at_datetime_utc=None):
+        """Return a Future for get_balance(at_datetime_utc) """
+        return self._worker_pool().submit(self.get_balance, at_datetime_utc)
+
+    def lines(self, state='posted', action='starting', effective_at=None,
+              id_=None, limit=None, prefetch=True, prefetch_related=()):
+        """Iterate over the lines of this account as AccountLine values
+
+        Lines are listed by effective date, from `effective_at` or the id of
+        a line `id_`. All pages are followed, `limit` sets the page size.
+        With `prefetch` the next page is loaded while the current one is
+        consumed. With 'journal_entry' in `prefetch_related` the journal
+        entries of each page are loaded concurrently, for
+        JournalEntry.from_id to find them.
+        """
+        if effective_at is None and id_ is None:
+            effective_at = EPOCH
+        path = self._path % self._values() + '/lines'
+        data = {'state': state, 'action': action, 'id': id_,
+                'effective_at': effective_at, 'limit': limit}
+        pager = Pager(self._api, path, data, '%s_lines' % state, prefetch)
+        for page in pager.iter_pages():
+            lines = [AccountLine.from_dict(v) for v in page]
+            if prefetch_related:
+                if set(prefetch_related) - set(['journal_entry']):
+                    raise ValueError('Lines have no related %r'
+                                     % (prefetch_related,))
+                with using(self._client):
+                    _prefetch((JournalEntry, (line.journal_entry,
+                                              self._org_id, self._book_id))
+                              for line in lines)
+            for line in lines:
+                yield line
+
     @property
     def book(self):
         """Return the Book that this account exists in """
         # Book will return itself from cache or load from Subledger
-        return Book.from_id(self._book_id, self._org_id)
+        with using(self._client):
+            return Book.from_id(self._book_id, self._org_id)
+
+    @property
+    def book_ref(self):
+        """Return a Lazy stand-in for the book, loaded on use """
+        with using(self._client):
+            return Lazy(Book, self._book_id, self._org_id)
+
+    def _related(self, name):
+        """Return (class, from_id arguments) of the related `name` """
+        if name == 'book':
+            return Book, (self._book_id, self._org_id)
+        if name == 'organization':
+            return Organization, (self._org_id,)
+        raise ValueError('Account has no related %r' % (name,))
 
     @classmethod
     def all(
             cls, book, state='active',
-            action='starting', id_=None, description=None, limit=None):
+            action='starting', id_=None, description=None, limit=None,
+            prefetch=True, prefetch_related=()):
         """Iterate over accounts within given book 
         
-        Filter results with the parameters.
+        Filter results with the parameters. All pages are followed, `limit`
+        sets the page size. With `prefetch` the next page is loaded while
+        the current one is consumed. The related instances named in
+        `prefetch_related`, 'book' or 'organization', are loaded
+        concurrently for each page.
         """
         path = cls._path % {'_org_id': book._org_id, '_book_id': book._id, '_id': ''}
         data = {'state': state, 'action': action, 'id': id_,
                 'description': description, 'limit': limit}
-        result = cls._api.get_json(path, data)
-        for v in result['%s_accounts' % state]:
-            v['type'] = "%s_account" % state
-            # Add org_id to the data, it is not returned by Subledger
-            v['org'] = book._org_id
-            yield cls._from_dict(v)
+        client = current_client(book)
+        with using(client):
+            pager = Pager(cls._api, path, data, '%s_accounts' % state,
+                          prefetch)
+        for page in pager.iter_pages():
+            accounts = []
+            with using(client):
+                for v in page:
+                    v['type'] = "%s_account" % state
+                    # Add org_id to the data, it is not returned by Subledger
+                    v['org'] = book._org_id
+                    accounts.append(cls._from_dict(v))
+                _prefetch_related(accounts, prefetch_related)
+            for account in accounts:
+                yield account
 
     @classmethod
     @memoize
@@ -250,18 +428,105 @@ class Account(SubledgerBase):
         return self
 
     def __repr__(self):
-        data = self.__dict__.copy()
-        data['book'] = Book.from_id(self._book_id, self._org_id)
+        data = self._values()
+        data['book'] = self.book_ref
         signature = "Account(%(book)r, %(description)s, " \
                     "%(normal_balance)s) %(_id)s"
         return signature % data
 
 
+class Line(object):
+    """A line of a journal entry: an amount debited or credited to an account
+
+    Lines are immutable values. The amount is kept as a Decimal, a float
+    amount by its shortest repr, so 10.10 is 10.1 and not 10.0999...
+    """
+    __slots__ = ('account', 'debit', 'amount')
+
+    def __init__(self, account, type_, amount):
+        """`account` is an account id, `type_` 'debit' or 'credit' """
+        if type_ not in ('debit', 'credit'):
+            raise ValueError('Line type must be debit or credit, not %r'
+                             % (type_,))
+        if isinstance(amount, float):
+            amount = repr(amount)
+        try:
+            amount = Decimal(amount)
+        except (InvalidOperation, TypeError):
+            raise ValueError('Line amount must be a decimal number, not %r'
+                             % (amount,))
+        object.__setattr__(self, 'account', account)
+        object.__setattr__(self, 'debit', type_ == 'debit')
+        object.__setattr__(self, 'amount', amount)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Line is immutable')
+
+    @property
+    def type(self):
+        return 'debit' if self.debit else 'credit'
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a Line from its Subledger representation """
+        value = data['value']
+        return cls(data['account'], value['type'], value['amount'])
+
+    def to_dict(self):
+        """Return the Subledger representation of this line """
+        return {'account': self.account,
+                'value': {'type': self.type, 'amount': str(self.amount)}}
+
+    def __eq__(self, other):
+        return isinstance(other, Line) and \
+            (self.account, self.debit, self.amount) == \
+            (other.account, other.debit, other.amount)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.account, self.debit, self.amount))
+
+    def __repr__(self):
+        return "Line(%s, %s, %s)" % (self.account, self.type, self.amount)
+
+
+class AccountLine(Line):
+    """A line as listed for an account by Account.lines
+
+    Adds the id of the line, the id of its journal entry and the effective
+    date to the Line value.
+    """
+    __slots__ = ('id', 'journal_entry', 'effective_at')
+
+    def __init__(self, account, type_, amount, id_=None, journal_entry=None,
+                 effective_at=None):
+        super(AccountLine, self).__init__(account, type_, amount)
+        object.__setattr__(self, 'id', id_)
+        object.__setattr__(self, 'journal_entry', journal_entry)
+        object.__setattr__(self, 'effective_at', effective_at)
+
+    @classmethod
+    def from_dict(cls, data):
+        value = data['value']
+        return cls(data['account'], value['type'], value['amount'],
+                   data.get('id'), data.get('journal_entry'),
+                   data.get('effective_at'))
+
+    def __repr__(self):
+        return "AccountLine(%s, %s, %s, %s) %s" % (
+            self.account, self.type, self.amount, self.effective_at, self.id)
+
+
 class JournalEntry(SubledgerBase):
     """ """
+    __slots__ = ('_org_id', '_book_id', 'effective_at', '_lines')
     _path = '/orgs/%(_org_id)s/books/%(_book_id)s/journal_entries/create_and_post'
     _get_path = '/orgs/%(_org_id)s/books/%(_book_id)s/journal_entries/%(_id)s'
     _types = ('active_journal_entry', 'posted_journal_entry', 'posting_journal_entry')
+    # Called with each journal entry after it was saved
+    _post_hooks = []
 
     def __init__(self, book, description, effective_at, lines, reference=None):
         """Create a journal entry
@@ -269,10 +534,10 @@ class JournalEntry(SubledgerBase):
         `book` should be passed as an instance of Book
         `lines` should be a list of dictionary objects with these keys: account, value
         value should be a dictionary with these keys: type, amount
+        Instances of Line are accepted as well.
         """
         super(JournalEntry, self).__init__(description, reference)
-        self._org_id = book._org_id
-        self._book_id = book._id
+        self._set_parent(book)
         # JournalEntry specific fields
         self.effective_at = effective_at
         self.lines = lines
@@ -314,13 +579,141 @@ class JournalEntry(SubledgerBase):
         self = cls(book=book,
                    description=data['description'],
                    effective_at=data['effective_at'],
-                   lines=None,
+                   lines=data.get('lines'),
                    reference=data.get('reference'))
         self._id = data['id']
         self._version = data['version']
         self._set_type(data['type'])
         return self
 
+    def _set_parent(self, book):
+        self._org_id = book._org_id
+        self._book_id = book._id
+        # An unsaved book gets its id later, take it when saving
+        self._parent = book if book._id is None else None
+        self._client = current_client(book)
+
+    @property
+    def book(self):
+        """Return the Book that this journal entry is posted in """
+        with using(self._client):
+            return Book.from_id(self._book_id, self._org_id)
+
+    def _related(self, name):
+        """Return (class, from_id arguments) of the related `name` """
+        if name == 'book':
+            return Book, (self._book_id, self._org_id)
+        if name == 'organization':
+            return Organization, (self._org_id,)
+        raise ValueError('JournalEntry has no related %r' % (name,))
+
+    @classmethod
+    def all(
+            cls, book, state='posted',
+            action='starting', effective_at=None, id_=None, limit=None,
+            prefetch=True, prefetch_related=()):
+        """Iterate over journal entries within given book
+
+        Entries are listed by effective date, from `effective_at` or the id
+        of an entry `id_`. All pages are followed, `limit` sets the page
+        size. With `prefetch` the next page is loaded while the current one
+        is consumed. Listed entries are indexed, so from_id finds them
+        without a request. Their lines are not listed, use Account.lines.
+        The related instances named in `prefetch_related` are loaded
+        concurrently for each page.
+        """
+        if effective_at is None and id_ is None:
+            effective_at = EPOCH
+        path = cls._get_path % {'_org_id': book._org_id,
+                                '_book_id': book._id, '_id': ''}
+        data = {'state': state, 'action': action, 'id': id_,
+                'effective_at': effective_at, 'limit': limit}
+        client = current_client(book)
+        with using(client):
+            pager = Pager(cls._api, path.rstrip('/'), data,
+                          '%s_journal_entries' % state, prefetch)
+        for page in pager.iter_pages():
+            entries = []
+            with using(client):
+                for v in page:
+                    v['type'] = "%s_journal_entry" % state
+                    # Add org_id to the data, it is not returned by Subledger
+                    v['org'] = book._org_id
+                    entries.append(cls._from_dict(v))
+                _prefetch_related(entries, prefetch_related)
+            for entry in entries:
+                yield entry
+
+    def save(self):
+        """Post this journal entry to Subledger, then call the post hooks """
+        created = super(JournalEntry, self).save()
+        for hook in list(self._post_hooks):
+            hook(self)
+        return created
+
+    @classmethod
+    def add_post_hook(cls, hook):
+        """Call `hook` with every journal entry after it was saved """
+        cls._post_hooks.append(hook)
+
+    @classmethod
+    def remove_post_hook(cls, hook):
+        cls._post_hooks.remove(hook)
+
+    def iter_lines(self, state='posted', limit=None, prefetch=True):
+        """Iterate over the lines of this entry as listed by Subledger, as
+        AccountLine values
+
+        All pages are followed, `limit` sets the page size. With `prefetch`
+        the next page is loaded while the current one is consumed.
+        """
+        path = self._get_path % self._values() + '/lines'
+        data = {'state': state, 'action': 'starting', 'limit': limit}
+        pager = Pager(self._api, path, data, '%s_lines' % state, prefetch)
+        for line in pager:
+            yield AccountLine.from_dict(line)
+
+    @classmethod
+    def save_many(cls, entries, **options):
+        """Post many new journal entries concurrently
+
+        Yields a posting.PostResult for each entry as it completes.
+        `options` are passed to posting.JournalEntryWriter.
+        """
+        return JournalEntryWriter(**options).post(entries)
+
+    @property
+    def lines(self):
+        """The lines as a list of dicts in their Subledger representation """
+        if self._lines is None:
+            return None
+        return [line.to_dict() for line in self._lines]
+
+    @lines.setter
+    def lines(self, lines):
+        if lines is None:
+            self._lines = None
+        else:
+            self._lines = tuple(
+                line if isinstance(line, Line) else Line.from_dict(line)
+                for line in lines)
+
+    @property
+    def line_items(self):
+        """The lines as a tuple of Line instances """
+        return self._lines or ()
+
+    def _payload(self):
+        data = super(JournalEntry, self)._payload()
+        # The serializer encodes Line values as dicts
+        data['lines'] = self._lines
+        return data
+
+    def _values(self):
+        values = super(JournalEntry, self)._values()
+        values['lines'] = self.lines
+        return values
+
     @property
     def is_posted(self):
         return self._type.startswith('posted')
@@ -0,0 +1,90 @@
+"""\
+Paginated listings from Subledger
+
+Subledger returns listings one page at a time, each in ascending order. The
+next page is requested with the id of the last item seen and action
+`following`, or when paging backwards the id of the first item and action
+`preceding`. Pager follows these cursors until the listing is exhausted.
+"""
+import sys
+import threading
+
+from workers import Future
+
+# Actions that walk the listing backwards
+BACKWARD_ACTIONS = ('before', 'ending', 'preceding')
+
+
+class Pager(object):
+    """Iterate over all items of a paginated Subledger listing
+
+    `key` is the key of the item list in the response. `params` are the
+    query parameters of the first page, its `limit` is used as page size.
+    With `prefetch` the next page is requested in the background while the
+    items of the current page are consumed. No more than two pages are held
+    in memory.
+    """
+
+    def __init__(self, access, path, params, key, prefetch=True):
+        self.access = access
+        self.path = path
+        self.params = dict(params)
+        self.key = key
+        self.prefetch = prefetch
+        self.pages = 0
+
+    def __iter__(self):
+        for page in self.iter_pages():
+            for item in page:
+                yield item
+
+    def iter_pages(self):
+        """Yield the items page by page, as lists """
+        params = self.params
+        page = self._fetch(params)
+        while page:
+            params = self._next_params(params, page)
+            upcoming = None
+            if self.prefetch:
+                upcoming = self._fetch_in_background(params)
+            yield page
+            if upcoming is not None:
+                page = upcoming.result()
+            else:
+                page = self._fetch(params)
+
+    def _next_params(self, params, page):
+        """Return query parameters for the page after `page`
+
+        Subledger may return fewer items than `limit` before the end of a
+        listing, only an empty page ends it.
+        """
+        params = dict(params)
+        # Pages are in ascending order, backwards the first item is the
+        # earliest seen
+        if params.get('action') in BACKWARD_ACTIONS:
+            params['action'] = 'preceding'
+            params['id'] = page[0]['id']
+        else:
+            params['action'] = 'following'
+            params['id'] = page[-1]['id']
+        return params
+
+    def _fetch(self, params):
+        self.pages += 1
+        result = self.access.get_json(self.path, params)
+        return result[self.key]
+
+    def _fetch_in_background(self, params):
+        future = Future()
+
+        def fetch():
+            try:
+                future.set_result(self._fetch(params))
+            except BaseException:
+                future.set_exc_info(sys.exc_info())
+
+        thread = threading.Thread(target=fetch)
+        thread.daemon = True
+        thread.start()
+        return future
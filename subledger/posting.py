@@ -0,0 +1,175 @@
+"""\
+Posting journal entries in bulk
+
+JournalEntry.save posts a single entry and waits for Subledger to respond.
+JournalEntryWriter posts a stream of entries from a WorkerPool instead. It
+reads entries only as fast as they are posted, so the stream may be endless,
+and posts entries that share an account in the order they were given.
+"""
+import sys
+import threading
+import time
+import Queue
+
+from workers import Future, WorkerPool, DEFAULT_MAX_WORKERS
+
+
+class PostResult(object):
+    """Outcome of posting a single journal entry """
+
+    def __init__(self, entry, error=None, exc_info=None, elapsed=None):
+        self.entry = entry
+        self.error = error
+        self.exc_info = exc_info
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def id(self):
+        return self.entry._id
+
+    @property
+    def version(self):
+        return self.entry._version
+
+    @property
+    def type(self):
+        return self.entry._type
+
+    def __repr__(self):
+        if self.ok:
+            return "PostResult(%s, %s, %s)" % (self.id, self.version, self.type)
+        return "PostResult(%r, error=%r)" % (self.entry.reference, self.error)
+
+
+class JournalEntryWriter(object):
+    """Post journal entries concurrently
+
+    At most `max_workers` entries are posted at the same time and at most
+    `max_pending` entries are read ahead of the results. With
+    `preserve_order` an entry is posted only after all earlier entries with
+    a line on one of its accounts are done.
+
+    With a validation.JournalEntryValidator as `validator` all entries are
+    read and checked before the first one is posted, post raises a
+    ValidationError listing every invalid entry.
+
+    A shared `pool` must not bound its queue with max_pending: entries
+    waiting for an earlier one are submitted from the workers, which would
+    block on a full queue and deadlock the pool.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, max_pending=None,
+                 preserve_order=True, pool=None, validator=None):
+        if pool is not None and pool.max_pending:
+            raise ValueError('JournalEntryWriter needs a pool without '
+                             'max_pending')
+        self.max_workers = max_workers
+        self.max_pending = max_pending or max_workers * 2
+        self.preserve_order = preserve_order
+        self.pool = pool
+        self.validator = validator
+        self.submitted = 0
+        self.posted = 0
+        self.failed = 0
+        self.latency = 0.0
+        self.started_at = None
+        self.finished_at = None
+
+    def post(self, entries):
+        """Post `entries` and yield a PostResult for each as it completes """
+        if self.validator is not None:
+            entries = self.validator.validate(entries)
+        own_pool = self.pool is None
+        pool = WorkerPool(self.max_workers) if own_pool else self.pool
+        completed = Queue.Queue()
+        # Last entry posted per account id
+        last = {}
+        in_flight = 0
+        finished = False
+        self.started_at = time.time()
+        try:
+            for entry in entries:
+                while in_flight >= self.max_pending:
+                    yield self._record(completed.get())
+                    in_flight -= 1
+                done = Future()
+                done.add_done_callback(lambda f: completed.put(f.result()))
+                waits_for = []
+                if self.preserve_order:
+                    for account_id in _account_ids(entry):
+                        previous = last.get(account_id)
+                        if previous is not None and not previous.done():
+                            waits_for.append(previous)
+                        last[account_id] = done
+                    if len(last) > 10 * self.max_pending:
+                        last = dict((k, f) for k, f in last.items()
+                                    if not f.done())
+                _after(waits_for, pool.submit, self._post_one, entry, done)
+                self.submitted += 1
+                in_flight += 1
+            while in_flight:
+                yield self._record(completed.get())
+                in_flight -= 1
+            finished = True
+        finally:
+            self.finished_at = time.time()
+            if own_pool:
+                # Only wait for the workers when no entry is left posting
+                pool.shutdown(wait=finished)
+
+    def stats(self):
+        """Return counters and throughput of the posted entries """
+        end = self.finished_at or time.time()
+        elapsed = end - self.started_at if self.started_at else 0.0
+        done = self.posted + self.failed
+        return {'submitted': self.submitted,
+                'posted': self.posted,
+                'failed': self.failed,
+                'elapsed': elapsed,
+                'entries_per_second': done / elapsed if elapsed else 0.0,
+                'mean_latency': self.latency / done if done else 0.0}
+
+    def _post_one(self, entry, done):
+        start = time.time()
+        try:
+            entry.save()
+        except Exception as e:
+            result = PostResult(entry, e, sys.exc_info(), time.time() - start)
+        else:
+            result = PostResult(entry, elapsed=time.time() - start)
+        done.set_result(result)
+
+    def _record(self, result):
+        if result.ok:
+            self.posted += 1
+        else:
+            self.failed += 1
+        self.latency += result.elapsed
+        return result
+
+
+def _account_ids(entry):
+    return set(line.account for line in entry.line_items)
+
+
+def _after(futures, func, *args):
+    """Call func(*args) once all `futures` are done """
+    if not futures:
+        func(*args)
+        return
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def one_done(future):
+        with lock:
+            remaining[0] -= 1
+            ready = remaining[0] == 0
+        if ready:
+            func(*args)
+
+    for future in futures:
+        future.add_done_callback(one_done)
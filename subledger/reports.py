@@ -0,0 +1,156 @@
+"""\
+Trial balance and movement reports of a Book
+
+Balances of all accounts are fetched in bulk with balances.iter_balances and
+kept in columns, one value per account. Amounts are stored as integers in
+units of the smallest decimal place that occurs, so totals and differences
+are exact. The columns are NumPy arrays when NumPy is installed and plain
+lists otherwise.
+"""
+from decimal import Decimal
+
+from balances import iter_balances
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Columns whose total may exceed this are not kept as int64
+INT64_LIMIT = 2 ** 63
+
+
+def _scale(amounts):
+    """Return the number of decimal places needed for all `amounts` """
+    return max([-a.as_tuple().exponent for a in amounts] + [0])
+
+
+def _column(values):
+    if numpy is None:
+        return list(values)
+    values = list(values)
+    if values and max(abs(v) for v in values) * len(values) >= INT64_LIMIT:
+        return numpy.array(values, dtype=object)
+    return numpy.array(values, dtype=numpy.int64)
+
+
+def _subtract(a, b):
+    if numpy is None:
+        return [x - y for x, y in zip(a, b)]
+    return a - b
+
+
+def _total(column):
+    if numpy is None:
+        return sum(column)
+    return int(column.sum())
+
+
+class TrialBalance(object):
+    """Debit and credit balance of every account of a book at one moment """
+
+    def __init__(self, accounts, balances, at):
+        """`balances` holds the Account.get_balance result per account """
+        self.accounts = list(accounts)
+        self.at = at
+        debits = [Decimal(balances[a]['balance']['debit_value']['amount'])
+                  for a in self.accounts]
+        credits = [Decimal(balances[a]['balance']['credit_value']['amount'])
+                   for a in self.accounts]
+        self.scale = _scale(debits + credits)
+        self.debits = _column(int(d.scaleb(self.scale)) for d in debits)
+        self.credits = _column(int(c.scaleb(self.scale)) for c in credits)
+
+    @classmethod
+    def from_book(cls, book, at, accounts=None, **options):
+        """Fetch the balances of the accounts of `book` at `at`
+
+        All active accounts are used unless `accounts` is given. `options`
+        are passed to balances.iter_balances.
+        """
+        if accounts is None:
+            from models import Account
+            accounts = Account.all(book)
+        accounts = list(accounts)
+        balances = dict((account, balance) for (account, _), balance
+                        in iter_balances(accounts, [at], **options))
+        return cls(accounts, balances, at)
+
+    def _decimal(self, value):
+        return Decimal(int(value)).scaleb(-self.scale)
+
+    @property
+    def total_debit(self):
+        return self._decimal(_total(self.debits))
+
+    @property
+    def total_credit(self):
+        return self._decimal(_total(self.credits))
+
+    @property
+    def is_balanced(self):
+        return _total(self.debits) == _total(self.credits)
+
+    @property
+    def net(self):
+        """Column of debit minus credit per account, in scaled units """
+        return _subtract(self.debits, self.credits)
+
+    def rows(self):
+        """Yield (account, debit, credit) with Decimal amounts """
+        for account, debit, credit in zip(
+                self.accounts, self.debits, self.credits):
+            yield account, self._decimal(debit), self._decimal(credit)
+
+    def totals(self):
+        return {'at': self.at,
+                'accounts': len(self.accounts),
+                'debit': self.total_debit,
+                'credit': self.total_credit,
+                'balanced': self.is_balanced}
+
+
+class Movements(object):
+    """Change of the balance of every account between cut-off times """
+
+    def __init__(self, accounts, balances, cut_offs):
+        """`balances` holds balance results by (account, cut_off) """
+        self.accounts = list(accounts)
+        self.cut_offs = sorted(cut_offs)
+        nets = []
+        for at in self.cut_offs:
+            nets.append([_net(balances[(a, at)]) for a in self.accounts])
+        self.scale = _scale([n for column in nets for n in column])
+        # One column of net balances, debit positive, per cut-off
+        self.balances = [_column(int(n.scaleb(self.scale)) for n in column)
+                         for column in nets]
+
+    @classmethod
+    def from_book(cls, book, cut_offs, accounts=None, **options):
+        """Fetch the balances of the accounts of `book` at all `cut_offs` """
+        if accounts is None:
+            from models import Account
+            accounts = Account.all(book)
+        accounts = list(accounts)
+        balances = dict(iter_balances(accounts, cut_offs, **options))
+        return cls(accounts, balances, cut_offs)
+
+    def periods(self):
+        """Yield (start, end, column of movements) per period """
+        for i in range(1, len(self.cut_offs)):
+            yield (self.cut_offs[i - 1], self.cut_offs[i],
+                   _subtract(self.balances[i], self.balances[i - 1]))
+
+    def rows(self):
+        """Yield (account, [movement per period]) with Decimal amounts """
+        periods = [column for _, _, column in self.periods()]
+        for i, account in enumerate(self.accounts):
+            yield account, [Decimal(int(column[i])).scaleb(-self.scale)
+                            for column in periods]
+
+
+def _net(balance):
+    """Return debit minus credit of a balance result """
+    balance = balance['balance']
+    return (Decimal(balance['debit_value']['amount']) -
+            Decimal(balance['credit_value']['amount']))
@@ -0,0 +1,75 @@
+"""\
+JSON encoding and decoding of API payloads
+
+Access encodes request payloads and decodes responses with a serializer. The
+standard library json module is always available; simplejson, when installed,
+is faster thanks to its C speedups. Both encode Decimal amounts as strings,
+the way Subledger expects them, and Line values as their Subledger dicts.
+"""
+import json
+from decimal import Decimal
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+
+def _default(value):
+    """Encode the values json does not know about """
+    if isinstance(value, Decimal):
+        return str(value)
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+class JSONSerializer(object):
+    """Serializer using the standard library json module """
+    name = 'json'
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(default=_default,
+                                         separators=(',', ':'))
+
+    def dumps(self, data):
+        return self._encoder.encode(data)
+
+    def loads(self, text):
+        return json.loads(text)
+
+
+class SimpleJSONSerializer(object):
+    """Serializer using simplejson """
+    name = 'simplejson'
+
+    def __init__(self):
+        if simplejson is None:
+            raise ImportError('simplejson is not installed')
+        # With use_decimal simplejson would write amounts as numbers
+        self._encoder = simplejson.JSONEncoder(
+            default=_default, use_decimal=False, separators=(',', ':'))
+
+    def dumps(self, data):
+        return self._encoder.encode(data)
+
+    def loads(self, text):
+        return simplejson.loads(text)
+
+
+SERIALIZERS = {'json': JSONSerializer, 'simplejson': SimpleJSONSerializer}
+
+
+def available_serializers():
+    """Return the names of the serializers that can be used here """
+    names = ['json']
+    if simplejson is not None:
+        names.append('simplejson')
+    return names
+
+
+def get_serializer(name=None):
+    """Return a serializer by name, by default the fastest available """
+    if name is None:
+        name = available_serializers()[-1]
+    return SERIALIZERS[name]()
@@ -0,0 +1,90 @@
+"""\
+Unit of work for saving many changed instances
+
+A Session collects organizations, books, accounts and journal entries and
+saves those with unsaved changes in one flush. An instance is saved after the
+instance it belongs to, so a new book created for a new organization gets the
+id of the organization. Instances of the same class do not depend on each
+other and are saved concurrently.
+"""
+from models import Organization, Book, Account, JournalEntry
+from workers import WorkerPool, DEFAULT_MAX_WORKERS
+
+# Classes in the order they are saved
+FLUSH_ORDER = (Organization, Book, Account, JournalEntry)
+
+
+class Session(object):
+    """Instances to save together with flush """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, pool=None):
+        """Pass a WorkerPool as `pool` to share workers, otherwise one with
+        `max_workers` is used for each flush.
+        """
+        self.max_workers = max_workers
+        self.pool = pool
+        self._instances = []
+        self._ids = set()
+
+    def add(self, instance):
+        """Save `instance` on the next flush when it has changes """
+        if id(instance) not in self._ids:
+            self._ids.add(id(instance))
+            self._instances.append(instance)
+
+    def add_all(self, instances):
+        for instance in instances:
+            self.add(instance)
+
+    @property
+    def dirty(self):
+        """The added instances with unsaved changes """
+        return [i for i in self._instances if i.is_dirty]
+
+    def flush(self):
+        """Save all dirty instances, returns the instances saved
+
+        When a save fails, the others of its class are still completed
+        before the first error is raised, instances that depend on them are
+        not saved.
+        """
+        dirty = self.dirty
+        if not dirty:
+            return []
+        tiers = [[i for i in dirty if isinstance(i, cls)]
+                 for cls in FLUSH_ORDER]
+        others = [i for i in dirty if not isinstance(i, FLUSH_ORDER)]
+        if others:
+            tiers.append(others)
+        pool = self.pool or WorkerPool(self.max_workers)
+        saved = []
+        try:
+            for tier in tiers:
+                futures = [pool.submit(instance.save) for instance in tier]
+                failed = []
+                for instance, future in zip(tier, futures):
+                    if future.exception() is None:
+                        saved.append(instance)
+                    else:
+                        failed.append(future)
+                if failed:
+                    # Raise with the traceback of the failed save
+                    failed[0].result()
+        finally:
+            if self.pool is None:
+                pool.shutdown()
+        return saved
+
+    def clear(self):
+        """Forget all added instances """
+        self._instances = []
+        self._ids = set()
+
+    def __contains__(self, instance):
+        return id(instance) in self._ids
+
+    def __len__(self):
+        return len(self._instances)
+
+    def __iter__(self):
+        return iter(self._instances)
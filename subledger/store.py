@@ -0,0 +1,130 @@
+"""\
+Persistent cache of Subledger instances
+
+Organizations, books and accounts rarely change, yet every new process loads
+them from Subledger again. A DiskCache keeps their Subledger representation
+in an SQLite file, keyed by id and version. Register it with
+SubledgerBase.set_disk_cache to have from_id read from it before going to
+Subledger, and to fill the instance index from it at startup.
+
+Writes are committed in batches, loading a large book does not commit once
+per account. Call flush or close to commit the last ones.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+from base import SubledgerBase
+
+# Journal entries are numerous and rarely read twice, leave them out by default
+DEFAULT_KINDS = ('Organization', 'Book', 'Account')
+# Commit after this many writes or seconds, whichever comes first
+COMMIT_EVERY = 100
+COMMIT_INTERVAL = 1.0
+
+
+class DiskCache(object):
+    """SQLite file with the Subledger representation of instances
+
+    Only instances of the classes named in `kinds` are stored. Writes are
+    committed every `commit_every` writes or `commit_interval` seconds.
+    """
+
+    def __init__(self, path, kinds=DEFAULT_KINDS, commit_every=COMMIT_EVERY,
+                 commit_interval=COMMIT_INTERVAL):
+        self.path = path
+        self.kinds = kinds
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._committed_at = time.time()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS instances ('
+            ' id TEXT PRIMARY KEY, kind TEXT, version INTEGER,'
+            ' data TEXT, stored_at REAL)')
+        self._connection.commit()
+        # (version, type) on disk, to skip writes that change nothing, the
+        # type changes without a new version on archive and activate
+        self._versions = dict(
+            (id_, (version, json.loads(data)['type']))
+            for id_, version, data in self._connection.execute(
+                'SELECT id, version, data FROM instances'))
+
+    def put(self, instance):
+        """Store the representation of `instance` unless stored already """
+        kind = type(instance).__name__
+        if instance._id is None or kind not in self.kinds:
+            return
+        stored = (instance._version, instance._type)
+        if self._versions.get(instance._id) == stored:
+            return
+        data = json.dumps(instance._as_dict())
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?, ?)',
+                (instance._id, kind, instance._version, data,
+                 instance._fetched_at or time.time()))
+            self._versions[instance._id] = stored
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every or \
+                    time.time() - self._committed_at >= self.commit_interval:
+                self._commit()
+
+    def flush(self):
+        """Commit the writes not committed yet """
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        self._connection.commit()
+        self._uncommitted = 0
+        self._committed_at = time.time()
+
+    def get(self, id_, kind):
+        """Return (data, stored_at) of the instance with id_, or None """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT data, stored_at FROM instances'
+                ' WHERE id = ? AND kind = ?', (id_, kind)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def discard(self, id_):
+        with self._lock:
+            self._connection.execute(
+                'DELETE FROM instances WHERE id = ?', (id_,))
+            self._commit()
+            self._versions.pop(id_, None)
+
+    def hydrate(self):
+        """Create all stored instances in the instance index
+
+        Returns the number of instances loaded.
+        """
+        classes = dict((cls.__name__, cls) for cls in _subclasses())
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT kind, data, stored_at FROM instances').fetchall()
+        for kind, data, stored_at in rows:
+            instance = classes[kind]._from_dict(json.loads(data))
+            instance._fetched_at = stored_at
+        return len(rows)
+
+    def __len__(self):
+        return len(self._versions)
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._connection.close()
+
+
+def _subclasses(cls=SubledgerBase):
+    for subclass in cls.__subclasses__():
+        yield subclass
+        for subsubclass in _subclasses(subclass):
+            yield subsubclass
@@ -0,0 +1,234 @@
+"""\
+Local mirror of the accounts and journal entries of a Book
+
+Reporting jobs that read a whole book again on every run spend most of their
+time on requests for data they have seen before. A BookMirror copies the
+accounts, journal entries and lines of a book into an SQLite file. Later runs
+of sync only list the journal entries and lines after the last ones stored,
+the watermark. The mirrored data is read back as model instances without
+network access.
+
+Journal entries are listed by effective date. An entry posted later with an
+effective date before the watermark is not picked up by an incremental sync,
+run sync(full=True) to catch up on backdated entries.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+from base import current_client, using
+from models import Account, AccountLine, JournalEntry
+from workers import WorkerPool, DEFAULT_MAX_WORKERS
+
+
+class BookMirror(object):
+    """SQLite copy of the accounts and journal entries of `book` """
+
+    def __init__(self, path, book, max_workers=DEFAULT_MAX_WORKERS):
+        """`max_workers` accounts have their lines synchronized at once """
+        self.path = path
+        self.book = book
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        for statement in (
+                'CREATE TABLE IF NOT EXISTS accounts ('
+                ' id TEXT PRIMARY KEY, book TEXT, version INTEGER,'
+                ' data TEXT)',
+                'CREATE TABLE IF NOT EXISTS journal_entries ('
+                ' id TEXT PRIMARY KEY, book TEXT, effective_at TEXT,'
+                ' data TEXT)',
+                'CREATE TABLE IF NOT EXISTS lines ('
+                ' id TEXT PRIMARY KEY, book TEXT, account TEXT,'
+                ' journal_entry TEXT, effective_at TEXT, type TEXT,'
+                ' amount TEXT)',
+                'CREATE INDEX IF NOT EXISTS lines_by_account'
+                ' ON lines (account, effective_at)',
+                'CREATE INDEX IF NOT EXISTS lines_by_journal_entry'
+                ' ON lines (journal_entry)',
+                'CREATE TABLE IF NOT EXISTS watermarks ('
+                ' book TEXT, name TEXT, id TEXT, synced_at REAL,'
+                ' PRIMARY KEY (book, name))'):
+            self._connection.execute(statement)
+        self._connection.commit()
+
+    # Synchronization
+
+    def sync(self, full=False, limit=None):
+        """Fetch what changed in Subledger since the last sync
+
+        Accounts are listed completely, they carry no effective date, but
+        only changed versions are written. Journal entries and lines are
+        listed from the watermarks on, or from the start with `full`.
+        `limit` sets the page size. Returns the number of records fetched
+        per kind and the seconds it took.
+        """
+        start = time.time()
+        stats = {'accounts': 0, 'journal_entries': 0, 'lines': 0}
+        accounts = []
+        for state in ('active', 'archived'):
+            for account in Account.all(self.book, state=state, limit=limit):
+                accounts.append(account)
+                stats['accounts'] += self._put_account(account)
+        self._commit()
+
+        watermark = None if full else self._watermark('journal_entries')
+        if watermark is None:
+            entries = JournalEntry.all(self.book, limit=limit)
+        else:
+            entries = JournalEntry.all(self.book, action='following',
+                                       id_=watermark, limit=limit)
+        for entry in entries:
+            self._put_journal_entry(entry)
+            watermark = entry._id
+            stats['journal_entries'] += 1
+        self._set_watermark('journal_entries', watermark)
+        self._commit()
+
+        pool = WorkerPool(self.max_workers)
+        try:
+            futures = [(account, pool.submit(self._fetch_lines, account,
+                                             full, limit))
+                       for account in accounts]
+            for account, future in futures:
+                lines = future.result()
+                for line in lines:
+                    self._put_line(line)
+                if lines:
+                    self._set_watermark('lines:%s' % account._id,
+                                        lines[-1].id)
+                self._commit()
+                stats['lines'] += len(lines)
+        finally:
+            pool.shutdown()
+        stats['seconds'] = time.time() - start
+        return stats
+
+    def _fetch_lines(self, account, full, limit):
+        watermark = None
+        if not full:
+            watermark = self._watermark('lines:%s' % account._id)
+        if watermark is None:
+            return list(account.lines(limit=limit))
+        return list(account.lines(action='following', id_=watermark,
+                                  limit=limit))
+
+    def _put_account(self, account):
+        """Store `account`, return 1 if it was new or changed, else 0 """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT version FROM accounts WHERE id = ?',
+                (account._id,)).fetchone()
+            if row is not None and row[0] == account._version:
+                return 0
+            self._connection.execute(
+                'INSERT OR REPLACE INTO accounts VALUES (?, ?, ?, ?)',
+                (account._id, self.book._id, account._version,
+                 json.dumps(account._as_dict())))
+        return 1
+
+    def _put_journal_entry(self, entry):
+        data = entry._as_dict()
+        # Lines are mirrored per account
+        data.pop('lines', None)
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO journal_entries VALUES (?, ?, ?, ?)',
+                (entry._id, self.book._id, entry.effective_at,
+                 json.dumps(data)))
+
+    def _put_line(self, line):
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO lines VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (line.id, self.book._id, line.account, line.journal_entry,
+                 line.effective_at, line.type, str(line.amount)))
+
+    def _watermark(self, name):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT id FROM watermarks WHERE book = ? AND name = ?',
+                (self.book._id, name)).fetchone()
+        return row and row[0]
+
+    def _set_watermark(self, name, id_):
+        if id_ is None:
+            return
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?, ?)',
+                (self.book._id, name, id_, time.time()))
+
+    def _commit(self):
+        with self._lock:
+            self._connection.commit()
+
+    # Offline access
+
+    def accounts(self):
+        """Yield the mirrored accounts as Account instances """
+        rows = self._query('SELECT data FROM accounts WHERE book = ?'
+                           ' ORDER BY id', (self.book._id,))
+        for (data,) in rows:
+            with using(current_client(self.book)):
+                account = Account._from_dict(json.loads(data))
+            yield account
+
+    def journal_entries(self, start=None, end=None):
+        """Yield the mirrored journal entries with their lines
+
+        Entries are ordered by effective date, optionally limited to
+        `start` <= effective_at < `end`, as Subledger timestamps.
+        """
+        sql = 'SELECT id, data FROM journal_entries WHERE book = ?'
+        args = [self.book._id]
+        if start is not None:
+            sql += ' AND effective_at >= ?'
+            args.append(start)
+        if end is not None:
+            sql += ' AND effective_at < ?'
+            args.append(end)
+        sql += ' ORDER BY effective_at, id'
+        for id_, data in self._query(sql, args):
+            data = json.loads(data)
+            data['lines'] = [line.to_dict()
+                             for line in self._lines('journal_entry', id_)]
+            with using(current_client(self.book)):
+                entry = JournalEntry._from_dict(data)
+            if entry._lines is None:
+                # Indexed before its lines were known
+                entry.lines = data['lines']
+                entry._mark_clean()
+            yield entry
+
+    def lines(self, account):
+        """Return the mirrored lines of `account` as AccountLine values,
+        ordered by effective date
+
+        `account` is an Account or account id.
+        """
+        return self._lines('account', getattr(account, '_id', account))
+
+    def load(self):
+        """Index all mirrored accounts and journal entries
+
+        from_id finds them afterwards without a request. Returns the number
+        of instances loaded.
+        """
+        return len(list(self.accounts())) + len(list(self.journal_entries()))
+
+    def _lines(self, column, id_):
+        rows = self._query(
+            'SELECT account, type, amount, id, journal_entry, effective_at'
+            ' FROM lines WHERE %s = ? ORDER BY effective_at, rowid' % column,
+            (id_,))
+        return [AccountLine(*row) for row in rows]
+
+    def _query(self, sql, args):
+        with self._lock:
+            return self._connection.execute(sql, args).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,487 @@
+"""\
+Local stand-in for the Subledger API
+
+FakeSubledger serves the endpoints used by the models from memory, so tests
+and benchmarks run without network access and give reproducible timings.
+`latency` adds a delay to every response to mimic the round trip to
+api.subledger.com.
+
+    server = FakeSubledger(latency=0.02).start()
+    SubledgerBase.set_access(server.access())
+    ...
+    server.stop()
+"""
+import BaseHTTPServer
+import SocketServer
+import itertools
+import json
+import re
+import threading
+import time
+import urlparse
+from decimal import Decimal
+
+from base import Access
+
+
+class NotFound(Exception):
+    pass
+
+
+class FakeSubledger(object):
+    """In-memory Subledger served over HTTP on localhost """
+
+    def __init__(self, latency=0, host='127.0.0.1', port=0,
+                 max_page_size=None):
+        """With `max_page_size` listings return at most that many items
+        per page, whatever limit is asked for
+        """
+        self.latency = latency
+        self.max_page_size = max_page_size
+        self.host = host
+        self.port = port
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.requests = 0
+        # Resources by id, in order of creation
+        self.orgs = {}
+        self.books = {}
+        self.accounts = {}
+        self.journal_entries = {}
+        # Lines per account id, as (effective_at, type, amount, line) where
+        # line is the listed representation
+        self.lines = {}
+        # Listed lines per journal entry id
+        self.journal_entry_lines = {}
+        # Responses for the next requests, see fail_next
+        self._failures = []
+        self._server = None
+        self._routes = [
+            ('POST', r'/identities', self.create_identity),
+            ('POST', r'/orgs', self.create_org),
+            ('GET', r'/orgs/(\w+)', self.get_org),
+            ('PATCH', r'/orgs/(\w+)', self.update_org),
+            ('POST', r'/orgs/(\w+)/(archive|activate)', self.set_org_state),
+            ('POST', r'/orgs/(\w+)/books', self.create_book),
+            ('GET', r'/orgs/(\w+)/books', self.list_books),
+            ('GET', r'/orgs/(\w+)/books/(\w+)', self.get_book),
+            ('PATCH', r'/orgs/(\w+)/books/(\w+)', self.update_book),
+            ('POST', r'/orgs/(\w+)/books/(\w+)/(archive|activate)',
+             self.set_book_state),
+            ('POST', r'/orgs/(\w+)/books/(\w+)/accounts', self.create_account),
+            ('GET', r'/orgs/(\w+)/books/(\w+)/accounts', self.list_accounts),
+            ('GET', r'/orgs/(\w+)/books/(\w+)/accounts/(\w+)',
+             self.get_account),
+            ('PATCH', r'/orgs/(\w+)/books/(\w+)/accounts/(\w+)',
+             self.update_account),
+            ('POST', r'/orgs/(\w+)/books/(\w+)/accounts/(\w+)/'
+             r'(archive|activate)', self.set_account_state),
+            ('GET', r'/orgs/(\w+)/books/(\w+)/accounts/(\w+)/balance',
+             self.get_balance),
+            ('GET', r'/orgs/(\w+)/books/(\w+)/accounts/(\w+)/lines',
+             self.list_lines),
+            ('POST', r'/orgs/(\w+)/books/(\w+)/journal_entries/'
+             r'create_and_post', self.create_and_post),
+            ('GET', r'/orgs/(\w+)/books/(\w+)/journal_entries',
+             self.list_journal_entries),
+            ('GET', r'/orgs/(\w+)/books/(\w+)/journal_entries/(\w+)',
+             self.get_journal_entry),
+            ('GET', r'/orgs/(\w+)/books/(\w+)/journal_entries/(\w+)/lines',
+             self.list_journal_entry_lines),
+        ]
+
+    # Server
+
+    def start(self):
+        """Serve in a background thread, returns self """
+        fake = self
+
+        class Handler(_Handler):
+            subledger = fake
+
+        self._server = _Server((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s/v1' % (self.host, self.port)
+
+    def access(self, **options):
+        """Return an Access instance that talks to this server """
+        access = Access('fake-key', 'fake-secret', **options)
+        access.api_url = self.url
+        return access
+
+    def fail_next(self, count=1, status=503, method=None, headers=None):
+        """Fail the next `count` requests, only those with `method` if
+        given
+
+        They get `status` with the extra `headers`. With status None the
+        connection is closed without a response.
+        """
+        with self.lock:
+            self._failures.extend([(method, status, headers or {})] * count)
+
+    def _take_failure(self, method):
+        with self.lock:
+            for i, failure in enumerate(self._failures):
+                if failure[0] in (None, method):
+                    return self._failures.pop(i)
+        return None
+
+    def handle(self, method, path, query, body):
+        """Return (status, response data, headers) for a request
+
+        Status None closes the connection without a response.
+        """
+        with self.lock:
+            self.requests += 1
+        failure = self._take_failure(method)
+        if failure is not None:
+            _, status, headers = failure
+            return status, {'exception': 'Injected failure'}, headers
+        if self.latency:
+            time.sleep(self.latency)
+        if path.startswith('/v1'):
+            path = path[3:]
+        path = path.rstrip('/')
+        if self.max_page_size is not None:
+            limit = int(query.get('limit') or self.max_page_size)
+            query['limit'] = str(min(limit, self.max_page_size))
+        for route_method, pattern, func in self._routes:
+            match = re.match(pattern + '$', path)
+            if route_method == method and match:
+                try:
+                    with self.lock:
+                        return 200, func(query, body, *match.groups()), {}
+                except NotFound:
+                    return 404, {'exception': 'Not Found'}, {}
+                except (KeyError, ValueError) as e:
+                    return 400, {'exception': repr(e)}, {}
+        return 404, {'exception': 'No route for %s %s' % (method, path)}, {}
+
+    # Data
+
+    def new_id(self):
+        return 'id%09d' % next(self.ids)
+
+    def seed(self, books=1, accounts=10, org_description='Fake Inc.'):
+        """Create an organization with books and accounts in memory
+
+        Returns the organization id.
+        """
+        with self.lock:
+            org = self.create_org(None, {'description': org_description})
+            org_id = org['active_org']['id']
+            for b in range(books):
+                book = self.create_book(
+                    None, {'description': 'Book %s' % b}, org_id)
+                book_id = book['active_book']['id']
+                for a in range(accounts):
+                    self.create_account(
+                        None, {'description': 'Account %06d' % a,
+                               'normal_balance': ('debit', 'credit')[a % 2]},
+                        org_id, book_id)
+        return org_id
+
+    def _create(self, store, body, **fields):
+        data = {'id': self.new_id(), 'version': 1, 'state': 'active',
+                'description': body['description'],
+                'reference': body.get('reference')}
+        data.update(fields)
+        store[data['id']] = data
+        return data
+
+    def _update(self, store, id_, body, kind):
+        data = self._lookup(store, id_)
+        if body.get('version') != data['version'] + 1:
+            raise ValueError('Version conflict')
+        for key, value in body.items():
+            if key not in ('id', 'state'):
+                data[key] = value
+        return self._wrap(data, kind)
+
+    def _lookup(self, store, id_):
+        if id_ not in store:
+            raise NotFound(id_)
+        return store[id_]
+
+    def _wrap(self, data, kind):
+        public = dict((k, v) for k, v in data.items() if k != 'state')
+        return {'%s_%s' % (data['state'], kind): public}
+
+    def _set_state(self, store, id_, action, kind):
+        data = self._lookup(store, id_)
+        data['state'] = {'archive': 'archived', 'activate': 'active'}[action]
+        return self._wrap(data, kind)
+
+    def _list(self, store, query, kind, **filters):
+        state = query.get('state', 'active')
+        items = [d for d in store.values() if d['state'] == state and
+                 all(d.get(k) == v for k, v in filters.items())]
+        items.sort(key=lambda d: d['id'])
+        if query.get('description'):
+            items = [d for d in items
+                     if d['description'].startswith(query['description'])]
+        items = _page(items, query)
+        public = [dict((k, v) for k, v in d.items() if k != 'state')
+                  for d in items]
+        return {'%s_%ss' % (state, kind): public}
+
+    # Handlers
+
+    def create_identity(self, query, body):
+        identity_id = self.new_id()
+        return {'active_identity': {'id': identity_id,
+                                    'email': body['email'],
+                                    'description': body['description'],
+                                    'reference': body.get('reference'),
+                                    'version': 1},
+                'active_key': {'id': self.new_id(),
+                               'identity': identity_id,
+                               'secret': self.new_id()}}
+
+    def create_org(self, query, body):
+        return self._wrap(self._create(self.orgs, body), 'org')
+
+    def get_org(self, query, body, org_id):
+        return self._wrap(self._lookup(self.orgs, org_id), 'org')
+
+    def update_org(self, query, body, org_id):
+        return self._update(self.orgs, org_id, body, 'org')
+
+    def set_org_state(self, query, body, org_id, action):
+        return self._set_state(self.orgs, org_id, action, 'org')
+
+    def create_book(self, query, body, org_id):
+        self._lookup(self.orgs, org_id)
+        return self._wrap(self._create(self.books, body, org=org_id), 'book')
+
+    def list_books(self, query, body, org_id):
+        return self._list(self.books, query, 'book', org=org_id)
+
+    def get_book(self, query, body, org_id, book_id):
+        return self._wrap(self._lookup(self.books, book_id), 'book')
+
+    def update_book(self, query, body, org_id, book_id):
+        return self._update(self.books, book_id, body, 'book')
+
+    def set_book_state(self, query, body, org_id, book_id, action):
+        return self._set_state(self.books, book_id, action, 'book')
+
+    def create_account(self, query, body, org_id, book_id):
+        self._lookup(self.books, book_id)
+        account = self._create(self.accounts, body, book=book_id,
+                               normal_balance=body['normal_balance'])
+        self.lines[account['id']] = []
+        return self._wrap(account, 'account')
+
+    def list_accounts(self, query, body, org_id, book_id):
+        return self._list(self.accounts, query, 'account', book=book_id)
+
+    def get_account(self, query, body, org_id, book_id, account_id):
+        return self._wrap(self._lookup(self.accounts, account_id), 'account')
+
+    def update_account(self, query, body, org_id, book_id, account_id):
+        return self._update(self.accounts, account_id, body, 'account')
+
+    def set_account_state(self, query, body, org_id, book_id, account_id,
+                          action):
+        return self._set_state(self.accounts, account_id, action, 'account')
+
+    def get_balance(self, query, body, org_id, book_id, account_id):
+        self._lookup(self.accounts, account_id)
+        at = query['at']
+        debit = credit = Decimal(0)
+        for effective_at, type_, amount, _ in self.lines[account_id]:
+            if effective_at[:19] <= at[:19]:
+                if type_ == 'debit':
+                    debit += amount
+                else:
+                    credit += amount
+        if debit > credit:
+            value = _value('debit', debit - credit)
+        else:
+            value = _value('credit', credit - debit)
+        return {'balance': {'debit_value': _value('debit', debit),
+                            'credit_value': _value('credit', credit),
+                            'value': value}}
+
+    def create_and_post(self, query, body, org_id, book_id):
+        self._lookup(self.books, book_id)
+        debit = credit = Decimal(0)
+        for line in body['lines']:
+            self._lookup(self.accounts, line['account'])
+            amount = Decimal(line['value']['amount'])
+            if line['value']['type'] == 'debit':
+                debit += amount
+            else:
+                credit += amount
+        if debit != credit:
+            raise ValueError('Journal entry is not balanced')
+        entry = self._create(self.journal_entries, body, book=book_id,
+                             effective_at=body['effective_at'],
+                             lines=body['lines'])
+        entry['state'] = 'posted'
+        for order, line in enumerate(body['lines']):
+            listed = {'id': self.new_id(), 'version': 1, 'order': order,
+                      'journal_entry': entry['id'],
+                      'account': line['account'],
+                      'effective_at': body['effective_at'],
+                      'description': body['description'],
+                      'reference': body.get('reference'),
+                      'value': line['value']}
+            self.lines[line['account']].append(
+                (body['effective_at'], line['value']['type'],
+                 Decimal(line['value']['amount']), listed))
+            self.journal_entry_lines.setdefault(entry['id'], []).append(
+                listed)
+        return self._wrap(entry, 'journal_entry')
+
+    def get_journal_entry(self, query, body, org_id, book_id, entry_id):
+        entry = self._lookup(self.journal_entries, entry_id)
+        data = self._wrap(entry, 'journal_entry')
+        data.values()[0].pop('lines')
+        return data
+
+    def list_journal_entries(self, query, body, org_id, book_id):
+        state = query.get('state', 'posted')
+        entries = [dict((k, v) for k, v in d.items()
+                        if k not in ('state', 'lines'))
+                   for d in self.journal_entries.values()
+                   if d['book'] == book_id and d['state'] == state]
+        return {'%s_journal_entries' % state: _dated_page(entries, query)}
+
+    def list_journal_entry_lines(self, query, body, org_id, book_id,
+                                 entry_id):
+        self._lookup(self.journal_entries, entry_id)
+        state = query.get('state', 'posted')
+        lines = self.journal_entry_lines.get(entry_id, [])
+        return {'%s_lines' % state: _page(lines, query)}
+
+    def list_lines(self, query, body, org_id, book_id, account_id):
+        self._lookup(self.accounts, account_id)
+        state = query.get('state', 'posted')
+        lines = [line for _, _, _, line in self.lines[account_id]]
+        return {'%s_lines' % state: _dated_page(lines, query)}
+
+
+def _value(type_, amount):
+    if not amount:
+        type_ = 'zero'
+    return {'type': type_, 'amount': str(amount)}
+
+
+def _dated_page(items, query):
+    """Page `items` ordered by effective date, as Subledger does for
+    journal entries and lines
+
+    The cursor is the `id` of an item or, without one, `effective_at`.
+    """
+    items = sorted(items, key=lambda d: (d['effective_at'], d['id']))
+    if query.get('id') is not None:
+        by_id = dict((d['id'], d) for d in items)
+        cursor = by_id[query['id']]
+        cursor = (cursor['effective_at'], cursor['id'])
+    elif query.get('effective_at') is not None:
+        cursor = (query['effective_at'], '')
+    else:
+        cursor = None
+    return _page(items, query, [(d['effective_at'], d['id']) for d in items],
+                 cursor)
+
+
+def _page(items, query, keys=None, cursor=None):
+    """Apply Subledger's cursor parameters to the sorted `items`
+
+    `keys` are the sort keys of `items`, their ids by default, and `cursor`
+    the key to page from, by default the `id` parameter.
+    """
+    action = query.get('action', 'starting')
+    limit = int(query.get('limit') or 25)
+    if keys is None:
+        keys = [d['id'] for d in items]
+        cursor = query.get('id')
+    if cursor is None:
+        position = 0 if action in ('starting', 'following') else len(keys)
+    else:
+        position = _bisect(keys, cursor)
+    if action == 'starting':
+        return items[position:position + limit]
+    if action == 'following':
+        if position < len(keys) and keys[position] == cursor:
+            position += 1
+        return items[position:position + limit]
+    if action == 'ending':
+        if position < len(keys) and keys[position] == cursor:
+            position += 1
+        return items[max(position - limit, 0):position]
+    if action in ('before', 'preceding'):
+        return items[max(position - limit, 0):position]
+    raise ValueError('Unknown action %s' % action)
+
+
+def _bisect(keys, key):
+    low, high = 0, len(keys)
+    while low < high:
+        middle = (low + high) // 2
+        if keys[middle] < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one packet, small writes stall on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    subledger = None
+
+    def _respond(self, method):
+        parsed = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(parsed.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        status, data, headers = self.subledger.handle(
+            method, parsed.path, query, body)
+        if status is None:
+            self.close_connection = 1
+            return
+        content = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_POST(self):
+        self._respond('POST')
+
+    def do_PATCH(self):
+        self._respond('PATCH')
+
+    def log_message(self, format, *args):
+        pass
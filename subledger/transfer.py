@@ -0,0 +1,592 @@
+"""\
+Streaming export and import of a Book as NDJSON or CSV
+
+BookExporter writes the accounts and journal entries of a book to a file and
+BookImporter recreates them in another book, for migrations and backups. Both
+stream: records are read, converted and written one at a time through
+generators over the paginated listings, so memory use does not grow with the
+size of the book. The lines of exported journal entries are listed per entry
+from a fixed number of threads, imported journal entries are posted
+concurrently with a posting.JournalEntryWriter.
+
+A file holds the accounts first, then the journal entries by effective date.
+In NDJSON every record is a JSON object on a line of its own:
+
+    {"kind":"account","id":"...","state":"active","description":"Cash",
+     "reference":null,"normal_balance":"debit"}
+    {"kind":"journal_entry","id":"...","description":"Sale",
+     "reference":null,"effective_at":"2014-01-31T00:00:00Z",
+     "lines":[{"account":"...","value":{"type":"debit","amount":"10"}}, ...]}
+
+In CSV a journal entry takes a row for each of its lines, see CSV_FIELDS.
+
+With a `checkpoint` path progress is saved to that file as the transfer goes,
+an interrupted export or import started again with the same checkpoint
+continues where it stopped. The checkpoint is removed once the transfer is
+complete.
+"""
+import collections
+import csv
+import json
+import os
+import sys
+import time
+
+from base import current_client, using
+from models import Account, JournalEntry, Line
+from posting import JournalEntryWriter
+from serializers import get_serializer
+from workers import WorkerPool, as_completed, DEFAULT_MAX_WORKERS
+
+CSV_FIELDS = ('kind', 'id', 'state', 'description', 'reference',
+              'normal_balance', 'effective_at', 'account', 'type', 'amount')
+FORMATS = ('ndjson', 'csv')
+
+
+def guess_format(path):
+    """Return 'csv' for a .csv file, 'ndjson' otherwise """
+    return 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+
+def write_ndjson(records, fileobj, serializer=None):
+    """Write each record as a JSON line, yield the records as written """
+    serializer = serializer or get_serializer()
+    for record in records:
+        fileobj.write(serializer.dumps(record) + '\n')
+        yield record
+
+
+def read_ndjson(fileobj, serializer=None):
+    """Yield the records of an NDJSON file """
+    serializer = serializer or get_serializer()
+    for line in fileobj:
+        if line.strip():
+            yield serializer.loads(line)
+
+
+def write_csv(records, fileobj):
+    """Write records as CSV rows, yield the records as written """
+    writer = csv.writer(fileobj)
+    if fileobj.tell() == 0:
+        writer.writerow(CSV_FIELDS)
+    for record in records:
+        writer.writerows(_csv_rows(record))
+        yield record
+
+
+def read_csv(fileobj):
+    """Yield the records of a CSV file
+
+    The rows of a journal entry are joined into one record.
+    """
+    rows = csv.reader(fileobj)
+    header = next(rows, None)
+    entry = None
+    for row in rows:
+        row = dict((name, value.decode('utf-8') if value else None)
+                   for name, value in zip(header, row))
+        line = {'account': row['account'],
+                'value': {'type': row['type'], 'amount': row['amount']}}
+        if entry is not None and row['kind'] == 'journal_entry' and \
+                row['id'] == entry['id']:
+            entry['lines'].append(line)
+            continue
+        if entry is not None:
+            yield entry
+            entry = None
+        if row['kind'] == 'journal_entry':
+            entry = {'kind': 'journal_entry', 'id': row['id'],
+                     'description': row['description'],
+                     'reference': row['reference'],
+                     'effective_at': row['effective_at'],
+                     'lines': [line]}
+        else:
+            yield {'kind': 'account', 'id': row['id'],
+                   'state': row['state'],
+                   'description': row['description'],
+                   'reference': row['reference'],
+                   'normal_balance': row['normal_balance']}
+    if entry is not None:
+        yield entry
+
+
+def _csv_rows(record):
+    def encode(value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+    if record['kind'] == 'account':
+        return [[encode(record.get(name)) for name in CSV_FIELDS]]
+    rows = []
+    for line in record['lines']:
+        values = dict(record, account=line['account'],
+                      type=line['value']['type'],
+                      amount=line['value']['amount'])
+        rows.append([encode(values.get(name)) for name in CSV_FIELDS])
+    return rows
+
+
+class _Transfer(object):
+    """Counters, throughput reporting and checkpoints of a transfer """
+
+    def __init__(self, checkpoint=None, checkpoint_every=1000,
+                 progress=None, report_every=1000):
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.progress = progress
+        self.report_every = report_every
+        self.counts = dict((name, 0) for name in self._counted)
+        self.started_at = None
+        self.finished_at = None
+
+    def stats(self):
+        """Return the counters, elapsed seconds and records per second """
+        end = self.finished_at or time.time()
+        elapsed = end - self.started_at if self.started_at else 0.0
+        stats = dict(self.counts)
+        stats['seconds'] = elapsed
+        stats['records_per_second'] = \
+            stats['records'] / elapsed if elapsed else 0.0
+        return stats
+
+    def _count(self, name, n=1):
+        self.counts[name] += n
+        if name == 'records' and self.progress is not None and \
+                self.counts['records'] % self.report_every == 0:
+            self.progress(self.stats())
+
+    def _load_checkpoint(self):
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint) as f:
+            return json.load(f)
+
+    def _save_checkpoint(self, state):
+        if self.checkpoint is None:
+            return
+        # Replace the previous checkpoint only when the new one is complete
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.checkpoint)
+
+    def _remove_checkpoint(self):
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+
+class BookExporter(_Transfer):
+    """Write the accounts and journal entries of `book` to a file
+
+    `limit` sets the page size of the listings. The lines of `max_workers`
+    journal entries are listed at once. `progress` is called with stats()
+    every `report_every` records.
+    """
+    _counted = ('records', 'accounts', 'journal_entries', 'lines')
+
+    def __init__(self, book, limit=None, max_workers=DEFAULT_MAX_WORKERS,
+                 **options):
+        super(BookExporter, self).__init__(**options)
+        self.book = book
+        self.limit = limit
+        self.max_workers = max_workers
+
+    def export(self, path, format=None):
+        """Write the book to `path` as 'ndjson' or 'csv', guessed from the
+        extension by default, returns stats()
+        """
+        format = format or guess_format(path)
+        if format not in FORMATS:
+            raise ValueError('Unknown format %r' % (format,))
+        state = self._load_checkpoint()
+        self.started_at = time.time()
+        self.finished_at = None
+        if state is None:
+            fileobj = open(path, 'wb')
+        else:
+            # Drop what was written after the checkpoint
+            fileobj = open(path, 'r+b')
+            fileobj.truncate(state['offset'])
+            fileobj.seek(state['offset'])
+            self.counts.update(state['counts'])
+        try:
+            if state is None:
+                records = (self._account_record(account, state_)
+                           for account, state_ in self._accounts())
+                self._write(records, fileobj, format, None)
+                state = {'journal_entry': None}
+                self._checkpoint(fileobj, state)
+            records = self.journal_entry_records(state['journal_entry'])
+            self._write(records, fileobj, format, state)
+            fileobj.flush()
+        finally:
+            fileobj.close()
+            self.finished_at = time.time()
+        self._remove_checkpoint()
+        return self.stats()
+
+    def records(self):
+        """Yield all records of the book, accounts first """
+        for account, state in self._accounts():
+            yield self._account_record(account, state)
+        for record in self.journal_entry_records():
+            yield record
+
+    def journal_entry_records(self, after=None):
+        """Yield the journal entries of the book with their lines
+
+        The lines of each entry are listed from `max_workers` threads, at
+        most twice that many entries ahead of the one yielded. With `after`,
+        the id of an entry, the entries following it are yielded.
+        """
+        if after is None:
+            entries = JournalEntry.all(self.book, limit=self.limit)
+        else:
+            entries = JournalEntry.all(self.book, action='following',
+                                       id_=after, limit=self.limit)
+        pool = WorkerPool(self.max_workers)
+        pending = collections.deque()
+        finished = False
+        try:
+            for entry in entries:
+                pending.append((entry, pool.submit(self._entry_lines, entry)))
+                if len(pending) > 2 * self.max_workers:
+                    yield self._entry_record(*pending.popleft())
+            while pending:
+                yield self._entry_record(*pending.popleft())
+            finished = True
+        finally:
+            # Only wait for the workers when no listing is left running
+            pool.shutdown(wait=finished)
+
+    def _entry_lines(self, entry):
+        return list(entry.iter_lines(limit=self.limit, prefetch=False))
+
+    def _entry_record(self, entry, lines):
+        return {'kind': 'journal_entry', 'id': entry._id,
+                'description': entry.description,
+                'reference': entry.reference,
+                'effective_at': entry.effective_at,
+                'lines': [line.to_dict() for line in lines.result()]}
+
+    def _accounts(self):
+        for state in ('active', 'archived'):
+            for account in Account.all(self.book, state=state,
+                                       limit=self.limit):
+                yield account, state
+
+    def _account_record(self, account, state):
+        return {'kind': 'account', 'id': account._id, 'state': state,
+                'description': account.description,
+                'reference': account.reference,
+                'normal_balance': account.normal_balance}
+
+    def _write(self, records, fileobj, format, state):
+        if format == 'csv':
+            written = write_csv(records, fileobj)
+        else:
+            written = write_ndjson(records, fileobj)
+        for record in written:
+            self._count('records')
+            if record['kind'] == 'account':
+                self._count('accounts')
+                continue
+            self._count('journal_entries')
+            self._count('lines', len(record['lines']))
+            state['journal_entry'] = record['id']
+            if self.counts['journal_entries'] % self.checkpoint_every == 0:
+                self._checkpoint(fileobj, state)
+
+    def _checkpoint(self, fileobj, state):
+        if self.checkpoint is None:
+            return
+        fileobj.flush()
+        os.fsync(fileobj.fileno())
+        self._save_checkpoint(dict(state, offset=fileobj.tell(),
+                                   counts=self.counts))
+
+
+class BookImporter(_Transfer):
+    """Create the accounts and post the journal entries of a file in `book`
+
+    Account ids of the file are mapped to the ids of the accounts created
+    for them. `max_workers` journal entries are posted at once, entries
+    sharing an account in file order. `progress` is called with stats()
+    every `report_every` records.
+
+    Entries that fail to post, or with a malformed line type or amount, are
+    listed in `errors` as (position, reference, error) and the import goes
+    on. Starting the import again with the same checkpoint retries those
+    and the entries not read yet.
+
+    Every account created and entry posted is appended to a journal next to
+    the checkpoint, `checkpoint` + '.log', as soon as Subledger confirms it.
+    The checkpoint itself, which is fsynced, replaces the journal every
+    `checkpoint_every` records. After the importing process is killed only
+    the requests that were in flight may be sent again: at most
+    `max_workers` accounts or 2 * `max_workers` journal entries. After a
+    power loss that includes the records journaled since the last
+    checkpoint. Post entries with references through wal.WriteAheadLog
+    when no entry may ever be posted twice.
+
+    A record out of place or with a line on an account not in the file
+    stops the import with a ValueError. import_ checks the whole file
+    before anything is created, load stops reading at that record and
+    raises once the entries already posting are done.
+    """
+    _counted = ('records', 'accounts', 'journal_entries', 'lines',
+                'failed')
+
+    def __init__(self, book, max_workers=DEFAULT_MAX_WORKERS, **options):
+        super(BookImporter, self).__init__(**options)
+        self.book = book
+        self.max_workers = max_workers
+        self.errors = []
+        # Ids of the file mapped to ids in the book
+        self.accounts = {}
+        # Records before the watermark and those in done were completed
+        self._watermark = 0
+        self._done = set()
+        # Completed records since the last checkpoint, see _journal_path
+        self._journal = None
+
+    def import_(self, path, format=None):
+        """Read `path` as 'ndjson' or 'csv', guessed from the extension by
+        default, returns stats()
+        """
+        format = format or guess_format(path)
+        if format not in FORMATS:
+            raise ValueError('Unknown format %r' % (format,))
+        with open(path, 'rb') as fileobj:
+            self.check(_read(fileobj, format))
+        with open(path, 'rb') as fileobj:
+            return self.load(_read(fileobj, format))
+
+    def check(self, records):
+        """Raise ValueError for the first record of `records` that cannot
+        be imported, without sending a request
+        """
+        accounts = set(self.accounts)
+        records = enumerate(records)
+        for position, record in records:
+            if record['kind'] != 'account':
+                break
+            accounts.add(record['id'])
+        else:
+            return
+        for position, record in _chain((position, record), records):
+            self._check_entry(position, record, accounts)
+
+    def load(self, records):
+        """Create the accounts and post the journal entries of `records`,
+        returns stats()
+        """
+        state = self._load_checkpoint() or {'position': 0, 'done': [],
+                                            'accounts': {}}
+        self.accounts.update(state['accounts'])
+        self._watermark = state['position']
+        self._done = set(state['done'])
+        self._replay_journal()
+        if self.checkpoint is not None:
+            self._journal = open(self._journal_path, 'ab')
+        self.errors = []
+        self.started_at = time.time()
+        self.finished_at = None
+        try:
+            records = enumerate(records)
+            first = self._create_accounts(records)
+            self._checkpoint()
+            if first is not None:
+                self._post(first, records)
+        finally:
+            self.finished_at = time.time()
+            self._checkpoint()
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+        if not self.errors:
+            self._remove_checkpoint()
+        return self.stats()
+
+    def _create_accounts(self, records):
+        """Create the accounts at the start of `records`, return the first
+        (position, record) after them
+        """
+        pending = []
+        first = None
+        for position, record in records:
+            if record['kind'] != 'account':
+                first = position, record
+                break
+            if record['id'] in self.accounts:
+                self._complete(position)
+            else:
+                pending.append((position, record))
+        pool = WorkerPool(self.max_workers)
+        error = None
+        try:
+            futures = dict((pool.submit(self._create_account, record),
+                            (position, record))
+                           for position, record in pending)
+            # Record every account as it is created, also before raising for
+            # a failed one, so it is not created again on resume
+            for future in as_completed(futures):
+                position, record = futures[future]
+                if future.exception() is not None:
+                    error = error or future
+                    continue
+                self._complete(position, (record['id'], future.result()))
+                self._count('records')
+                self._count('accounts')
+        finally:
+            pool.shutdown()
+        if error is not None:
+            error.result()
+        return first
+
+    def _create_account(self, record):
+        with using(current_client(self.book)):
+            account = Account(self.book, record['description'],
+                              record['normal_balance'], record['reference'])
+            account.save()
+            if record['state'] == 'archived':
+                account.archive()
+        return account._id
+
+    def _post(self, first, records):
+        positions = {}
+        invalid = []
+
+        def entries():
+            for position, record in _chain(first, records):
+                if position < self._watermark or position in self._done:
+                    continue
+                try:
+                    self._check_entry(position, record, self.accounts)
+                except ValueError:
+                    # Raised below, once the entries posting are recorded
+                    invalid.append(sys.exc_info())
+                    return
+                try:
+                    entry = self._journal_entry(record)
+                except ValueError as e:
+                    # A malformed line fails its entry only, like a refused
+                    # post
+                    self.errors.append((position, record.get('reference'),
+                                        e))
+                    self._count('records')
+                    self._count('failed')
+                    continue
+                positions[id(entry)] = position
+                yield entry
+
+        writer = JournalEntryWriter(max_workers=self.max_workers)
+        for result in writer.post(entries()):
+            position = positions.pop(id(result.entry))
+            if result.ok:
+                self._complete(position)
+                self._count('journal_entries')
+                self._count('lines', len(result.entry.line_items))
+            else:
+                self.errors.append((position, result.entry.reference,
+                                    result.error))
+                self._count('failed')
+            # Counted last, the progress callback sees the entry journaled
+            self._count('records')
+            if self.counts['records'] % self.checkpoint_every == 0:
+                self._checkpoint()
+        if invalid:
+            raise invalid[0][0], invalid[0][1], invalid[0][2]
+
+    def _check_entry(self, position, record, accounts):
+        if record['kind'] != 'journal_entry':
+            raise ValueError('Record %s: %s after the journal entries'
+                             % (position, record['kind']))
+        for line in record['lines']:
+            if line['account'] not in accounts:
+                raise ValueError('Record %s: unknown account %s'
+                                 % (position, line['account']))
+
+    def _journal_entry(self, record):
+        lines = [Line(self.accounts[line['account']], line['value']['type'],
+                      line['value']['amount'])
+                 for line in record['lines']]
+        with using(current_client(self.book)):
+            return JournalEntry(self.book, record['description'],
+                                record['effective_at'], lines,
+                                record.get('reference'))
+
+    def _complete(self, position, account=None):
+        """Mark the record at `position` done, with `account` as (id in
+        the file, id in the book) for an account record
+        """
+        if account is not None:
+            self.accounts[account[0]] = account[1]
+        if self._journal is not None:
+            entry = {'position': position}
+            if account is not None:
+                entry['account'] = account
+            self._journal.write(json.dumps(entry) + '\n')
+            # Left to the OS, it survives the process
+            self._journal.flush()
+        self._done.add(position)
+        while self._watermark in self._done:
+            self._done.remove(self._watermark)
+            self._watermark += 1
+
+    @property
+    def _journal_path(self):
+        return self.checkpoint + '.log'
+
+    def _replay_journal(self):
+        if self.checkpoint is None or not os.path.exists(self._journal_path):
+            return
+        with open(self._journal_path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn by a crash while it was written
+                    break
+                if 'account' in entry:
+                    self.accounts[entry['account'][0]] = entry['account'][1]
+                if entry['position'] >= self._watermark:
+                    self._complete(entry['position'])
+
+    def _checkpoint(self):
+        self._save_checkpoint({'position': self._watermark,
+                               'done': sorted(self._done),
+                               'accounts': self.accounts})
+        if self._journal is not None:
+            # Everything journaled so far is in the checkpoint
+            self._journal.close()
+            self._journal = open(self._journal_path, 'wb')
+
+    def _remove_checkpoint(self):
+        super(BookImporter, self)._remove_checkpoint()
+        if self.checkpoint is not None and os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+
+
+def _read(fileobj, format):
+    if format == 'csv':
+        return read_csv(fileobj)
+    return read_ndjson(fileobj)
+
+
+def _chain(first, rest):
+    yield first
+    for item in rest:
+        yield item
+
+
+def export_book(book, path, format=None, **options):
+    """Write `book` to `path`, see BookExporter """
+    return BookExporter(book, **options).export(path, format)
+
+
+def import_book(book, path, format=None, **options):
+    """Read `path` into `book`, see BookImporter """
+    return BookImporter(book, **options).import_(path, format)
@@ -0,0 +1,171 @@
+"""\
+Validation of journal entries before they are posted
+
+Subledger rejects an unbalanced or malformed journal entry only after a
+create_and_post request. JournalEntryValidator checks entries locally, with
+exact Decimal arithmetic, so a batch of thousands of entries is checked
+before any request is sent and all failures are reported at once.
+"""
+import datetime
+import re
+from decimal import Decimal
+
+# Subledger timestamps at UTC, with optional fractions of a second
+EFFECTIVE_AT = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.\d{1,6})?Z$')
+ZERO = Decimal(0)
+
+
+class ValidationError(ValueError):
+    """Journal entries that failed validation
+
+    `errors` is a list of (index, entry, messages) for every invalid entry,
+    with its position in the batch and a list of what is wrong with it.
+    `entry` is None when the entry could not be built, see
+    JournalEntryValidator.build.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        count = len(errors)
+        message = '%s invalid journal %s' % (
+            count, 'entry' if count == 1 else 'entries')
+        if errors:
+            index, _, messages = errors[0]
+            message += ', entry %s: %s' % (index, '; '.join(messages))
+        super(ValidationError, self).__init__(message)
+
+
+def effective_at_error(value):
+    """Return what is wrong with an effective_at value, None if it is valid
+    """
+    if not isinstance(value, basestring):
+        return 'effective_at must be a string, not %s' % type(value).__name__
+    match = EFFECTIVE_AT.match(value)
+    if match is None:
+        return 'effective_at %r is not like 2014-01-31T00:00:00Z' % (value,)
+    try:
+        datetime.datetime(*[int(part) for part in match.groups()])
+    except ValueError as e:
+        return 'effective_at %r is not a valid date: %s' % (value, e)
+    return None
+
+
+class JournalEntryValidator(object):
+    """Check journal entries without contacting Subledger
+
+    An entry is valid when its effective_at is a Subledger timestamp, it
+    has lines, every amount is a finite, non-negative Decimal, debits equal
+    credits and every account is known. Known accounts are the Accounts or
+    account ids given as `accounts`, or by default the active accounts of
+    the entry's book in the instance index. With `check_accounts` False the
+    accounts are not checked.
+    """
+
+    def __init__(self, accounts=None, check_accounts=True):
+        self.check_accounts = check_accounts
+        self.accounts = None
+        if accounts is not None:
+            self.accounts = set(getattr(a, '_id', a) for a in accounts)
+        # Accounts looked up in the instance index, by id
+        self._indexed = {}
+        # Checked effective_at values, entries of a batch often share them
+        self._effective_ats = {}
+
+    def errors(self, entry):
+        """Return a list of what is wrong with `entry`, empty when valid """
+        errors = []
+        try:
+            error = self._effective_ats[entry.effective_at]
+        except (KeyError, TypeError):
+            error = effective_at_error(entry.effective_at)
+            if isinstance(entry.effective_at, basestring):
+                self._effective_ats[entry.effective_at] = error
+        if error is not None:
+            errors.append(error)
+        lines = entry.line_items
+        if not lines:
+            errors.append('journal entry has no lines')
+        debit = credit = ZERO
+        for i, line in enumerate(lines):
+            amount = line.amount
+            if not amount.is_finite():
+                errors.append('line %s: amount %s is not finite'
+                              % (i, amount))
+                continue
+            if amount < ZERO:
+                errors.append('line %s: amount %s is negative' % (i, amount))
+            if line.debit:
+                debit += amount
+            else:
+                credit += amount
+            if self.check_accounts:
+                error = self._account_error(entry, line.account)
+                if error is not None:
+                    errors.append('line %s: %s' % (i, error))
+        if debit != credit:
+            errors.append('debits %s do not equal credits %s'
+                          % (debit, credit))
+        return errors
+
+    def iter_errors(self, entries):
+        """Yield (index, entry, messages) for every invalid entry """
+        for index, entry in enumerate(entries):
+            messages = self.errors(entry)
+            if messages:
+                yield index, entry, messages
+
+    def validate(self, entries):
+        """Check all `entries`, raise ValidationError listing every invalid
+        entry
+
+        Returns the entries as a list.
+        """
+        entries = list(entries)
+        errors = list(self.iter_errors(entries))
+        if errors:
+            raise ValidationError(errors)
+        return entries
+
+    def build(self, records, make_entry):
+        """Return make_entry(record) for each of `records`, all checked
+
+        Line and JournalEntry raise ValueError for a malformed line type or
+        amount as soon as they are built. Such errors are reported with the
+        index of the record in the ValidationError, together with those of
+        the entries that could be built.
+        """
+        entries = []
+        errors = []
+        for index, record in enumerate(records):
+            try:
+                entry = make_entry(record)
+            except ValueError as e:
+                errors.append((index, None, [str(e)]))
+                continue
+            entries.append(entry)
+            messages = self.errors(entry)
+            if messages:
+                errors.append((index, entry, messages))
+        if errors:
+            raise ValidationError(errors)
+        return entries
+
+    def _account_error(self, entry, account_id):
+        if self.accounts is not None:
+            if account_id not in self.accounts:
+                return 'unknown account %s' % (account_id,)
+            return None
+        account = self._indexed.get(account_id)
+        if account is None:
+            from models import Account
+            account = entry._instance_index.get(account_id)
+            if not isinstance(account, Account):
+                return 'unknown account %s' % (account_id,)
+            self._indexed[account_id] = account
+        if account._book_id != entry._book_id:
+            return 'account %s is not in book %s' % (account_id,
+                                                     entry._book_id)
+        if not account.is_active:
+            return 'account %s is archived' % (account_id,)
+        return None
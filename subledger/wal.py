@@ -0,0 +1,246 @@
+"""\
+Write-ahead log for posting journal entries exactly once
+
+A worker that dies while posting a batch leaves no record of which
+create_and_post requests Subledger accepted. WriteAheadLog appends the intent
+to post each entry to a local file before the entry is sent, and its outcome
+once Subledger responds. The `reference` of an entry is its idempotency key:
+an entry whose reference was posted before is not posted again.
+
+After a crash the entries with an intent but no outcome are pending. Before
+posting anything else the log reconciles them: the journal entries of their
+books are listed from the earliest pending effective date on and matched by
+reference. Entries found are recorded as posted, the others are posted again
+when the batch is run again. Only that part of a book is read, not the
+entries posted before it.
+
+    with WriteAheadLog('postings.wal') as log:
+        for result in log.post(entries):
+            ...
+
+References must be unique within a book for this to work.
+"""
+import os
+import threading
+
+from base import Dummy
+from models import JournalEntry
+from posting import JournalEntryWriter
+from serializers import get_serializer
+
+# When to fsync the log: after every record, after every intent only (an
+# outcome lost in a crash is reconciled), or never (left to the OS)
+FSYNC_MODES = ('always', 'intents', 'never')
+# Journal entry states listed to reconcile pending entries
+RECONCILE_STATES = ('posted', 'posting')
+
+
+def is_refused(error):
+    """Return True when `error` shows Subledger did not accept the request
+
+    Access raises ValueError(status, text) for responses it gives up on. A
+    client error (4xx) was refused, but after a connection error, timeout or
+    server error the entry may have been posted all the same.
+    """
+    return isinstance(error, ValueError) and bool(error.args) and \
+        isinstance(error.args[0], int) and 400 <= error.args[0] < 500
+
+
+class WriteAheadLog(object):
+    """Append-only log of the journal entries posted from this process
+
+    `path` is the log file, created when missing and replayed when it
+    exists. `fsync` is one of FSYNC_MODES. `options` are passed to the
+    posting.JournalEntryWriter that posts the entries.
+    """
+
+    def __init__(self, path, fsync='intents', serializer=None, **options):
+        if fsync not in FSYNC_MODES:
+            raise ValueError('fsync must be one of %s, not %r'
+                             % (', '.join(FSYNC_MODES), fsync))
+        self.path = path
+        self.fsync = fsync
+        self.options = options
+        self.serializer = serializer or get_serializer()
+        self._lock = threading.Lock()
+        # Ids of the posted entries by reference
+        self._posted = {}
+        # Intents without an outcome by reference
+        self._pending = {}
+        self.counts = {'posted': 0, 'failed': 0, 'skipped': 0,
+                       'reconciled': 0}
+        self._replay()
+        self._file = open(path, 'ab')
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r+b') as f:
+            offset = 0
+            for line in iter(f.readline, ''):
+                try:
+                    record = self.serializer.loads(line)
+                except ValueError:
+                    # Only the last record can be torn by a crash
+                    if f.readline():
+                        raise
+                    f.truncate(offset)
+                    break
+                offset += len(line)
+                self._apply(record)
+
+    def _apply(self, record):
+        reference = record['reference']
+        op = record['op']
+        if op == 'intent':
+            self._pending[reference] = record
+        elif op == 'posted':
+            self._pending.pop(reference, None)
+            self._posted[reference] = record['id']
+        elif op == 'failed':
+            self._pending.pop(reference, None)
+        else:
+            raise ValueError('Unknown log record %r' % (op,))
+
+    def _append(self, record, sync):
+        line = self.serializer.dumps(record) + '\n'
+        with self._lock:
+            self._apply(record)
+            self._file.write(line)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    @property
+    def pending(self):
+        """References of the entries with an unknown outcome """
+        return sorted(self._pending)
+
+    def posted_id(self, reference):
+        """Return the id of the entry posted with `reference`, or None """
+        return self._posted.get(reference)
+
+    def recover(self):
+        """Reconcile the pending entries with Subledger
+
+        Returns the number of pending entries found posted.
+        """
+        books = {}
+        for intent in self._pending.values():
+            books.setdefault((intent['org'], intent['book']), []).append(
+                intent)
+        found = 0
+        for (org_id, book_id), intents in books.items():
+            found += self._reconcile(org_id, book_id, intents)
+        return found
+
+    def _reconcile(self, org_id, book_id, intents):
+        book = Dummy()
+        book._id, book._org_id = book_id, org_id
+        references = set(intent['reference'] for intent in intents)
+        start = min(intent['effective_at'] for intent in intents)
+        found = 0
+        for state in RECONCILE_STATES:
+            for entry in JournalEntry.all(book, state=state,
+                                          effective_at=start):
+                if entry.reference in references:
+                    references.remove(entry.reference)
+                    self._append({'op': 'posted', 'reference':
+                                  entry.reference, 'id': entry._id},
+                                  self.fsync == 'always')
+                    found += 1
+                    if not references:
+                        break
+            if not references:
+                break
+        for reference in references:
+            self._append({'op': 'failed', 'reference': reference,
+                          'error': 'not found in Subledger'},
+                         self.fsync == 'always')
+        self.counts['reconciled'] += found
+        return found
+
+    def post(self, entries):
+        """Post the `entries` not posted before, yield a PostResult for
+        each entry posted
+
+        Pending entries are reconciled first. An entry whose outcome stays
+        unknown, after a connection error or server error, remains pending
+        until the next post or recover.
+        """
+        if self._pending:
+            self.recover()
+        writer = JournalEntryWriter(**self.options)
+        for result in writer.post(self._intents(entries)):
+            reference = result.entry.reference
+            if result.ok:
+                self._append({'op': 'posted', 'reference': reference,
+                              'id': result.id}, self.fsync == 'always')
+                self.counts['posted'] += 1
+            else:
+                if is_refused(result.error):
+                    self._append({'op': 'failed', 'reference': reference,
+                                  'error': repr(result.error)},
+                                 self.fsync == 'always')
+                self.counts['failed'] += 1
+            yield result
+
+    def _intents(self, entries):
+        """Log the intent of every entry not posted before, then yield it """
+        for entry in entries:
+            reference = entry.reference
+            if reference is None:
+                raise ValueError('Journal entries need a reference to be '
+                                 'posted through the log')
+            if reference in self._posted:
+                self.counts['skipped'] += 1
+                continue
+            if reference in self._pending:
+                raise ValueError('Journal entry %r is posted twice'
+                                 % (reference,))
+            if entry._parent is not None:
+                raise ValueError('Journal entry %r is in an unsaved book'
+                                 % (reference,))
+            self._append({'op': 'intent', 'reference': reference,
+                          'org': entry._org_id, 'book': entry._book_id,
+                          'effective_at': entry.effective_at,
+                          'description': entry.description,
+                          'lines': entry.line_items},
+                         self.fsync != 'never')
+            yield entry
+
+    def stats(self):
+        """Return the counters of this log """
+        stats = dict(self.counts)
+        stats['pending'] = len(self._pending)
+        return stats
+
+    def compact(self):
+        """Rewrite the log with only the posted references and pending
+        intents
+        """
+        with self._lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                for reference, id_ in sorted(self._posted.items()):
+                    f.write(self.serializer.dumps(
+                        {'op': 'posted', 'reference': reference,
+                         'id': id_}) + '\n')
+                for reference in sorted(self._pending):
+                    f.write(self.serializer.dumps(
+                        self._pending[reference]) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.rename(tmp, self.path)
+            self._file = open(self.path, 'ab')
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
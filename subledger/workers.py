@@ -0,0 +1,234 @@
+"""\
+Concurrent execution of Subledger requests
+
+Requests to Subledger block on network I/O. A WorkerPool runs them in a fixed
+number of threads and hands out a Future for every call, so many requests can
+be in flight at once while the caller decides when to wait for the results.
+
+Values put in `context` are scoped to the current thread. Calls submitted to
+a WorkerPool run with the context of the thread that submitted them.
+"""
+import sys
+import time
+import threading
+import Queue
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class _Context(threading.local):
+    """Values of the current thread, see the module docstring """
+
+    def __init__(self):
+        self.values = {}
+
+
+context = _Context()
+
+
+class Future(object):
+    """Result of a call that may not have finished yet """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the call to finish and return its result
+
+        Exceptions raised by the call are raised again here.
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timeout waiting for result')
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError('Timeout waiting for result')
+        if self._exc_info is not None:
+            return self._exc_info[1]
+        return None
+
+    def add_done_callback(self, func):
+        """Call `func` with this future when it is done """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exc_info(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def set_exception(self, exception):
+        self.set_exc_info((type(exception), exception, None))
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
+
+
+class WorkerPool(object):
+    """Run calls in a fixed number of threads
+
+    At most `max_workers` calls run at the same time. With `max_pending`
+    set, `submit` blocks while that many calls are waiting for a worker.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, max_pending=0):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._queue = Queue.Queue(max_pending)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, func, *args, **kwargs):
+        """Schedule func(*args, **kwargs) and return its Future """
+        if self._shutdown:
+            raise RuntimeError('Cannot submit to a pool that is shut down')
+        future = Future()
+        self._start_worker()
+        self._queue.put((future, func, args, kwargs, dict(context.values)))
+        return future
+
+    def map(self, func, *iterables):
+        """Like map() but run the calls concurrently
+
+        Results are yielded in the order of the arguments.
+        """
+        futures = [self.submit(func, *args) for args in zip(*iterables)]
+        for future in futures:
+            yield future.result()
+
+    def shutdown(self, wait=True):
+        """Stop the workers once all submitted calls are done """
+        with self._lock:
+            self._shutdown = True
+            threads = list(self._threads)
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _start_worker(self):
+        with self._lock:
+            if len(self._threads) >= self.max_workers:
+                return
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, func, args, kwargs, context.values = item
+            try:
+                result = func(*args, **kwargs)
+            except BaseException:
+                future.set_exc_info(sys.exc_info())
+            else:
+                future.set_result(result)
+            context.values = {}
+            del item, future, func, args, kwargs
+
+
+class SingleFlight(object):
+    """Share one call among concurrent callers asking for the same key
+
+    While a call for a key is running, other callers with that key wait for
+    its result instead of making the call again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        """Return func(*args, **kwargs), or the result of the running call
+        for `key`
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            future.set_exc_info(sys.exc_info())
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return result
+
+    def __len__(self):
+        return len(self._calls)
+
+
+def as_completed(futures):
+    """Yield the futures as soon as they are done """
+    futures = list(futures)
+    finished = Queue.Queue()
+    for future in futures:
+        future.add_done_callback(finished.put)
+    for _ in futures:
+        yield finished.get()
+
+
+def wait_all(futures):
+    """Wait for all futures and return their results in order """
+    return [future.result() for future in futures]
+
+
+class RateLimiter(object):
+    """Token bucket limiting calls to `rate` per second
+
+    Up to `burst` calls may pass at once after a quiet period.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call may be made """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
@@ -18,39 +18,93 @@ Identity created for this purpose
 }
 """
 import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 import logging
+from decimal import Decimal
+from email.utils import formatdate
+
+import requests
 
 logger = logging.getLogger()
 logger.setLevel('DEBUG')
 
-from subledger.base import Access
-from subledger.models import Organization, Book, Account, JournalEntry
+from subledger.balances import BalanceCache, get_balances
+from subledger.base import Access, AsyncAccess, Dummy, RetryPolicy, \
+    SubledgerBase, parse_retry_after, scoped_access
+from subledger.client import Client
+from subledger.identity import IdentityMap, StripedIdentityMap
+from subledger.ledger import Ledger
+from subledger.metrics import Histogram, endpoint
+from subledger.reports import Movements, TrialBalance
+from subledger.posting import JournalEntryWriter
+from subledger.session import Session
+from subledger.store import DiskCache
+from subledger.sync import BookMirror
+from subledger.serializers import get_serializer, available_serializers
+from subledger.testing import FakeSubledger
+from subledger.transfer import BookExporter, BookImporter, read_csv, \
+    write_ndjson
+from subledger.wal import WriteAheadLog
+from subledger.validation import JournalEntryValidator, ValidationError
+from subledger.workers import RateLimiter, WorkerPool
+from subledger.models import Organization, Book, Account, JournalEntry, Line
 
 # Setup the test account
 API_KEY = None
 SECRET = None
+# Access of the identity created for the live tests, False when offline
+_live_access = None
+
+
+def live_access():
+    """Return the Access of an identity created in Subledger on first use
+
+    Skips the calling tests when api.subledger.com cannot be reached, the
+    offline tests below run against FakeSubledger.
+    """
+    global API_KEY, SECRET, _live_access
+    if _live_access is None:
+        access = Access(key_id=None, secret=None)
+        try:
+            access.create_new_identity(email='r.r.nederhoed@gmail.com',
+                                       description='Identity for automated Unit testing',
+                                       reference='https://www.acme.com/')
+        except (requests.ConnectionError, requests.Timeout):
+            _live_access = False
+        else:
+            _live_access = access
+            # Use this newly created identity if API_KEY and SECRET are not set
+            if API_KEY is None or SECRET is None:
+                API_KEY = access._key_id
+                SECRET = access._secret
+    if not _live_access:
+        raise unittest.SkipTest('Subledger cannot be reached')
+    return _live_access
+
+
+class LiveTestCase(unittest.TestCase):
+    """Runs against api.subledger.com with the identity of live_access """
 
+    @classmethod
+    def setUpClass(cls):
+        live_access()
 
-class TestCreateAPIKey(unittest.TestCase):
-    access = Access(key_id=None, secret=None)
-    assert access._key_id is None
-    assert access._secret is None
-    key_id, secret = access.create_new_identity(email='r.r.nederhoed@gmail.com',
-                                                description='Identity for automated Unit testing',
-                                                reference='https://www.acme.com/')
-    assert access._key_id is not None
-    assert key_id == access._key_id
-    assert access._secret is not None
-    assert secret == access._secret
-    # While we're at it, override the API_KEY and SECRET using this newly created identity if they're set to None
-    if API_KEY is None or SECRET is None:
-        global API_KEY, SECRET
-        API_KEY = key_id
-        SECRET = secret
-
-
-class TestOrganization(unittest.TestCase):
+
+class TestCreateAPIKey(LiveTestCase):
+    def test_create_new_identity(self):
+        access = live_access()
+        self.assertIsNotNone(access._key_id)
+        self.assertIsNotNone(access._secret)
+        self.assertNotEqual(access._key_id, access._secret)
+
+
+class TestOrganization(LiveTestCase):
     def setUp(self):
         # Setup access to Subledger
         Organization.authenticate(API_KEY, SECRET)
@@ -72,7 +126,7 @@ class TestOrganization(unittest.TestCase):
         self.assertEqual(new, False)
 
 
-class TestOrganizationLoad(unittest.TestCase):
+class TestOrganizationLoad(LiveTestCase):
     def setUp(self):
         # Setup access to Subledger
         Organization.authenticate(API_KEY, SECRET)
@@ -104,7 +158,7 @@ class TestOrganizationLoad(unittest.TestCase):
         self.assertIsNot(org, self.org)
 
 
-class TestOrganizationArchive(unittest.TestCase):
+class TestOrganizationArchive(LiveTestCase):
     def setUp(self):
         # Setup access to Subledger
         Organization.authenticate(API_KEY, SECRET)
@@ -124,7 +178,7 @@ class TestOrganizationArchive(unittest.TestCase):
         self.assertEqual(self.org.is_active, True)
 
 
-class TestBook(unittest.TestCase):
+class TestBook(LiveTestCase):
     def setUp(self):
         # Setup access to Subledger
         Organization.authenticate(API_KEY, SECRET)
@@ -158,7 +212,7 @@ class TestBook(unittest.TestCase):
         self.assertIsNot(book, self.book)
 
 
-class TestAccount(unittest.TestCase):
+class TestAccount(LiveTestCase):
     def setUp(self):
         # Setup access to Subledger
         Organization.authenticate(API_KEY, SECRET)
@@ -228,7 +282,7 @@ class TestAccount(unittest.TestCase):
         self.assertIsNot(account, self.account)
 
 
-class TestJournalEntry(unittest.TestCase):
+class TestJournalEntry(LiveTestCase):
     def setUp(self):
         # Setup access to Subledger
         Organization.authenticate(API_KEY, SECRET)
@@ -279,5 +333,1096 @@ class TestJournalEntry(unittest.TestCase):
         self.assertIs(retrieved, self.journal_entry)
 
 
+class TestIdentityMap(unittest.TestCase):
+    def setUp(self):
+        self.index = IdentityMap(max_size=2, type_limits={'Book': 1})
+        self.org = Organization('ACME Inc.')
+        self.org._id = 'org-1'
+        self.books = [Book(self.org, 'EUR') for i in range(3)]
+        for i, book in enumerate(self.books):
+            book._id = 'book-%s' % i
+
+    def test_lookup(self):
+        self.index['org-1'] = self.org
+        self.assertIs(self.index.get('org-1'), self.org)
+        self.assertIs(self.index.get('missing'), None)
+        stats = self.index.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_eviction(self):
+        self.index['org-1'] = self.org
+        for book in self.books:
+            self.index[book._id] = book
+        stats = self.index.stats()
+        # Only one book is kept alive by the index
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['evictions'], 2)
+        # Evicted instances that are still referenced are found again
+        self.assertIs(self.index.get('book-0'), self.books[0])
+
+    def test_unreferenced_instances_are_dropped(self):
+        self.index['book-0'] = self.books.pop(0)
+        self.index['book-1'] = self.books.pop(0)
+        self.assertIs(self.index.get('book-0'), None)
+        self.assertIsNot(self.index.get('book-1'), None)
+
+    def test_setdefault_keeps_first_instance(self):
+        self.index['org-1'] = self.org
+        other = Organization('ACME Inc.')
+        self.assertIs(self.index.setdefault('org-1', other), self.org)
+
+    def test_striped(self):
+        index = StripedIdentityMap(stripes=4)
+        for book in self.books:
+            index[book._id] = book
+        self.assertIs(index.setdefault('book-1', self.org), self.books[1])
+        self.assertEqual(sorted(index.keys()), ['book-0', 'book-1', 'book-2'])
+        self.assertEqual(index.stats()['size'], 3)
+
+
+class TestLedger(unittest.TestCase):
+    def setUp(self):
+        self.ledger = Ledger()
+        self.ledger.add_line('cash', 'debit', '10.00', '2014-01-05T00:00:00Z')
+        self.ledger.add_line('cash', 'credit', '2.50', '2014-01-03T00:00:00Z')
+        self.ledger.add_line('cash', 'debit', '1.25', '2014-01-01T00:00:00Z')
+
+    def test_totals_at(self):
+        at = datetime.datetime(2014, 1, 4)
+        debit, credit = self.ledger.totals('cash', at)
+        self.assertEqual(str(debit), '1.25')
+        self.assertEqual(str(credit), '2.50')
+        debit, credit = self.ledger.totals('cash')
+        self.assertEqual(str(debit), '11.25')
+
+    def test_balance(self):
+        balance = self.ledger.balance('cash', '2014-01-04T00:00:00Z')
+        self.assertEqual(balance['balance']['value'],
+                         {'type': 'credit', 'amount': '1.25'})
+        balance = self.ledger.balance('unknown')
+        self.assertEqual(balance['balance']['value']['type'], 'zero')
+
+    def test_out_of_order_insert(self):
+        for day in range(6, 10):
+            self.ledger.add_line('cash', 'debit', '1', '2014-01-0%sT00:00:00Z'
+                                 % day)
+        self.assertEqual(self.ledger.totals('cash')[0], Decimal('15.25'))
+        account = self.ledger._accounts['cash']
+        self.ledger.add_line('cash', 'debit', '0.75', '2014-01-07T12:00:00Z')
+        # Only the totals from the inserted line on are dropped
+        self.assertEqual(len(account.debit_totals), 5)
+        self.assertEqual(self.ledger.totals('cash', '2014-01-07T00:00:00Z'),
+                         (Decimal('13.25'), Decimal('2.50')))
+        self.assertEqual(len(account.debit_totals), 5)
+        self.assertEqual(self.ledger.totals('cash', '2014-01-08T00:00:00Z'),
+                         (Decimal('15.00'), Decimal('2.50')))
+        self.assertEqual(self.ledger.totals('cash')[0], Decimal('16.00'))
+        self.assertEqual(len(account.debit_totals), 8)
+
+
+class TestTrialBalance(unittest.TestCase):
+    def setUp(self):
+        self.accounts = ['cash', 'revenue']
+        self.at = datetime.datetime(2014, 1, 1)
+        self.balances = {
+            'cash': self.ledger_balance('10.125', '0.10'),
+            'revenue': self.ledger_balance('0', '10.025')}
+
+    def ledger_balance(self, debit, credit):
+        return {'balance': {'debit_value': {'type': 'debit', 'amount': debit},
+                            'credit_value': {'type': 'credit',
+                                             'amount': credit}}}
+
+    def test_totals(self):
+        report = TrialBalance(self.accounts, self.balances, self.at)
+        self.assertEqual(str(report.total_debit), '10.125')
+        self.assertEqual(str(report.total_credit), '10.125')
+        self.assertTrue(report.is_balanced)
+
+    def test_rows(self):
+        report = TrialBalance(self.accounts, self.balances, self.at)
+        rows = list(report.rows())
+        self.assertEqual(rows[0][0], 'cash')
+        self.assertEqual(str(rows[0][2]), '0.100')
+
+
+class TestMovements(unittest.TestCase):
+    def setUp(self):
+        self.accounts = ['cash', 'revenue']
+        self.cut_offs = [datetime.datetime(2014, 1, day) for day in (1, 2, 3)]
+        amounts = {'cash': [('10.125', '0.1'), ('10.125', '0.10'),
+                            ('12', '0.1')],
+                   'revenue': [('0', '10.025'), ('0', '10.125'),
+                               ('0', '11.9')]}
+        self.balances = {}
+        for account, values in amounts.items():
+            for at, (debit, credit) in zip(self.cut_offs, values):
+                self.balances[(account, at)] = {'balance': {
+                    'debit_value': {'type': 'debit', 'amount': debit},
+                    'credit_value': {'type': 'credit', 'amount': credit}}}
+
+    def test_periods(self):
+        # Cut-offs are sorted
+        report = Movements(self.accounts, self.balances,
+                           reversed(self.cut_offs))
+        periods = list(report.periods())
+        self.assertEqual([(start, end) for start, end, _ in periods],
+                         zip(self.cut_offs, self.cut_offs[1:]))
+        self.assertEqual([list(column) for _, _, column in periods],
+                         [[0, -100], [1875, -1775]])
+
+    def test_rows(self):
+        report = Movements(self.accounts, self.balances, self.cut_offs)
+        rows = [(account, [str(amount) for amount in movements])
+                for account, movements in report.rows()]
+        self.assertEqual(rows, [('cash', ['0.000', '1.875']),
+                                ('revenue', ['-0.100', '-1.775'])])
+        self.assertEqual(sum(sum(movements) for _, movements
+                             in report.rows()), 0)
+
+
+class TestSerializers(unittest.TestCase):
+    def test_decimal_amounts_are_strings(self):
+        for name in available_serializers():
+            serializer = get_serializer(name)
+            text = serializer.dumps({'amount': Decimal('0.10')})
+            self.assertEqual(serializer.loads(text), {'amount': '0.10'})
+
+    def test_journal_entry_payload(self):
+        book = Book(Organization('ACME Inc.'), 'EUR')
+        entry = JournalEntry(book, 'Sale', '2014-01-01T00:00:00Z',
+                             [Line('cash', 'debit', '1.50'),
+                              Line('revenue', 'credit', '1.50')])
+        payload = get_serializer().dumps(entry._payload())
+        data = get_serializer().loads(payload)
+        self.assertEqual(data['lines'], entry.lines)
+        self.assertEqual(data['description'], 'Sale')
+        self.assertNotIn('_book_id', data)
+
+    def test_numeric_amounts(self):
+        book = Book(Organization('ACME Inc.'), 'EUR')
+        entry = JournalEntry(book, 'Sale', '2014-01-01T00:00:00Z',
+                             [{'account': 'cash',
+                               'value': {'type': 'debit', 'amount': 10.10}},
+                              {'account': 'fees',
+                               'value': {'type': 'debit', 'amount': 2}},
+                              {'account': 'revenue',
+                               'value': {'type': 'credit', 'amount': 12.1}}])
+        self.assertEqual([line.amount for line in entry.line_items],
+                         [Decimal('10.1'), Decimal('2'), Decimal('12.1')])
+        data = get_serializer().loads(get_serializer().dumps(entry._payload()))
+        self.assertEqual([line['value']['amount'] for line in data['lines']],
+                         ['10.1', '2', '12.1'])
+
+
+class TestValidation(unittest.TestCase):
+    def setUp(self):
+        self.book = Book(Organization('ACME Inc.'), 'EUR')
+        self.validator = JournalEntryValidator(accounts=['cash', 'revenue'])
+
+    def entry(self, effective_at, debit, credit, account='cash'):
+        return JournalEntry(self.book, 'Sale', effective_at,
+                            [Line(account, 'debit', debit),
+                             Line('revenue', 'credit', credit)])
+
+    def test_valid(self):
+        entries = [self.entry('2014-01-31T00:00:00Z', '0.10', '0.1'),
+                   self.entry('2014-01-31T12:00:00.250Z', 1, '1.00')]
+        self.assertEqual(self.validator.validate(entries), entries)
+
+    def test_all_failures_reported(self):
+        entries = [self.entry('2014-01-31T00:00:00Z', '1.00', '1.00'),
+                   self.entry('2014-02-30T00:00:00Z', '1.00', '1.00'),
+                   self.entry('2014-01-31', '1.00', '0.99'),
+                   self.entry('2014-01-31T00:00:00Z', '1', '1', 'bank')]
+        try:
+            self.validator.validate(entries)
+        except ValidationError as e:
+            self.assertEqual([index for index, _, _ in e.errors], [1, 2, 3])
+            self.assertEqual(len(e.errors[1][2]), 2)
+            self.assertIn('unknown account bank', e.errors[2][2][0])
+        else:
+            self.fail('ValidationError not raised')
+
+    def test_malformed_lines_reported(self):
+        def make_entry(amounts):
+            return self.entry('2014-01-31T00:00:00Z', *amounts)
+        try:
+            self.validator.build([('1', '1'), ('ten', '10'), ('1', '2'),
+                                  ('1', None)], make_entry)
+        except ValidationError as e:
+            self.assertEqual([(index, entry is None)
+                              for index, entry, _ in e.errors],
+                             [(1, True), (2, False), (3, True)])
+            self.assertIn("'ten'", e.errors[0][2][0])
+        else:
+            self.fail('ValidationError not raised')
+        entries = self.validator.build([('1', '1')], make_entry)
+        self.assertEqual(entries[0].line_items[0].amount, Decimal('1'))
+
+
+class FakeSubledgerTestCase(unittest.TestCase):
+    """Runs each test against a new FakeSubledger with seeded books
+
+    The first book is `book`, with the accounts `cash` and `revenue` when
+    at least two accounts are seeded per book.
+    """
+    latency = 0
+    seed_books = 1
+    seed_accounts = 2
+    identity_map_class = IdentityMap
+
+    def setUp(self):
+        self.server = FakeSubledger(latency=self.latency).start()
+        self.access = SubledgerBase.__dict__['_api'].default
+        self.identity_map = SubledgerBase.__dict__['_instance_index'].default
+        SubledgerBase.set_access(self.server.access())
+        SubledgerBase.set_identity_map(self.identity_map_class())
+        self.org_id = self.server.seed(books=self.seed_books,
+                                       accounts=self.seed_accounts)
+        self.books = [Book.from_id(id_, self.org_id)
+                      for id_ in sorted(self.server.books)]
+        if self.books:
+            self.book = self.books[0]
+            if self.seed_accounts >= 2:
+                self.cash, self.revenue = list(Account.all(self.book))[:2]
+
+    def tearDown(self):
+        # Close pooled connections, no server thread is left waiting on one
+        SubledgerBase._api.close()
+        SubledgerBase.set_access(self.access)
+        SubledgerBase.set_identity_map(self.identity_map)
+        self.server.stop()
+
+
+class TestListings(FakeSubledgerTestCase):
+    def setUp(self):
+        super(TestListings, self).setUp()
+        self.entries = []
+        for day in (3, 1, 2):
+            entry = JournalEntry(self.book, 'Sale %s' % day,
+                                 '2014-01-0%sT00:00:00Z' % day,
+                                 [Line(self.cash._id, 'debit', day),
+                                  Line(self.revenue._id, 'credit', day)])
+            entry.save()
+            self.entries.append(entry)
+
+    def test_journal_entries(self):
+        entries = list(JournalEntry.all(self.book, limit=2))
+        self.assertEqual([e.description for e in entries],
+                         ['Sale 1', 'Sale 2', 'Sale 3'])
+        # Listed entries are the indexed instances
+        self.assertIs(entries[2], self.entries[0])
+        requests = self.server.requests
+        JournalEntry.from_id(entries[0]._id, self.book._org_id,
+                             self.book._id)
+        self.assertEqual(self.server.requests, requests)
+
+    def test_capped_page_size(self):
+        # Subledger returns fewer items than asked for
+        self.server.max_page_size = 1
+        entries = list(JournalEntry.all(self.book, limit=2))
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(len(list(Account.all(self.book, limit=10))), 2)
+
+    def test_backward_paging(self):
+        for i in range(5):
+            Account(self.book, 'Account %s' % i).save()
+        ids = sorted(a._id for a in Account.all(self.book))
+        requests = self.server.requests
+        accounts = list(Account.all(self.book, action='ending', limit=3,
+                                    prefetch=False))
+        self.assertEqual(sorted(a._id for a in accounts), ids)
+        self.assertEqual(len(accounts), 7)
+        # Pages of 3, 3 and 1 items and the empty page ending the listing
+        self.assertEqual(self.server.requests - requests, 4)
+
+    def test_account_lines(self):
+        lines = list(self.cash.lines(effective_at='2014-01-02T00:00:00Z',
+                                     limit=1))
+        self.assertEqual([str(line.amount) for line in lines], ['2', '3'])
+        self.assertEqual(lines[1].journal_entry, self.entries[0]._id)
+        self.assertTrue(lines[0].debit)
+
+    def test_prefetch_related(self):
+        SubledgerBase.set_identity_map(IdentityMap())
+        book = Dummy()
+        book._id, book._org_id = self.book._id, self.book._org_id
+        accounts = list(Account.all(book))
+        requests = self.server.requests
+        # Printing does not load the book
+        self.assertIn('<Book %s>' % book._id, repr(accounts[0]))
+        self.assertEqual(self.server.requests, requests)
+        # Two pages, the second one empty, and the book
+        accounts = list(Account.all(book, prefetch_related=['book']))
+        self.assertEqual(self.server.requests, requests + 3)
+        self.assertEqual(accounts[0].book_ref.description, 'Book 0')
+        lines = list(self.cash.lines(prefetch_related=['journal_entry']))
+        requests = self.server.requests
+        entry = JournalEntry.from_id(lines[0].journal_entry, book._org_id,
+                                     book._id)
+        self.assertEqual(entry.description, 'Sale 1')
+        self.assertEqual(self.server.requests, requests)
+
+    def test_book_mirror(self):
+        mirror = BookMirror(':memory:', self.book)
+        stats = mirror.sync(limit=2)
+        self.assertEqual(stats['journal_entries'], 3)
+        self.assertEqual(stats['lines'], 6)
+        entry = JournalEntry(self.book, 'Sale 4', '2014-01-04T00:00:00Z',
+                             [Line(self.cash._id, 'debit', 4),
+                              Line(self.revenue._id, 'credit', 4)])
+        entry.save()
+        stats = mirror.sync(limit=2)
+        self.assertEqual((stats['accounts'], stats['journal_entries']),
+                         (0, 1))
+        self.server.stop()
+        entries = list(mirror.journal_entries(start='2014-01-03T00:00:00Z'))
+        self.assertEqual([e.description for e in entries],
+                         ['Sale 3', 'Sale 4'])
+        self.assertEqual(entries[1].line_items, entry.line_items)
+        self.assertEqual(len(mirror.lines(self.cash)), 4)
+
+
+class TestTransfer(FakeSubledgerTestCase):
+    seed_books = 2
+
+    def setUp(self):
+        super(TestTransfer, self).setUp()
+        self.copy = self.books[1]
+        for day in range(1, 6):
+            JournalEntry(self.book, 'Sale %s' % day,
+                         '2014-01-0%sT00:00:00Z' % day,
+                         [Line(self.cash._id, 'debit', day),
+                          Line(self.revenue._id, 'credit', day)]).save()
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(TestTransfer, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_resume_export(self):
+        path = os.path.join(self.dir, 'book.csv')
+        checkpoint = path + '.checkpoint'
+
+        def interrupt(stats):
+            raise KeyboardInterrupt
+        exporter = BookExporter(self.book, limit=2, checkpoint=checkpoint,
+                                checkpoint_every=1, progress=interrupt,
+                                report_every=4)
+        self.assertRaises(KeyboardInterrupt, exporter.export, path)
+        stats = BookExporter(self.book, limit=2,
+                             checkpoint=checkpoint).export(path)
+        self.assertEqual((stats['accounts'], stats['journal_entries'],
+                          stats['lines']), (2, 5, 10))
+        self.assertFalse(os.path.exists(checkpoint))
+        records = list(read_csv(open(path, 'rb')))
+        self.assertEqual([r['description'] for r in records[2:]],
+                         ['Sale %s' % day for day in range(1, 6)])
+        self.assertEqual(records[6]['lines'][1],
+                         {'account': self.revenue._id,
+                          'value': {'type': 'credit', 'amount': '5'}})
+
+    def test_export_requests_do_not_grow_with_accounts(self):
+        for i in range(40):
+            Account(self.book, 'Account %s' % i).save()
+        threads = threading.active_count()
+        requests = self.server.requests
+        records = BookExporter(self.book, max_workers=2).journal_entry_records()
+        self.assertEqual(next(records)['description'], 'Sale 1')
+        # Two pages of entries and the lines of the first five entries
+        self.assertTrue(self.server.requests - requests <= 7)
+        # Workers, the prefetch of the entries and a server thread for
+        # each of their connections, none per account
+        self.assertTrue(threading.active_count() - threads <= 6)
+        self.assertEqual([len(r['lines']) for r in records], [2] * 4)
+
+    def test_import_retries_failed_entries(self):
+        records = list(BookExporter(self.book).records())
+        records[3]['lines'][0]['value']['amount'] = '3'
+        checkpoint = os.path.join(self.dir, 'import.checkpoint')
+        importer = BookImporter(self.copy, checkpoint=checkpoint)
+        stats = importer.load(records)
+        self.assertEqual((stats['journal_entries'], stats['failed']), (4, 1))
+        self.assertEqual(importer.errors[0][0], 3)
+        records[3]['lines'][0]['value']['amount'] = '2'
+        stats = BookImporter(self.copy, checkpoint=checkpoint).load(records)
+        self.assertEqual((stats['accounts'], stats['journal_entries']),
+                         (0, 1))
+        self.assertFalse(os.path.exists(checkpoint))
+        copied = list(JournalEntry.all(self.copy))
+        self.assertEqual([e.description for e in copied],
+                         ['Sale %s' % day for day in range(1, 6)])
+
+    def copied_accounts(self):
+        return len(list(Account.all(self.copy)))
+
+    def test_import_resumes_after_crash(self):
+        records = list(BookExporter(self.book).records())
+        checkpoint = os.path.join(self.dir, 'import.checkpoint')
+
+        def crash(stats):
+            raise SystemExit
+        importer = BookImporter(self.copy, checkpoint=checkpoint,
+                                progress=crash, report_every=len(records))
+        # Killed before any checkpoint was saved
+        importer._checkpoint = lambda: None
+        self.assertRaises(SystemExit, importer.load, records)
+        self.assertFalse(os.path.exists(checkpoint))
+        accounts = self.copied_accounts()
+        stats = BookImporter(self.copy, checkpoint=checkpoint).load(records)
+        self.assertEqual((stats['accounts'], stats['journal_entries']),
+                         (0, 0))
+        self.assertEqual(self.copied_accounts(), accounts)
+        self.assertEqual(len(list(JournalEntry.all(self.copy))), 5)
+        self.assertFalse(os.path.exists(checkpoint + '.log'))
+
+    def test_import_resumes_failed_accounts(self):
+        records = list(BookExporter(self.book).records())
+        checkpoint = os.path.join(self.dir, 'import.checkpoint')
+        accounts = self.copied_accounts()
+        self.server.fail_next(status=400, method='POST')
+        importer = BookImporter(self.copy, checkpoint=checkpoint)
+        self.assertRaises(ValueError, importer.load, records)
+        self.assertEqual(len(importer.accounts), 1)
+        self.assertEqual(self.copied_accounts(), accounts + 1)
+        stats = BookImporter(self.copy, checkpoint=checkpoint).load(records)
+        self.assertEqual((stats['accounts'], stats['journal_entries']),
+                         (1, 5))
+        self.assertEqual(self.copied_accounts(), accounts + 2)
+
+    def test_unknown_account(self):
+        records = list(BookExporter(self.book).records())
+        records[5]['lines'][0]['account'] = 'unknown'
+        path = os.path.join(self.dir, 'book.ndjson')
+        with open(path, 'wb') as f:
+            list(write_ndjson(records, f))
+        requests = self.server.requests
+        importer = BookImporter(self.copy)
+        self.assertRaises(ValueError, importer.import_, path)
+        self.assertEqual(self.server.requests, requests)
+        # Entries posting when the record is read are done before it raises
+        checkpoint = os.path.join(self.dir, 'import.checkpoint')
+        importer = BookImporter(self.copy, max_workers=2,
+                                checkpoint=checkpoint)
+        self.assertRaises(ValueError, importer.load, records)
+        self.assertEqual(importer.stats()['journal_entries'], 3)
+        records[5]['lines'][0]['account'] = self.revenue._id
+        stats = BookImporter(self.copy, checkpoint=checkpoint).load(records)
+        self.assertEqual(stats['journal_entries'], 2)
+        self.assertEqual(len(list(JournalEntry.all(self.copy))), 5)
+
+    def test_malformed_amount(self):
+        records = list(BookExporter(self.book).records())
+        records[3]['lines'][0]['value']['amount'] = 'three'
+        importer = BookImporter(self.copy)
+        stats = importer.load(records)
+        self.assertEqual((stats['journal_entries'], stats['failed']), (4, 1))
+        self.assertEqual(importer.errors[0][0], 3)
+        self.assertIn("'three'", str(importer.errors[0][2]))
+
+
+class TestWriteAheadLog(FakeSubledgerTestCase):
+    def setUp(self):
+        super(TestWriteAheadLog, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'postings.wal')
+
+    def tearDown(self):
+        super(TestWriteAheadLog, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def entries(self, count):
+        return [JournalEntry(self.book, 'Sale %s' % i,
+                             '2014-01-0%sT00:00:00Z' % (i + 1),
+                             [Line(self.cash._id, 'debit', i + 1),
+                              Line(self.revenue._id, 'credit', i + 1)],
+                             reference='sale-%s' % i)
+                for i in range(count)]
+
+    def test_skips_posted_references(self):
+        with WriteAheadLog(self.path, max_workers=2) as log:
+            results = list(log.post(self.entries(3)))
+            self.assertTrue(all(result.ok for result in results))
+        with WriteAheadLog(self.path) as log:
+            results = list(log.post(self.entries(4)))
+            self.assertEqual([r.entry.reference for r in results],
+                             ['sale-3'])
+            self.assertEqual(log.stats()['skipped'], 3)
+        self.assertEqual(len(self.server.journal_entries), 4)
+
+    def test_reconcile_after_crash(self):
+        posted, lost, new = self.entries(3)
+        log = WriteAheadLog(self.path)
+        for entry in log._intents([posted, lost]):
+            pass
+        # The process died after posting the first entry
+        posted.save()
+        log.close()
+        with open(self.path, 'ab') as f:
+            f.write('{"op":"posted","refer')
+        log = WriteAheadLog(self.path)
+        self.assertEqual(log.pending, ['sale-0', 'sale-1'])
+        self.assertEqual(log.recover(), 1)
+        self.assertEqual(log.posted_id('sale-0'), posted._id)
+        results = list(log.post(self.entries(3)))
+        self.assertEqual([r.entry.reference for r in results],
+                         ['sale-1', 'sale-2'])
+        self.assertEqual(len(self.server.journal_entries), 3)
+        log.compact()
+        log.close()
+        self.assertEqual(WriteAheadLog(self.path).stats()['pending'], 0)
+
+
+class TestBalances(FakeSubledgerTestCase):
+    def setUp(self):
+        super(TestBalances, self).setUp()
+        JournalEntry(self.book, 'Sale', '2014-01-02T00:00:00Z',
+                     [Line(self.cash._id, 'debit', 5),
+                      Line(self.revenue._id, 'credit', 5)]).save()
+        self.at = datetime.datetime(2014, 1, 3)
+        self.later = datetime.datetime(2014, 1, 4)
+
+    def test_pairs_requested_once(self):
+        same_second = self.at.replace(microsecond=500000)
+        requests = self.server.requests
+        balances = get_balances([self.cash, self.revenue, self.cash],
+                                [self.at, same_second, self.at, self.later])
+        # Two accounts at two distinct seconds
+        self.assertEqual(self.server.requests - requests, 4)
+        self.assertEqual(set(balances),
+                         set((account, at)
+                             for account in (self.cash, self.revenue)
+                             for at in (self.at, same_second, self.later)))
+        balance = balances[(self.revenue, same_second)]['balance']
+        self.assertEqual(balance['credit_value']['amount'], '5')
+
+    def test_book_balances(self):
+        balances = self.book.get_balances([self.at, self.later])
+        self.assertEqual(len(balances), 4)
+        results = self.book.get_balances([self.at, self.later],
+                                         [self.cash, self.revenue],
+                                         stream=True, max_workers=1)
+        self.server.latency = 0.05
+        requests = self.server.requests
+        next(results)
+        # The first balance is yielded before all are requested
+        self.assertTrue(self.server.requests - requests < 4)
+        self.assertEqual(len(list(results)), 3)
+
+
+class TestBalanceCache(FakeSubledgerTestCase):
+    def setUp(self):
+        super(TestBalanceCache, self).setUp()
+        self.cache = BalanceCache(horizon=datetime.timedelta(days=1), ttl=0)
+        Account.set_balance_cache(self.cache)
+
+    def tearDown(self):
+        Account.set_balance_cache(None)
+        super(TestBalanceCache, self).tearDown()
+
+    def post(self, effective_at, amount):
+        JournalEntry(self.book, 'Sale', effective_at,
+                     [Line(self.cash._id, 'debit', amount),
+                      Line(self.revenue._id, 'credit', amount)]).save()
+
+    def amount(self, at):
+        return self.cash.get_balance(at)['balance']['value']['amount']
+
+    def test_settled_balances(self):
+        self.post('2014-01-02T00:00:00Z', 5)
+        at = datetime.datetime(2014, 1, 3)
+        self.assertEqual(self.amount(at), '5')
+        requests = self.server.requests
+        self.assertEqual(self.amount(at), '5')
+        self.assertEqual(self.server.requests, requests)
+        # A backdated entry changes the balance
+        self.post('2014-01-01T00:00:00Z', 2)
+        self.assertEqual(self.amount(at), '7')
+        self.post('2014-01-04T00:00:00Z', 1)
+        self.assertEqual(self.amount(at), '7')
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+    def test_recent_balances_expire(self):
+        now = datetime.datetime.utcnow()
+        self.cash.get_balance(now)
+        requests = self.server.requests
+        self.cash.get_balance(now)
+        self.assertEqual(self.server.requests, requests + 1)
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+
+class TestAccess(FakeSubledgerTestCase):
+    seed_books = 0
+
+    def test_connection_reuse(self):
+        access = self.server.access()
+        for _ in range(5):
+            access.get_json('/orgs/%s' % self.org_id)
+        stats = access.connection_stats()
+        self.assertEqual((stats['requests'], stats['connections']), (5, 1))
+        self.assertEqual(stats['reused'], 4)
+        self.assertEqual(stats['hit_rate'], 0.8)
+        access.close()
+
+
+class TestFreshness(FakeSubledgerTestCase):
+    seed_books = 0
+
+    def tearDown(self):
+        Organization.set_max_age(None)
+        super(TestFreshness, self).tearDown()
+
+    def change_org(self, description):
+        data = self.server.orgs[self.org_id]
+        data['description'] = description
+        data['version'] += 1
+
+    def test_max_age(self):
+        Organization.set_max_age(60)
+        org = Organization.from_id(self.org_id)
+        requests = self.server.requests
+        Organization.from_id(self.org_id)
+        self.assertEqual(self.server.requests, requests)
+        self.change_org('Stale Inc.')
+        org._fetched_at -= 120
+        self.assertIs(Organization.from_id(self.org_id), org)
+        self.assertEqual(self.server.requests, requests + 1)
+        self.assertEqual(org.description, 'Stale Inc.')
+
+    def test_refresh_ahead_once(self):
+        Organization.set_max_age(60, refresh_ahead=10)
+        org = Organization.from_id(self.org_id)
+        self.change_org('Ahead Inc.')
+        self.server.latency = 0.1
+        org._fetched_at -= 30
+        requests = self.server.requests
+        pool = WorkerPool(5)
+        futures = [pool.submit(Organization.from_id, self.org_id)
+                   for _ in range(5)]
+        self.assertTrue(all(f.result() is org for f in futures))
+        pool.shutdown()
+        deadline = time.time() + 5
+        while org._refreshing and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.server.requests, requests + 1)
+        self.assertEqual(org.description, 'Ahead Inc.')
+
+    def test_refresh_and_invalidate(self):
+        org = Organization.from_id(self.org_id)
+        self.assertFalse(org.refresh())
+        self.assertTrue(org.age < 1)
+        self.change_org('Changed Inc.')
+        org.invalidate()
+        self.assertIsNone(org.age)
+        requests = self.server.requests
+        Organization.from_id(self.org_id)
+        self.assertEqual(self.server.requests, requests + 1)
+        self.assertEqual(org.description, 'Changed Inc.')
+        self.assertFalse(org.is_dirty)
+
+
+class TestDiskCache(FakeSubledgerTestCase):
+    def setUp(self):
+        super(TestDiskCache, self).setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.db')
+
+    def tearDown(self):
+        SubledgerBase._disk_cache.close()
+        SubledgerBase.set_disk_cache(None)
+        super(TestDiskCache, self).tearDown()
+        shutil.rmtree(self.dir)
+
+    def test_archive_survives_restart(self):
+        SubledgerBase.set_disk_cache(DiskCache(self.path))
+        # Stored active, archiving keeps the version
+        SubledgerBase._disk_cache.put(self.cash)
+        self.cash.archive()
+        SubledgerBase._disk_cache.close()
+        # A new process
+        SubledgerBase.set_identity_map(IdentityMap())
+        SubledgerBase.set_disk_cache(DiskCache(self.path))
+        requests = self.server.requests
+        account = Account.from_id(self.cash._id, self.org_id, self.book._id)
+        self.assertEqual(self.server.requests, requests)
+        self.assertEqual(account._type, 'archived_account')
+
+    def test_batched_commits(self):
+        cache = DiskCache(self.path, commit_every=3, commit_interval=60)
+        SubledgerBase.set_disk_cache(cache, hydrate=False)
+        reader = sqlite3.connect(self.path)
+        count = 'SELECT COUNT(*) FROM instances'
+        cache.put(self.cash)
+        cache.put(self.revenue)
+        self.assertEqual(reader.execute(count).fetchone()[0], 0)
+        cache.put(self.book)
+        self.assertEqual(reader.execute(count).fetchone()[0], 3)
+        cache.put(self.cash)
+        self.assertEqual(len(cache), 3)
+        reader.close()
+
+    def test_clients_own_cache(self):
+        SubledgerBase.set_disk_cache(DiskCache(self.path))
+        SubledgerBase._disk_cache.put(self.cash)
+        args = self.cash._id, self.org_id, self.book._id
+        client = Client(access=self.server.access())
+        requests = self.server.requests
+        with client:
+            account = Account.from_id(*args)
+        # Loaded with the credentials of the client, not from the cache
+        self.assertEqual(self.server.requests, requests + 1)
+        self.assertIsNot(account, self.cash)
+        client.close()
+        # A client with a disk cache is filled from it
+        path = os.path.join(self.dir, 'client.db')
+        cache = DiskCache(path)
+        cache.put(account)
+        cache.close()
+        client = Client(access=self.server.access(),
+                        disk_cache=DiskCache(path))
+        self.assertEqual(len(client.identity_map), 1)
+        requests = self.server.requests
+        with client:
+            cached = Account.from_id(*args)
+        self.assertEqual(self.server.requests, requests)
+        self.assertIs(cached._client, client)
+        client.disk_cache.close()
+        client.close()
+
+
+class TestJournalEntryWriter(FakeSubledgerTestCase):
+    seed_accounts = 4
+
+    def setUp(self):
+        super(TestJournalEntryWriter, self).setUp()
+        self.accounts = list(Account.all(self.book))
+        self.server.latency = 0.01
+
+    def entries(self, count):
+        # Even entries share the first two accounts, odd ones the others
+        for i in range(count):
+            debit, credit = self.accounts[i % 2 * 2:i % 2 * 2 + 2]
+            yield JournalEntry(self.book, 'Entry %s' % i,
+                               '2014-01-01T00:00:00Z',
+                               [Line(debit._id, 'debit', i + 1),
+                                Line(credit._id, 'credit', i + 1)])
+
+    def test_per_account_order(self):
+        writer = JournalEntryWriter(max_workers=4)
+        self.assertTrue(all(r.ok for r in writer.post(self.entries(12))))
+        posted = [self.server.journal_entries[id_]['description']
+                  for id_ in sorted(self.server.journal_entries)]
+        for parity in (0, 1):
+            numbers = [int(d.split()[1]) for d in posted
+                       if int(d.split()[1]) % 2 == parity]
+            self.assertEqual(numbers, sorted(numbers))
+
+    def test_backpressure_and_stats(self):
+        read = []
+
+        def entries():
+            for entry in self.entries(10):
+                read.append(entry)
+                yield entry
+        writer = JournalEntryWriter(max_workers=2, max_pending=2)
+        results = writer.post(entries())
+        next(results)
+        self.assertTrue(len(read) <= 3)
+        list(results)
+        stats = writer.stats()
+        self.assertEqual((stats['submitted'], stats['posted'],
+                          stats['failed']), (10, 10, 0))
+        self.assertTrue(stats['entries_per_second'] > 0)
+        self.assertTrue(stats['mean_latency'] >= 0.01)
+
+    def test_failures_counted(self):
+        entry = next(self.entries(1))
+        entry.lines = [Line(self.accounts[0]._id, 'debit', 1)]
+        writer = JournalEntryWriter()
+        results = list(writer.post([entry]))
+        self.assertFalse(results[0].ok)
+        self.assertEqual(results[0].error.args[0], 400)
+        self.assertEqual(writer.stats()['failed'], 1)
+
+    def test_bounded_pool_rejected(self):
+        pool = WorkerPool(2, max_pending=4)
+        self.assertRaises(ValueError, JournalEntryWriter, pool=pool)
+        pool.shutdown()
+
+
+class TestRetry(FakeSubledgerTestCase):
+    def setUp(self):
+        super(TestRetry, self).setUp()
+        SubledgerBase._api.close()
+        SubledgerBase.set_access(self.server.access(
+            retry=RetryPolicy(backoff=0.01, max_backoff=0.05, jitter=False)))
+
+    def test_create_retried_on_429_only(self):
+        self.server.fail_next(status=503, method='POST')
+        account = Account(self.book, 'Bank')
+        try:
+            account.save()
+        except ValueError as e:
+            self.assertEqual(e.args[0], 503)
+        else:
+            self.fail('A create is retried after a server error')
+        self.assertEqual(len(self.server.accounts), 2)
+        self.server.fail_next(2, status=429, method='POST')
+        account.save()
+        self.assertEqual(len(self.server.accounts), 3)
+        self.assertEqual(SubledgerBase._api.retries, 2)
+
+    def test_archive_and_activate_retried(self):
+        self.server.fail_next(status=503, method='POST')
+        self.cash.archive()
+        self.assertEqual(self.server.accounts[self.cash._id]['state'],
+                         'archived')
+        self.server.fail_next(status=502, method='POST')
+        self.cash.activate()
+        self.assertEqual(self.server.accounts[self.cash._id]['state'],
+                         'active')
+        self.assertEqual(SubledgerBase._api.retries, 2)
+
+    def test_connection_error_retried(self):
+        access = SubledgerBase._api
+        access.get_json('/orgs/%s' % self.org_id)
+        self.server.fail_next(status=None)
+        data = access.get_json('/orgs/%s' % self.org_id)
+        self.assertEqual(data['active_org']['id'], self.org_id)
+        self.assertEqual(access.retries, 1)
+
+    def test_retry_after_capped(self):
+        self.server.fail_next(status=503, headers={'Retry-After': '3600'})
+        start = time.time()
+        SubledgerBase._api.get_json('/orgs/%s' % self.org_id)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(RetryPolicy(max_backoff=5).delay(0, 3600), 5)
+
+    def test_retry_after_date(self):
+        self.assertTrue(55 < parse_retry_after(formatdate(time.time() + 60,
+                                                          usegmt=True)) <= 60)
+        self.assertEqual(parse_retry_after(formatdate(time.time() - 60)), 0)
+        self.assertEqual(parse_retry_after('2'), 2)
+        self.assertEqual(parse_retry_after('soon'), None)
+        self.server.fail_next(status=429, headers={
+            'Retry-After': formatdate(time.time() + 60, usegmt=True)})
+        start = time.time()
+        SubledgerBase._api.get_json('/orgs/%s' % self.org_id)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(20, burst=2)
+        start = time.time()
+        for _ in range(6):
+            limiter.acquire()
+        # The burst passes at once, the other 4 calls wait 1 / 20s each
+        self.assertTrue(0.18 < time.time() - start < 0.5)
+
+    def test_rate_limited_access(self):
+        access = self.server.access(rate_limit=50)
+        start = time.time()
+        for _ in range(5):
+            access.get_json('/orgs/%s' % self.org_id)
+        self.assertTrue(time.time() - start >= 0.07)
+        access.close()
+
+
+class TestMetrics(FakeSubledgerTestCase):
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        SubledgerBase._api.close()
+        SubledgerBase.set_access(self.server.access(
+            retry=RetryPolicy(backoff=0.01, jitter=False)))
+
+    def test_endpoint(self):
+        self.assertEqual(endpoint('/orgs/a1/books/b2/accounts/c3/balance'
+                                  '?at=2014-01-01T00:00:00Z'),
+                         '/orgs/:id/books/:id/accounts/:id/balance')
+        self.assertEqual(endpoint('/orgs/a1/books/b2/journal_entries/'
+                                  'create_and_post'),
+                         '/orgs/:id/books/:id/journal_entries/'
+                         'create_and_post')
+        self.assertEqual(endpoint('/orgs/a1/books/'), '/orgs/:id/books/')
+
+    def test_histogram(self):
+        histogram = Histogram((1, 2, 3))
+        self.assertEqual(histogram.quantile(0.5), None)
+        for value in (0.5, 1.5, 2.5, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.quantile(0.25), 1)
+        self.assertEqual(histogram.quantile(0.5), 2)
+        # Above the largest bucket the maximum is returned
+        self.assertEqual(histogram.quantile(0.99), 10)
+        snapshot = histogram.snapshot()
+        self.assertEqual((snapshot['overflow'], snapshot['count'],
+                          snapshot['min'], snapshot['mean']),
+                         (1, 4, 0.5, 3.625))
+
+    def test_snapshot(self):
+        events = []
+
+        def broken(event):
+            raise RuntimeError
+        metrics = SubledgerBase._api.metrics
+        metrics.add_listener(events.append)
+        metrics.add_listener(broken)
+        at = datetime.datetime(2014, 1, 1)
+        self.cash.get_balance(at)
+        self.server.fail_next(status=503, method='GET')
+        self.cash.get_balance(at)
+        snapshot = SubledgerBase.metrics()
+        balance = snapshot['endpoints'][
+            'GET /orgs/:id/books/:id/accounts/:id/balance']
+        self.assertEqual(balance['statuses'], {200: 2, 503: 1})
+        self.assertEqual(balance['retries'], 1)
+        self.assertEqual(balance['latency']['count'], 3)
+        self.assertEqual(balance['bytes_sent'], 0)
+        self.assertTrue(balance['bytes_received'] > 0)
+        self.assertEqual((snapshot['totals']['requests'],
+                          snapshot['totals']['retries']), (3, 1))
+        self.assertEqual([(e['status'], e['attempt']) for e in events],
+                         [(200, 0), (503, 0), (200, 1)])
+        self.assertIn('hit_rate', snapshot['identity_map'])
+        metrics.reset()
+        self.assertEqual(SubledgerBase.metrics()['endpoints'], {})
+
+
+class TestAsync(FakeSubledgerTestCase):
+    def setUp(self):
+        super(TestAsync, self).setUp()
+        SubledgerBase.set_concurrency(2)
+
+    def tearDown(self):
+        SubledgerBase._workers.shutdown()
+        SubledgerBase._workers = None
+        super(TestAsync, self).tearDown()
+
+    def test_same_instances(self):
+        org = Organization.from_id_async(self.org_id).result()
+        self.assertIs(org, Organization.from_id(self.org_id))
+        accounts = Account.all_async(self.book).result()
+        self.assertIs(accounts[0], self.cash)
+        self.assertIs(accounts[1], self.revenue)
+        account = Account(self.book, 'Bank')
+        self.assertTrue(account.save_async().result())
+        self.assertIs(Account.from_id(account._id, self.org_id,
+                                      self.book._id), account)
+        account.archive_async().result()
+        self.assertEqual(self.server.accounts[account._id]['state'],
+                         'archived')
+        account.activate_async().result()
+        self.assertEqual(self.server.accounts[account._id]['state'],
+                         'active')
+        at = datetime.datetime(2014, 1, 1)
+        self.assertEqual(self.cash.get_balance_async(at).result(),
+                         self.cash.get_balance(at))
+
+    def test_async_access(self):
+        access = AsyncAccess(SubledgerBase._api, max_workers=2)
+        futures = [access.get_json('/orgs/%s' % self.org_id)
+                   for _ in range(3)]
+        self.assertEqual([f.result()['active_org']['id'] for f in futures],
+                         [self.org_id] * 3)
+        access.pool.shutdown()
+
+    def test_set_concurrency_stops_previous_workers(self):
+        previous = SubledgerBase._workers
+        Organization.from_id_async(self.org_id).result()
+        SubledgerBase.set_concurrency(4)
+        self.assertIsNot(SubledgerBase._workers, previous)
+        for thread in previous._threads:
+            thread.join(1)
+            self.assertFalse(thread.is_alive())
+
+
+class TestSession(FakeSubledgerTestCase):
+    seed_books = 0
+
+    def test_flush_in_dependency_order(self):
+        org = Organization('ACME Inc.')
+        book = Book(org, 'EUR')
+        accounts = [Account(book, 'Account %s' % i) for i in range(3)]
+        session = Session()
+        session.add_all(accounts + [book, org])
+        self.assertEqual(len(session.flush()), 5)
+        self.assertEqual(book._org_id, org._id)
+        self.assertEqual(accounts[0]._book_id, book._id)
+        self.assertEqual(session.dirty, [])
+
+    def test_save_sends_changes_only(self):
+        org = Organization('ACME Inc.', 'https://www.acme.com/')
+        org.save()
+        requests = self.server.requests
+        self.assertFalse(org.save())
+        self.assertEqual(self.server.requests, requests)
+        org.description = 'ACME Corp.'
+        self.assertEqual(org._changes(), {'description': 'ACME Corp.'})
+        org.save()
+        self.assertEqual(org._version, 2)
+        self.assertFalse(org.is_dirty)
+
+
+class TestConcurrentAccess(FakeSubledgerTestCase):
+    latency = 0.05
+    seed_books = 0
+    identity_map_class = StripedIdentityMap
+
+    def test_from_id_single_flight(self):
+        pool = WorkerPool(10)
+        requests = self.server.requests
+        futures = [pool.submit(Organization.from_id, self.org_id)
+                   for _ in range(10)]
+        orgs = set(id(future.result()) for future in futures)
+        pool.shutdown()
+        self.assertEqual(len(orgs), 1)
+        self.assertEqual(self.server.requests, requests + 1)
+
+    def test_scoped_access(self):
+        other = self.server.access()
+        with scoped_access(other):
+            self.assertIs(SubledgerBase._api, other)
+            future = Organization.from_id_async(self.org_id)
+            future.result()
+        self.assertIsNot(SubledgerBase._api, other)
+        self.assertEqual(other.metrics.snapshot()['totals']['requests'], 1)
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.servers = [FakeSubledger().start(), FakeSubledger().start()]
+        # Both servers hand out the same ids
+        self.org_ids = [server.seed(books=1, accounts=i + 1,
+                                    org_description='Tenant %s' % i)
+                        for i, server in enumerate(self.servers)]
+        self.clients = [Client(access=server.access())
+                        for server in self.servers]
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for server in self.servers:
+            server.stop()
+
+    def test_instances_bound_to_client(self):
+        orgs = []
+        for client, org_id in zip(self.clients, self.org_ids):
+            with client:
+                orgs.append(Organization.from_id(org_id))
+        self.assertIsNot(orgs[0], orgs[1])
+        self.assertEqual(orgs[1].description, 'Tenant 1')
+        # Outside the with block instances keep using their client
+        book = list(Book.all(orgs[1]))[0]
+        self.assertIs(book._client, self.clients[1])
+        self.assertEqual(len(list(Account.all(book))), 2)
+        account = Account(book, 'Cash')
+        account.save()
+        self.assertIn(account._id, self.servers[1].accounts)
+        self.assertIs(self.clients[1].identity_map.get(account._id), account)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file